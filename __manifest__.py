@@ -78,11 +78,13 @@
         # 2. Datos iniciales (secuencias)
         'data/tms_sequence_data.xml',
         'data/tms_data.xml',
+        'data/tms_cron_data.xml',
 
 
         # 3. Wizard de importación
         'wizard/sat_import_wizard_views.xml',
         'wizard/partner_assign_company_wizard_views.xml',
+        'wizard/waybill_requote_wizard_views.xml',
 
         # 3. Vistas de Catálogos SAT (orden alfabético)
         'views/sat_clave_prod_views.xml',
@@ -96,6 +98,7 @@
         'views/sat_material_peligroso_views.xml',
         'views/sat_municipio_views.xml',
         'views/sat_tipo_permiso_views.xml',
+        'views/sat_import_job_views.xml',
 
         # 3.1 Extensiones de modelos base SAT
         'views/res_partner_tms_view.xml',
@@ -107,9 +110,13 @@
 
         # 5. Vistas de Destinos/Rutas
         'views/tms_destination_views.xml',
+        'views/tms_route_job_views.xml',
+        'views/tms_fuel_price_views.xml',
+        'views/tms_rate_card_views.xml',
 
         # 6. Vistas de Viajes (Dashboard Kanban - MODELO MAESTRO)
         'views/tms_waybill_views.xml',
+        'views/tms_waybill_position_views.xml',
 
         # 7. Dashboard
         'views/tms_dashboard_views.xml',
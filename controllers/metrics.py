@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import hmac
+
+from odoo import http
+from odoo.http import request
+
+from ..models import tms_metrics
+
+
+class TMSMetrics(http.Controller):
+
+    @http.route('/tms/metrics', type='http', auth='public', methods=['GET'], csrf=False, save_session=False)
+    def tms_metrics(self, token=None, **kwargs):
+        """
+        Métricas del TMS en formato de texto de Prometheus.
+
+        Protegido con el parámetro 'tms.metrics_token' (query ?token= o
+        cabecera Authorization: Bearer). Sin token configurado o con token
+        incorrecto responde 404, igual que una ruta inexistente.
+
+        Los números son del worker que atiende la petición (etiqueta 'worker').
+        """
+        expected = request.env['ir.config_parameter'].sudo().get_param('tms.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if not expected or not token or not hmac.compare_digest(token, expected):
+            raise request.not_found()
+        gauges = request.env['tms.route.provider'].sudo()._get_metric_gauges()
+        return request.make_response(
+            tms_metrics.render_prometheus(request.env.cr.dbname, gauges),
+            headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('Cache-Control', 'no-store')],
+        )
@@ -22,6 +22,7 @@ from . import sat_municipio           # c_Municipio - Municipios
 from . import sat_config_autotransporte  # c_ConfigAutotransporte - Config vehicular
 from . import sat_tipo_permiso        # c_TipoPermiso - Permisos SCT
 from . import sat_figura_transporte   # c_FiguraTransporte - Figuras en transporte
+from . import sat_import_job          # Importación de catálogos en segundo plano (cron)
 from . import res_partner_tms         # Extensión de res.partner para Catálogos SAT
 
 # ============================================================
@@ -48,5 +49,14 @@ from . import sat_localidad
 from . import sat_municipio
 from . import sat_codigo_postal
 from . import tms_waybill
+from . import tms_waybill_position      # Bitácora GPS (breadcrumbs, solo inserción)
+from . import tms_waybill_eta           # ETA en vivo por viaje en trayecto
+from . import tms_route_provider        # Proveedores de rutas (google / local)
+from . import tms_route_job             # Cola de cálculo de rutas (cron)
+from . import tms_cache_generation      # Generaciones de las cachés en memoria (invalidación acotada)
+from . import tms_route_failure         # Caché negativa de rutas (carriles fallidos)
+from . import tms_fuel_price            # Índice de precios del diesel por región
+from . import tms_rate_card             # Tarifarios por cliente (índice de tramos)
+from . import res_company
 from . import res_config_settings
 from . import tms_vehicle_type             # Viajes / Cartas Porte (MODELO MAESTRO: fusiona Cotización + Viaje)
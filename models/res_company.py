@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    # Caché de rutas (tms.destination): vigencia por empresa
+    tms_route_cache_ttl_days = fields.Integer(
+        string="Vigencia de Rutas en Caché (días)",
+        default=180,
+        help="Después de este plazo la ruta guardada se considera vencida y se recalcula.")
+    tms_route_cache_serve_stale = fields.Boolean(
+        string="Usar Ruta Vencida mientras se Recalcula",
+        default=True,
+        help="Si está activo, una ruta vencida se usa de inmediato y se recalcula en segundo plano. "
+             "Si no, la cotización espera el nuevo cálculo.")
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'tms_route_cache_ttl_days' in vals:
+            # La vigencia forma parte de la caché en memoria de rutas (tms.destination)
+            self.env['tms.cache.generation']._bump('tms.destination', self.ids)
+        return res
@@ -1,4 +1,6 @@
-from odoo import fields, models
+from markupsafe import Markup, escape
+
+from odoo import _, api, fields, models
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -8,4 +10,54 @@ class ResConfigSettings(models.TransientModel):
     tms_route_provider = fields.Selection([
         ('std', 'Manual / Estándar'),
         ('google', 'Google Maps API'),
-    ], string="Proveedor de Rutas", default='std', config_parameter='tms.route_provider')
+        ('local', 'Local (sin red: CP + factor carretera)'),
+    ], string="Proveedor de Rutas", default='std', config_parameter='tms.route_provider',
+        help="Local: estima al instante desde los centroides de CP y un factor carretera aprendido de las rutas guardadas; no calcula casetas.")
+
+    # Geocercas (Avance automático de estados por GPS)
+    tms_geofence_radius_m = fields.Integer(
+        string="Radio de Geocerca (m)", default=500, config_parameter='tms.geofence_radius_m',
+        help="Radio alrededor de la geolocalización del contacto de origen/destino")
+    tms_geofence_cp_radius_m = fields.Integer(
+        string="Radio por Código Postal (m)", default=2000, config_parameter='tms.geofence_cp_radius_m',
+        help="Radio alrededor del centroide del CP cuando el contacto no está geolocalizado")
+
+    # Caché de rutas (por empresa)
+    tms_route_cache_ttl_days = fields.Integer(
+        related='company_id.tms_route_cache_ttl_days', readonly=False)
+    tms_route_cache_serve_stale = fields.Boolean(
+        related='company_id.tms_route_cache_serve_stale', readonly=False)
+    tms_route_refresh_budget = fields.Integer(
+        string="Rutas a Recalcular por Hora", default=50, config_parameter='tms.route_refresh_budget',
+        help="Máximo de rutas vencidas que el cron envía al proveedor en cada ejecución")
+    tms_metrics_token = fields.Char(
+        string="Token de Métricas", config_parameter='tms.metrics_token',
+        help="Habilita /tms/metrics (formato Prometheus) para quien envíe este token. Vacío: deshabilitado.")
+    tms_metrics_report = fields.Html(
+        string="Métricas de Rutas", compute='_compute_tms_metrics_report', sanitize=False)
+
+    @api.depends('company_id')
+    def _compute_tms_metrics_report(self):
+        """Tabla con la caché de rutas y los proveedores (números de este worker)."""
+        cache = self.env['tms.destination']._get_cache_stats()
+        providers = self.env['tms.route.provider']._get_provider_stats()
+        rows = [
+            (_("Caché: consultas"), cache['total']),
+            (_("Caché: aciertos / vencidas / fallos"), '%s / %s / %s' % (cache['hit'], cache['stale'], cache['miss'])),
+            (_("Caché: tasa de acierto"), '%.1f %%' % cache['hit_rate']),
+            (_("Caché en memoria: tasa de acierto"), '%.1f %%' % cache['lru_hit_rate']),
+        ]
+        for provider, stats in sorted(providers.items()):
+            rows += [
+                (_("%s: llamadas / errores / rechazadas", provider),
+                 '%s / %s / %s' % (stats['calls'], stats['errors'], stats['rejected'])),
+                (_("%s: latencia promedio / p95", provider), '%.0f ms / %.0f ms' % (stats['avg_ms'], stats['p95_ms'])),
+                (_("%s: casetas cotizadas", provider), '$ %.2f' % stats['tolls']),
+                (_("%s: circuit breaker", provider), stats['breaker']),
+            ]
+        report = Markup('<table class="table table-sm">%s</table>') % Markup('').join(
+            Markup('<tr><td>%s</td><td class="text-end">%s</td></tr>') % (escape(label), escape(value))
+            for label, value in rows
+        )
+        for settings in self:
+            settings.tms_metrics_report = report
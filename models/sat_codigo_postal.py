@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields
+from odoo import models, fields, api
+from odoo.tools import SQL
 
 
 class TmsSatCodigoPostal(models.Model):
@@ -46,6 +47,18 @@ class TmsSatCodigoPostal(models.Model):
         help='Localidad al que pertenece el código postal'
     )
 
+    # Centroide geográfico del CP (no viene en c_CP del SAT; se carga aparte,
+    # ej. SEPOMEX/INEGI). Se usa para geocercas y estimaciones de distancia.
+    latitude = fields.Float(
+        string='Latitud (Centroide)',
+        help='Latitud aproximada del centro del código postal'
+    )
+
+    longitude = fields.Float(
+        string='Longitud (Centroide)',
+        help='Longitud aproximada del centro del código postal'
+    )
+
     # ============================================================
     # CONSTRAINTS - UNICIDAD COMPUESTA
     # ============================================================
@@ -62,6 +75,29 @@ class TmsSatCodigoPostal(models.Model):
     # MÉTODOS
     # ============================================================
 
+    @api.model
+    def _get_centroids(self, codes):
+        """
+        Centroide de varios CPs en una sola consulta.
+        Si un CP tiene varias filas (por estado/municipio), se promedian.
+
+        :return: dict {code: (lat, long)}
+        """
+        if not codes:
+            return {}
+        self.env.cr.execute(SQL(
+            """
+            SELECT code, AVG(latitude), AVG(longitude)
+              FROM tms_sat_codigo_postal
+             WHERE code = ANY(%s)
+               AND latitude IS NOT NULL AND latitude != 0
+               AND longitude IS NOT NULL AND longitude != 0
+             GROUP BY code
+            """,
+            list(codes),
+        ))
+        return {code: (lat, long) for code, lat, long in self.env.cr.fetchall()}
+
     def name_get(self):
         """
         Muestra: "CP - Municipio (Estado)"
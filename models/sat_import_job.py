@@ -0,0 +1,834 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import codecs
+import contextlib
+import csv
+import io
+import itertools
+import logging
+import os
+import tempfile
+import time
+
+from psycopg2 import IntegrityError
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.tools import SQL, config
+from odoo.tools.sql import create_index
+
+# Importamos openpyxl para leer archivos Excel modernos (.xlsx)
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Importamos xlrd para leer archivos Excel antiguos (.xls)
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
+
+_logger = logging.getLogger(__name__)
+
+# =======================================================
+# IMPORTACIÓN EN STREAMING
+# =======================================================
+# Filas normalizadas que se escriben a la BD por lote (la memoria no crece con el archivo)
+SAT_IMPORT_CHUNK_SIZE = 5000
+
+# Bloque de base64 decodificado por paso al volcar la carga a disco (múltiplo de 4)
+SAT_IMPORT_DECODE_BLOCK = 4 * 1024 * 1024
+
+# Tiempo máximo (segundos) que el cron dedica a las importaciones en cada ejecución
+SAT_IMPORT_CRON_BUDGET = 90
+
+# Margen (segundos) bajo el límite real del worker de cron: el último lote y el conteo
+# de obsoletos se ejecutan después de revisar el presupuesto
+SAT_IMPORT_CRON_MARGIN = 30
+
+# Espacio de nombres de los advisory locks por importación (evita chocar con otros locks)
+SAT_IMPORT_LOCK_NAMESPACE = 7630196
+
+# Separador de las columnas de una llave compuesta en tms.sat.import.job.key
+SAT_IMPORT_KEY_SEPARATOR = '\x1f'
+
+# Firmas (magic bytes) de los formatos Excel; cualquier otro archivo se lee como texto delimitado
+SAT_IMPORT_XLSX_MAGIC = b'PK\x03\x04'                        # .xlsx (contenedor ZIP)
+SAT_IMPORT_XLS_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # .xls (OLE2)
+
+# Bytes del inicio del archivo que se usan para detectar el separador del CSV / TXT
+SAT_IMPORT_SNIFF_BYTES = 64 * 1024
+
+# Separadores posibles en los CSV / TXT del SAT
+SAT_IMPORT_DELIMITERS = ',|;\t'
+
+
+def chunked(iterable, size):
+    """Parte un iterable en listas de hasta `size` elementos (sin materializarlo)."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# =======================================================
+# MAPEO ESTRUCTURAL Y DE LLAVES ÚNICAS (AUDITADO)
+# =======================================================
+CATALOG_MAP = {
+    # --- GEOGRÁFICOS ---
+
+    # 1. Códigos Postales (Archivo c_CP.xls)
+    # Estructura verificada: Col 0=CP, 1=Estado, 2=Municipio, 3=Localidad
+    'zip': {
+        'model': 'tms.sat.codigo.postal',
+        'cols': {'code': 0, 'estado': 1, 'municipio': 2, 'localidad': 3},
+        'keys': ['code', 'estado', 'municipio']  # Llave compuesta según SQL constraint
+    },
+
+    # 2. Localidades (c_Localidad.csv)
+    # Estructura: 0=Clave, 1=Estado, 2=Descripción
+    'localidad': {
+        'model': 'tms.sat.localidad',
+        'cols': {'code': 0, 'estado': 1, 'name': 2},
+        'keys': ['code', 'estado']  # Único por Clave + Estado
+    },
+
+    # 3. Municipios (c_Municipio.csv)
+    # Estructura: 0=Clave, 1=Estado, 2=Descripción
+    'municipio': {
+        'model': 'tms.sat.municipio',
+        'cols': {'code': 0, 'estado': 1, 'name': 2},
+        'keys': ['code', 'estado']  # Único por Clave + Estado
+    },
+
+    # 4. Colonias (c_Colonia_*.csv)
+    # Estructura: 0=Clave, 1=CP, 2=Nombre
+    # El SAT publica las colonias en varios archivos por rango de CP: los
+    # obsoletos se cuentan solo entre los CPs que vienen en el archivo
+    'colonia': {
+        'model': 'tms.sat.colonia',
+        'cols': {'code': 0, 'zip_code': 1, 'name': 2},
+        'keys': ['code', 'zip_code'],  # Único por Clave + CP
+        'scope': 'zip_code',
+    },
+
+    # --- OTROS ---
+    'prod': {
+        'model': 'tms.sat.clave.prod',
+        'cols': {'code': 0, 'name': 1, 'material_peligroso': 3},  # Col D
+        'keys': ['code']
+    },
+    'uom': {
+        'model': 'tms.sat.clave.unidad',
+        'cols': {'code': 0, 'name': 1},
+        'keys': ['code']
+    },
+    'config_auto': {
+        'model': 'tms.sat.config.autotransporte',
+        'cols': {'code': 0, 'name': 1, 'numero_ejes_remolque': 4},
+        'keys': ['code']
+    },
+    'permiso': {
+        'model': 'tms.sat.tipo.permiso',
+        'cols': {'code': 0, 'name': 1, 'clave_transporte': 2},
+        'keys': ['code']
+    },
+    'packaging': {
+        'model': 'tms.sat.embalaje',
+        'cols': {'code': 0, 'name': 1},
+        'keys': ['code']
+    },
+    'material': {
+        'model': 'tms.sat.material.peligroso',
+        'cols': {'code': 0, 'name': 1, 'clase': 2},
+        'keys': ['code']
+    },
+    'figura': {
+        'model': 'tms.sat.figura.transporte',
+        'cols': {'code': 0, 'name': 1},
+        'keys': ['code']
+    },
+}
+# Catálogos que se pueden importar (tms.sat.import.job y sat.import.wizard)
+SAT_CATALOG_TYPES = [
+    ('prod', 'Productos y Servicios'),
+    ('uom', 'Unidades de Medida'),
+    ('zip', 'Códigos Postales (c_CP.xls)'),
+    ('colonia', 'Colonias'),
+    ('localidad', 'Localidades'),
+    ('municipio', 'Municipios'),
+    ('config_auto', 'Config. Autotransporte'),
+    ('permiso', 'Tipos Permiso SCT'),
+    ('packaging', 'Tipos Embalaje'),
+    ('material', 'Materiales Peligrosos'),
+    ('figura', 'Figuras Transporte'),
+]
+
+
+class TmsSatImportJob(models.Model):
+    """
+    Importación de Catálogos SAT en Segundo Plano (reanudable).
+
+    PROBLEMA: Importar c_CP (~150k filas) o colonias dentro del request HTTP
+    choca con limit_time_real del worker; al cortarse se pierde todo porque
+    era una sola transacción.
+
+    SOLUCIÓN:
+    - El wizard solo crea el trabajo (con el archivo como adjunto) y
+      dispara el cron (ir_cron_tms_sat_import)
+    - El cron lee el archivo en streaming y hace commit por lote; row_offset
+      guarda las filas ya confirmadas (checkpoint)
+    - Tras una caída o reinicio el siguiente cron reanuda desde row_offset:
+      el upsert es idempotente, un lote a medias se vuelve a aplicar igual
+    - Un advisory lock de sesión por trabajo evita que dos crons procesen
+      el mismo trabajo; se libera solo si el worker muere
+    - Avance (%) y filas/segundo visibles en el trabajo
+    """
+
+    _name = 'tms.sat.import.job'
+    _description = 'Importación de Catálogo SAT'
+    _order = 'id desc'
+
+    name = fields.Char(string='Importación', required=True, default=lambda self: _('Importación SAT'))
+    catalog_type = fields.Selection(SAT_CATALOG_TYPES, string='Tipo de Catálogo', required=True)
+    attachment_id = fields.Many2one('ir.attachment', string='Archivo', required=True, ondelete='restrict')
+    file_name = fields.Char(string='Nombre Archivo')
+    use_copy = fields.Boolean(string='Carga Rápida (COPY)', default=True)
+    sheet_index = fields.Integer(string='Número de Hoja (base 0)', default=0)
+    data_start_row = fields.Integer(string='Fila de Datos (Inicio)', default=2)
+    user_id = fields.Many2one('res.users', string='Solicitó', default=lambda self: self.env.user)
+
+    state = fields.Selection([
+        ('queued', 'En Cola'),
+        ('running', 'Importando'),
+        ('done', 'Terminada'),
+        ('failed', 'Fallida'),
+        ('cancel', 'Cancelada'),
+    ], string='Estado', default='queued', required=True, index=True)
+    error_message = fields.Text(string='Error', readonly=True)
+
+    # Checkpoint y avance
+    row_offset = fields.Integer(string='Filas Procesadas', readonly=True,
+                                help='Filas del archivo ya confirmadas (se reanuda desde aquí)')
+    rows_total = fields.Integer(string='Filas del Archivo', readonly=True)
+    progress = fields.Float(string='Avance (%)', compute='_compute_progress')
+    elapsed_seconds = fields.Float(string='Tiempo de Importación (s)', readonly=True)
+    rows_per_sec = fields.Float(string='Filas / Segundo', compute='_compute_progress', digits=(10, 1))
+    date_start = fields.Datetime(string='Inicio', readonly=True)
+    date_done = fields.Datetime(string='Fin', readonly=True)
+
+    # Resultado
+    created_count = fields.Integer(string='Nuevos', readonly=True)
+    updated_count = fields.Integer(string='Actualizados', readonly=True)
+    unchanged_count = fields.Integer(string='Sin Cambios', readonly=True)
+    obsolete_count = fields.Integer(string='Obsoletos', readonly=True,
+                                    help='En el sistema pero no en el archivo (no se borran). '
+                                         'Colonias: solo de los CPs que vienen en el archivo')
+
+    @api.depends('row_offset', 'rows_total', 'elapsed_seconds', 'state')
+    def _compute_progress(self):
+        for job in self:
+            if job.state == 'done':
+                job.progress = 100.0
+            else:
+                job.progress = min(100.0 * job.row_offset / job.rows_total, 99.9) if job.rows_total else 0.0
+            job.rows_per_sec = job.row_offset / job.elapsed_seconds if job.elapsed_seconds else 0.0
+
+    # =======================================================
+    # NORMALIZACIÓN
+    # =======================================================
+
+    def _clean_str(self, val):
+        """
+        Normalización agresiva: String, sin espacios, sin .0
+
+        CRÍTICO: Este método garantiza que 'AGU' == 'AGU ' == 'AGU.0'
+        y que '01' == '1' (ambos se convierten a string limpio).
+
+        :param val: valor crudo (int, float, str, None)
+        :return: string limpio sin decimales .0 ni espacios
+        """
+        if not val:
+            return ''
+
+        s = str(val).strip()
+
+        # Eliminar .0 al final (problema de Excel con formato numérico)
+        if s.endswith('.0'):
+            s = s[:-2]
+
+        return s
+
+    def _clean_hazardous(self, val):
+        """
+        Normaliza el campo Material Peligroso.
+
+        :param val: valor crudo del Excel
+        :return: string válido ('0', '1' o '0,1')
+        """
+        s = self._clean_str(val)
+
+        if s in ['0', '1', '0,1']:
+            return s
+
+        if s.lower() in ['si', 'sí', 'yes']:
+            return '1'
+
+        return '0'
+
+    # =======================================================
+    # LECTURA EN STREAMING
+    # =======================================================
+
+    @contextlib.contextmanager
+    def _open_upload(self):
+        """
+        Ruta en disco del archivo del trabajo, sin cargarlo decodificado en memoria.
+
+        - Si el adjunto vive en el filestore se lee directo de ahí
+        - Si no, el base64 se decodifica por bloques a un archivo temporal
+          que se borra al salir
+        """
+        attachment = self.attachment_id.sudo()
+        if attachment.store_fname:
+            yield attachment._full_path(attachment.store_fname)
+            return
+
+        data = attachment.datas
+        handle, path = tempfile.mkstemp(prefix='sat_import_')
+        try:
+            with os.fdopen(handle, 'wb') as temp:
+                for offset in range(0, len(data), SAT_IMPORT_DECODE_BLOCK):
+                    temp.write(base64.b64decode(data[offset:offset + SAT_IMPORT_DECODE_BLOCK]))
+            del data
+            yield path
+        finally:
+            os.unlink(path)
+
+    def _sniff_text(self, path):
+        """
+        Detecta codificación, separador y número de líneas de un CSV / TXT.
+
+        Una sola pasada en binario por bloques: cuenta las líneas y valida
+        UTF-8 con un decodificador incremental; si algún bloque no es UTF-8
+        válido el archivo se lee como latin-1 (los CSV del SAT vienen en
+        cualquiera de las dos). El separador se deduce con csv.Sniffer sobre
+        las primeras líneas.
+
+        :return: (encoding, dialecto csv, número de líneas)
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        encoding = 'utf-8-sig'
+        lines = 0
+        last_block = b''
+        with open(path, 'rb') as handle:
+            sample = handle.read(SAT_IMPORT_SNIFF_BYTES)
+            block = sample
+            while block:
+                last_block = block
+                lines += block.count(b'\n')
+                if encoding == 'utf-8-sig':
+                    try:
+                        decoder.decode(block)
+                    except UnicodeDecodeError:
+                        encoding = 'latin-1'
+                block = handle.read(SAT_IMPORT_DECODE_BLOCK)
+        if encoding == 'utf-8-sig':
+            try:
+                decoder.decode(b'', final=True)  # Secuencia UTF-8 cortada al final
+            except UnicodeDecodeError:
+                encoding = 'latin-1'
+        if last_block and not last_block.endswith(b'\n'):
+            lines += 1  # Última línea del archivo sin salto
+
+        # Solo líneas completas para el Sniffer (la última del bloque puede venir cortada)
+        text = sample.decode(encoding, errors='ignore')
+        if len(sample) == SAT_IMPORT_SNIFF_BYTES and '\n' in text:
+            text = text[:text.rindex('\n')]
+        try:
+            dialect = csv.Sniffer().sniff(text, delimiters=SAT_IMPORT_DELIMITERS)
+        except csv.Error:
+            dialect = csv.excel  # Una sola columna o muestra ambigua: separador por coma
+        return encoding, dialect, lines
+
+    def _read_rows(self, path, stack):
+        """
+        Iterador perezoso de las filas de datos (desde data_start_row).
+
+        El formato se detecta por el contenido (magic bytes), no por la
+        extensión: .xlsx (ZIP) con openpyxl, .xls (OLE2) con xlrd y cualquier
+        otro archivo como CSV / TXT con el lector csv (en C, mucho más rápido
+        y ligero que openpyxl en catálogos de 100k+ filas).
+
+        Abre el archivo de inmediato (los errores de formato salen aquí, no
+        a mitad de la importación) y registra su cierre en `stack`.
+
+        :param stack: contextlib.ExitStack que cierra el libro / archivo
+        :return: (iterador de tuplas / listas de celdas, filas de datos o 0 si no se conoce)
+        """
+        skip = max(self.data_start_row - 1, 0)
+        with open(path, 'rb') as handle:
+            magic = handle.read(len(SAT_IMPORT_XLS_MAGIC))
+
+        if magic.startswith(SAT_IMPORT_XLSX_MAGIC):
+            # Excel Moderno (.xlsx) en modo read_only (lee la hoja por filas)
+            if not openpyxl:
+                raise UserError(_("Para importar archivos .xlsx se requiere la librería openpyxl."))
+            try:
+                wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
+                stack.callback(wb.close)
+                sheet = wb.worksheets[self.sheet_index]
+            except Exception as e:
+                raise UserError(_("No se pudo leer el archivo .xlsx. Error: %s") % e)
+            total = max((sheet.max_row or 0) - skip, 0)
+            return sheet.iter_rows(min_row=self.data_start_row, values_only=True), total
+
+        if magic == SAT_IMPORT_XLS_MAGIC:
+            # Excel Antiguo (.xls); on_demand carga solo la hoja pedida
+            if not xlrd:
+                raise UserError(_("Para importar archivos .xls se requiere la librería xlrd."))
+            try:
+                wb = xlrd.open_workbook(path, on_demand=True)
+                stack.callback(wb.release_resources)
+                sheet = wb.sheet_by_index(self.sheet_index)
+            except Exception as e:
+                raise UserError(_("No se pudo leer el archivo .xls. Error: %s") % e)
+            rows = (sheet.row_values(row_idx) for row_idx in range(skip, sheet.nrows))
+            return rows, max(sheet.nrows - skip, 0)
+
+        # CSV / TXT: codificación y separador detectados
+        encoding, dialect, lines = self._sniff_text(path)
+        _logger.info("Importación SAT %s: texto %s, separador %r", self.id, encoding, dialect.delimiter)
+        handle = stack.enter_context(open(path, newline='', encoding=encoding))
+        return itertools.islice(csv.reader(handle, dialect), skip, None), max(lines - skip, 0)
+
+    def _iter_vals(self, rows, cfg, start):
+        """
+        Normaliza las filas a vals del modelo (generador, fila por fila).
+
+        Descarta las filas sin llave primaria y las que no se pueden leer.
+
+        :param start: número de fila en el archivo de la primera fila (para los mensajes de error)
+        """
+        cols_map = cfg['cols']
+        primary_key = cfg['keys'][0]  # Ej. 'code'
+        for i, row in enumerate(rows, start):
+            vals = {}
+            try:
+                # Extraer y limpiar datos
+                for field, col_idx in cols_map.items():
+                    if col_idx < len(row):
+                        raw = row[col_idx]
+
+                        if field == 'material_peligroso':
+                            vals[field] = self._clean_hazardous(raw)
+                        elif field == 'numero_ejes_remolque':
+                            # Campo numérico
+                            try:
+                                vals[field] = int(float(str(raw).replace(',', ''))) if raw else 0
+                            except (ValueError, TypeError):
+                                vals[field] = 0
+                        else:
+                            # APLICAR LIMPIEZA A TODOS LOS CAMPOS
+                            vals[field] = self._clean_str(raw)
+                    else:
+                        # Campo opcional, usar valor por defecto
+                        if field == 'material_peligroso':
+                            vals[field] = '0'
+                        elif field == 'numero_ejes_remolque':
+                            vals[field] = 0
+                        else:
+                            vals[field] = ''
+            except Exception as e:
+                _logger.warning(f"Error en fila {i}: {e}")
+                continue
+
+            # Validar que la llave primaria tenga dato
+            if vals.get(primary_key):
+                yield vals
+
+    # =======================================================
+    # ESCRITURA POR LOTES
+    # =======================================================
+
+    def _ensure_zip_codes(self, vals_list):
+        """
+        Auto-crea los Códigos Postales faltantes de un lote de Colonias.
+
+        Se crean solo con el código, sin datos geográficos detallados.
+        """
+        zip_codes_from_file = {vals['zip_code'] for vals in vals_list if vals.get('zip_code')}
+        if not zip_codes_from_file:
+            return
+        zip_model = self.env['tms.sat.codigo.postal']
+        existing_zip_codes = set(zip_model.search([('code', 'in', list(zip_codes_from_file))]).mapped('code'))
+        missing_zips = zip_codes_from_file - existing_zip_codes
+        if not missing_zips:
+            return
+        try:
+            with self.env.cr.savepoint():
+                zip_model.create([{
+                    'code': zip_code,
+                    'estado': '',
+                    'municipio': '',
+                    'localidad': '',
+                } for zip_code in missing_zips])
+            _logger.info(f"Auto-creados {len(missing_zips)} códigos postales faltantes.")
+        except Exception as e:
+            # No fallar la importación completa si hay error en auto-creación
+            _logger.warning(f"Error al auto-crear códigos postales: {e}")
+
+    def _import_chunk(self, model, cfg, vals_list):
+        """
+        Sincroniza un lote: dedupe interno, crea los nuevos y actualiza solo
+        los que cambiaron.
+
+        Los duplicados entre lotes se detectan contra la BD, donde ya están
+        los lotes anteriores.
+
+        :return: dict {created, updated, unchanged}
+        """
+        keys_def = cfg['keys']
+
+        # ELIMINAR DUPLICADOS DENTRO DEL LOTE (firma = llaves, ej. ('20126', 'AGU', '001'))
+        unique_vals = {}
+        for vals in vals_list:
+            unique_vals.setdefault(tuple(vals.get(k) for k in keys_def), vals)
+        self._record_seen_keys(cfg, unique_vals)
+
+        if self.use_copy:
+            return self._copy_upsert(model, cfg, list(unique_vals.values()))
+        return self._orm_upsert(model, cfg, unique_vals)
+
+    def _orm_upsert(self, model, cfg, unique_vals):
+        """
+        Sincroniza un lote con el ORM (create / write por registro).
+
+        :param unique_vals: dict {llave normalizada: vals} sin duplicados
+        :return: dict {created, updated, unchanged}
+        """
+        keys_def = cfg['keys']
+        primary_key = keys_def[0]
+        if self.catalog_type == 'colonia':
+            self._ensure_zip_codes(unique_vals.values())
+
+        # Indexar existentes por LLAVE COMPUESTA NORMALIZADA
+        # CRÍTICO: Normalizar también los datos de BD ('AGU ' vs 'AGU')
+        candidates = model.search_read(
+            [(primary_key, 'in', list({key[0] for key in unique_vals}))], list(cfg['cols']))
+        existing_map = {tuple(self._clean_str(rec[k]) for k in keys_def): rec for rec in candidates}
+
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        to_create = []
+        for key, vals in unique_vals.items():
+            rec = existing_map.get(key)
+            if not rec:
+                to_create.append(vals)
+                continue
+            changes = {
+                field: value for field, value in vals.items()
+                if value != (rec[field] if isinstance(value, int) else self._clean_str(rec[field]))
+            }
+            if changes:
+                model.browse(rec['id']).write(changes)
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+
+        if to_create:
+            try:
+                # Intento masivo (Rápido)
+                with self.env.cr.savepoint():
+                    model.create(to_create)
+                counts['created'] += len(to_create)
+            except IntegrityError:
+                # Fallback: insertar uno por uno; el savepoint aísla cada error
+                for val in to_create:
+                    try:
+                        with self.env.cr.savepoint():
+                            model.create(val)
+                        counts['created'] += 1
+                    except IntegrityError:
+                        counts['unchanged'] += 1  # Duplicado que la BD rechazó
+            except Exception as e:
+                raise UserError(f"Error al crear registros: {e}")
+        return counts
+
+    def _copy_upsert(self, model, cfg, vals_list):
+        """
+        Carga rápida de un lote: COPY a una tabla temporal + INSERT ... ON CONFLICT.
+
+        Los catálogos SAT son globales (sin company_id, sin computes ni
+        defaults que falten en el archivo), así que el INSERT directo es
+        equivalente al create() del ORM. La llave del conflicto es la llave
+        única del catálogo (CATALOG_MAP['keys'] = su _sql_constraints).
+
+        En conflicto solo se actualizan las filas cuyas columnas no llave
+        son distintas (IS DISTINCT FROM): las filas sin cambios no se
+        reescriben.
+
+        :return: dict {created, updated, unchanged}
+        """
+        table = model._table
+        columns = list(cfg['cols'])
+        values = [column for column in columns if column not in cfg['keys']]
+        stage = SQL.identifier('sat_import_stage')
+        cr = self.env.cr
+
+        # Tabla temporal con los tipos de las columnas del catálogo (se borra al terminar la transacción)
+        cr.execute(SQL(
+            "CREATE TEMP TABLE IF NOT EXISTS %s ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA",
+            stage, SQL(', ').join(map(SQL.identifier, columns)), SQL.identifier(table),
+        ))
+        cr.execute(SQL("TRUNCATE %s", stage))
+
+        # COPY en formato CSV: todo entrecomillado ('' = cadena vacía, no NULL)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        writer.writerows([vals[column] for column in columns] for vals in vals_list)
+        buffer.seek(0)
+        cr.copy_expert(
+            SQL("COPY %s (%s) FROM STDIN WITH (FORMAT csv)",
+                stage, SQL(', ').join(map(SQL.identifier, columns))).code,
+            buffer,
+        )
+
+        # Colonias: auto-crear los Códigos Postales faltantes (solo con el código)
+        if self.catalog_type == 'colonia':
+            cr.execute(SQL(
+                """
+                INSERT INTO tms_sat_codigo_postal
+                       (code, estado, municipio, localidad, create_uid, create_date, write_uid, write_date)
+                SELECT DISTINCT s.zip_code, '', '', '', %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+                  FROM %s s
+                 WHERE s.zip_code <> ''
+                   AND NOT EXISTS (SELECT 1 FROM tms_sat_codigo_postal z WHERE z.code = s.zip_code)
+                ON CONFLICT DO NOTHING
+                """,
+                self.env.uid, self.env.uid, stage,
+            ))
+            if cr.rowcount:
+                _logger.info(f"Auto-creados {cr.rowcount} códigos postales faltantes.")
+
+        if values:
+            on_conflict = SQL(
+                """
+                DO UPDATE SET %s, write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+                 WHERE (%s) IS DISTINCT FROM (%s)
+                """,
+                SQL(', ').join(SQL('%s = EXCLUDED.%s', SQL.identifier(c), SQL.identifier(c)) for c in values),
+                SQL(', ').join(SQL('t.%s', SQL.identifier(c)) for c in values),
+                SQL(', ').join(SQL('EXCLUDED.%s', SQL.identifier(c)) for c in values),
+            )
+        else:
+            on_conflict = SQL("DO NOTHING")
+        # xmax = 0: fila insertada; si no, fila existente actualizada
+        cr.execute(SQL(
+            """
+            INSERT INTO %s AS t (%s, create_uid, create_date, write_uid, write_date)
+            SELECT %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+              FROM %s
+            ON CONFLICT (%s) %s
+            RETURNING (t.xmax = 0)
+            """,
+            SQL.identifier(table), SQL(', ').join(map(SQL.identifier, columns)),
+            SQL(', ').join(map(SQL.identifier, columns)), self.env.uid, self.env.uid,
+            stage, SQL(', ').join(map(SQL.identifier, cfg['keys'])), on_conflict,
+        ))
+        inserted = [row[0] for row in cr.fetchall()]
+        created = sum(inserted)
+        return {
+            'created': created,
+            'updated': len(inserted) - created,
+            'unchanged': len(vals_list) - len(inserted),
+        }
+
+    # =======================================================
+    # LLAVES VISTAS (detección de obsoletos)
+    # =======================================================
+    # Se guardan en tms.sat.import.job.key (no en una tabla temporal) para
+    # sobrevivir a los commits por lote y a la reanudación en otro worker.
+
+    def _key_expression(self, cfg, alias):
+        """Llave compuesta de una fila como un solo texto (columnas separadas por \\x1f)."""
+        return SQL("concat_ws(%s, %s)", SAT_IMPORT_KEY_SEPARATOR, SQL(', ').join(
+            SQL("COALESCE(%s.%s::text, '')", SQL.identifier(alias), SQL.identifier(k)) for k in cfg['keys']))
+
+    def _record_seen_keys(self, cfg, unique_vals):
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tms_sat_import_job_key (job_id, key)
+            SELECT %s, unnest(%s::text[])
+            """,
+            self.id, [SAT_IMPORT_KEY_SEPARATOR.join(str(value or '') for value in key) for key in unique_vals],
+        ))
+
+    def _count_obsolete(self, model, cfg):
+        """
+        Registros del catálogo cuya llave no viene en el archivo (se reportan, no se borran).
+
+        Catálogos partidos en varios archivos (CATALOG_MAP['scope']): solo se
+        cuentan los registros cuyo valor de esa columna de la llave aparece en
+        el archivo (ej. colonias de los CPs importados); el resto del catálogo
+        pertenece a otro archivo.
+
+        Borra las llaves guardadas del trabajo.
+        """
+        scope = SQL()
+        if cfg.get('scope'):
+            scope = SQL(
+                """
+                AND COALESCE(t.%s::text, '') IN (SELECT split_part(k.key, %s, %s) FROM tms_sat_import_job_key k
+                                                  WHERE k.job_id = %s)
+                """,
+                SQL.identifier(cfg['scope']), SAT_IMPORT_KEY_SEPARATOR, cfg['keys'].index(cfg['scope']) + 1, self.id,
+            )
+        self.env.cr.execute(SQL(
+            """
+            SELECT count(*) FROM %s t
+             WHERE NOT EXISTS (SELECT 1 FROM tms_sat_import_job_key k
+                                WHERE k.job_id = %s AND k.key = %s)
+             %s
+            """,
+            SQL.identifier(model._table), self.id, self._key_expression(cfg, 't'), scope,
+        ))
+        obsolete = self.env.cr.fetchone()[0]
+        self.env.cr.execute(SQL("DELETE FROM tms_sat_import_job_key WHERE job_id = %s", self.id))
+        return obsolete
+
+    # =======================================================
+    # PROCESAMIENTO (cron)
+    # =======================================================
+
+    @api.model
+    def _cron_process_jobs(self):
+        """
+        Procesa las importaciones pendientes dentro de un presupuesto de tiempo.
+
+        Toma también las 'running': un trabajo de un worker que murió sigue
+        en 'running' y se reanuda desde su checkpoint. Si se acaba el
+        presupuesto, el cron se vuelve a disparar para continuar.
+        """
+        deadline = time.monotonic() + self._get_cron_budget()
+        for job in self.search([('state', 'in', ('queued', 'running'))], order='id'):
+            if time.monotonic() >= deadline:
+                break
+            if not job._try_lock():
+                continue  # Otro worker lo está procesando
+            try:
+                job._run(deadline)
+            finally:
+                job._unlock()
+        if time.monotonic() >= deadline and self.search_count([('state', 'in', ('queued', 'running'))]):
+            self.env.ref('tms.ir_cron_tms_sat_import')._trigger()
+
+    @api.model
+    def _get_cron_budget(self):
+        """
+        Presupuesto (segundos) del cron: SAT_IMPORT_CRON_BUDGET recortado al
+        límite real del worker de cron (limit_time_real_cron, o limit_time_real
+        si no está definido) menos SAT_IMPORT_CRON_MARGIN, para que el worker
+        no muera a mitad de un lote.
+        """
+        limit = config['limit_time_real_cron']
+        if limit is None or limit < 0:
+            limit = config['limit_time_real']
+        if not limit or limit <= 0:
+            return SAT_IMPORT_CRON_BUDGET  # Sin límite real configurado
+        return max(min(SAT_IMPORT_CRON_BUDGET, limit - SAT_IMPORT_CRON_MARGIN), 1)
+
+    def _try_lock(self):
+        """Advisory lock de sesión (sobrevive a los commits; se libera si el worker muere)."""
+        self.env.cr.execute(SQL("SELECT pg_try_advisory_lock(%s, %s)", SAT_IMPORT_LOCK_NAMESPACE, self.id))
+        return self.env.cr.fetchone()[0]
+
+    def _unlock(self):
+        self.env.cr.execute(SQL("SELECT pg_advisory_unlock(%s, %s)", SAT_IMPORT_LOCK_NAMESPACE, self.id))
+
+    def _run(self, deadline):
+        """
+        Importa por lotes desde row_offset hasta terminar o agotar el presupuesto.
+
+        Cada lote (upsert + checkpoint + contadores) se confirma con un commit.
+        Un error revierte solo el lote en curso y marca el trabajo como fallido;
+        action_retry lo reanuda desde el último checkpoint.
+        """
+        self.ensure_one()
+        self.invalidate_recordset()
+        if self.state not in ('queued', 'running'):
+            return
+        cfg = CATALOG_MAP[self.catalog_type]
+        model = self.env[cfg['model']]
+        self.write({'state': 'running', 'date_start': self.date_start or fields.Datetime.now()})
+        self.env.cr.commit()
+
+        try:
+            with self._open_upload() as path, contextlib.ExitStack() as stack:
+                rows, total = self._read_rows(path, stack)
+                if total != self.rows_total:
+                    self.rows_total = total
+                # Reanudar: saltar las filas ya confirmadas
+                rows = itertools.islice(rows, self.row_offset, None)
+                for raw_chunk in chunked(rows, SAT_IMPORT_CHUNK_SIZE):
+                    start = time.monotonic()
+                    counts = self._import_chunk(
+                        model, cfg, list(self._iter_vals(raw_chunk, cfg, self.row_offset + self.data_start_row)))
+                    self.write({
+                        'row_offset': self.row_offset + len(raw_chunk),
+                        'elapsed_seconds': self.elapsed_seconds + time.monotonic() - start,
+                        'created_count': self.created_count + counts['created'],
+                        'updated_count': self.updated_count + counts['updated'],
+                        'unchanged_count': self.unchanged_count + counts['unchanged'],
+                    })
+                    self.env.cr.commit()
+                    # Liberar los registros del lote de la caché del ORM
+                    self.env.invalidate_all()
+                    _logger.info("Importación SAT %s (%s): %s/%s filas",
+                                 self.catalog_type, self.id, self.row_offset, self.rows_total)
+                    if time.monotonic() >= deadline:
+                        return
+
+            if not (self.created_count + self.updated_count + self.unchanged_count):
+                raise UserError(_('No se encontraron registros válidos para importar.'))
+            self.write({
+                'state': 'done',
+                'rows_total': self.row_offset,
+                'obsolete_count': self._count_obsolete(model, cfg),
+                'date_done': fields.Datetime.now(),
+            })
+            self.env.cr.commit()
+        except Exception as e:
+            _logger.exception("Importación SAT %s: error en la fila %s", self.id, self.row_offset)
+            self.env.cr.rollback()
+            self.write({'state': 'failed', 'error_message': str(e)})
+            self.env.cr.commit()
+
+    # =======================================================
+    # ACCIONES
+    # =======================================================
+
+    def action_retry(self):
+        """Reanuda los trabajos fallidos desde su último checkpoint."""
+        self.filtered(lambda job: job.state == 'failed').write({'state': 'queued', 'error_message': False})
+        self.env.ref('tms.ir_cron_tms_sat_import')._trigger()
+
+    def action_cancel(self):
+        self.filtered(lambda job: job.state in ('queued', 'running', 'failed')).write({'state': 'cancel'})
+        self.env.cr.execute(SQL("DELETE FROM tms_sat_import_job_key WHERE job_id = ANY(%s)", self.ids))
+
+
+class TmsSatImportJobKey(models.Model):
+    """Llaves del archivo ya importadas por un trabajo (para contar obsoletos al final)."""
+
+    _name = 'tms.sat.import.job.key'
+    _description = 'Llave Importada de Catálogo SAT'
+    _log_access = False
+
+    job_id = fields.Many2one('tms.sat.import.job', required=True, ondelete='cascade')
+    key = fields.Char(required=True)
+
+    def init(self):
+        create_index(self.env.cr, 'tms_sat_import_job_key_job_key_idx', self._table, ['job_id', 'key'])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+
+from odoo import models, fields, api
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+# Llaves únicas (por proceso) para las transacciones con cambios sin confirmar
+_uncommitted_keys = itertools.count(1)
+
+
+class TmsCacheGeneration(models.Model):
+    """
+    Generación de las cachés en memoria del TMS (invalidación acotada).
+
+    PROBLEMA: registry.clear_cache() vacía TODA la caché ormcache de todos
+    los workers (permisos, reglas, índices de tarifas y diesel, rutas...)
+    por cada ruta guardada o fallo registrado; en una caída del proveedor,
+    cuando más fallos llegan, cada uno provoca una estampida en todos los
+    workers.
+
+    SOLUCIÓN:
+    - Un contador por caché y empresa ('tms.destination', 'tms.route.failure'...)
+    - La generación forma parte de la llave del ormcache: incrementarla deja
+      sin uso solo las entradas de esa caché y esa empresa (el LRU las
+      desaloja con el tiempo); el resto de la caché no se toca
+    - Se lee UNA vez por transacción y empresa (todas sus cachés en una
+      consulta); las búsquedas siguientes de la transacción no van a la BD
+    - El incremento se hace DESPUÉS del commit del escritor, en una
+      transacción propia de una sola sentencia: no retiene la fila mientras
+      la transacción que escribe sigue abierta, y ningún worker ve la nueva
+      generación antes que los datos nuevos
+    - Mientras una transacción tenga cambios sin confirmar en una caché, sus
+      lecturas usan una llave única: lo calculado con esos datos nunca se
+      comparte con otras transacciones del worker (ni sobrevive a un rollback)
+    """
+
+    _name = 'tms.cache.generation'
+    _description = 'Generación de Caché TMS'
+    _log_access = False
+
+    name = fields.Char(string='Caché', required=True)
+    company_id = fields.Many2one('res.company', string='Compañía', required=True, ondelete='cascade')
+    generation = fields.Integer(string='Generación', default=0)
+
+    _sql_constraints = [
+        ('name_company_uniq', 'unique(name, company_id)', 'Solo puede existir una generación por caché y empresa.')
+    ]
+
+    def _transaction_state(self):
+        """
+        Estado de la transacción en curso: generaciones leídas y cachés modificadas.
+
+        Vive en cr.postcommit.data, que Odoo vacía en cada commit y rollback.
+        """
+        return self.env.cr.postcommit.data.setdefault(self._name, {'read': {}, 'dirty': {}})
+
+    @api.model
+    def _get(self, name, company_id):
+        """
+        Generación de una caché para la llave del ormcache.
+
+        :return: generación confirmada (0 si nunca se ha invalidado) o una llave
+                 única si esta transacción modificó la caché y aún no hace commit
+        """
+        state = self._transaction_state()
+        if (name, company_id) in state['dirty']:
+            return state['dirty'][(name, company_id)]
+        generations = state['read'].get(company_id)
+        if generations is None:
+            self.env.cr.execute(SQL(
+                "SELECT name, generation FROM tms_cache_generation WHERE company_id = %s",
+                company_id,
+            ))
+            generations = state['read'][company_id] = dict(self.env.cr.fetchall())
+        return generations.get(name, 0)
+
+    @api.model
+    def _bump(self, name, company_ids):
+        """Invalida una caché para estas empresas al confirmar la transacción en curso."""
+        company_ids = set(filter(None, company_ids))
+        if not company_ids:
+            return
+        state = self._transaction_state()
+        if not state['dirty']:
+            registry, dirty = self.env.registry, state['dirty']
+            self.env.cr.postcommit.add(lambda: self._bump_committed(registry, sorted(dirty)))
+        for company_id in company_ids:
+            state['dirty'].setdefault((name, company_id), ('uncommitted', next(_uncommitted_keys)))
+
+    @api.model
+    def _bump_committed(self, registry, pairs):
+        """
+        Incrementa las generaciones tras el commit (un solo upsert, en orden
+        para evitar deadlocks, con un cursor propio).
+
+        :param pairs: lista ordenada de (caché, company_id)
+        """
+        try:
+            with registry.cursor() as cr:
+                cr.execute(SQL(
+                    """
+                    INSERT INTO tms_cache_generation AS g (name, company_id, generation)
+                    SELECT unnest(%s::varchar[]), unnest(%s::int[]), 1
+                    ON CONFLICT (name, company_id) DO UPDATE SET generation = g.generation + 1
+                    """,
+                    [cache for cache, company_id in pairs], [company_id for cache, company_id in pairs],
+                ))
+        except Exception:
+            _logger.exception("TMS: no se pudo invalidar la caché en memoria %s", pairs)
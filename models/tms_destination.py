@@ -1,8 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from psycopg2 import IntegrityError
+
 # Importamos las clases necesarias de Odoo
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
+from odoo.tools import SQL
+
+from . import tms_metrics
+from .tms_route_provider import RouteProviderError
+
+_logger = logging.getLogger(__name__)
+
+# ============================================================
+# PRECALENTADO DE CACHÉ (prefetch de carriles frecuentes)
+# ============================================================
+
+# Carriles por ejecución del cron (parámetro 'tms.route_prefetch_limit')
+ROUTE_PREFETCH_LIMIT = 200
+
+# Llamadas simultáneas al proveedor (parámetro 'tms.route_prefetch_concurrency')
+ROUTE_PREFETCH_CONCURRENCY = 4
+
+# Ventana de historial de viajes para elegir carriles frecuentes
+ROUTE_PREFETCH_HISTORY_DAYS = 365
+
+# ============================================================
+# VIGENCIA DE LA CACHÉ (TTL + stale-while-revalidate)
+# ============================================================
+
+# Rutas vencidas a recalcular por ejecución del cron (parámetro 'tms.route_refresh_budget')
+ROUTE_REFRESH_BUDGET = 50
+
+# Campos que forman parte de la entrada en la caché en memoria (_get_cached_route):
+# escribir cualquiera de ellos invalida la caché de rutas de la empresa en todos los workers
+ROUTE_CACHE_FIELDS = {
+    'company_id', 'origin_zip', 'dest_zip', 'vehicle_type_id', 'active',
+    'distance_km', 'duration_hours', 'cost_tolls', 'last_update',
+}
 
 
 class TmsDestination(models.Model):
@@ -99,7 +138,410 @@ class TmsDestination(models.Model):
 
     last_update = fields.Date(string="Última Actualización", default=fields.Date.context_today)
 
+    # Integer: versión de la ruta (se incrementa en cada recálculo del proveedor)
+    version = fields.Integer(string='Versión', default=1, readonly=True, copy=False)
+
+    # Boolean: la ruta superó la vigencia de la empresa (ver res.company)
+    is_stale = fields.Boolean(string='Vencida', compute='_compute_is_stale')
+
+    @api.depends('last_update', 'company_id.tms_route_cache_ttl_days')
+    def _compute_is_stale(self):
+        today = fields.Date.context_today(self)
+        for record in self:
+            record.is_stale = record._is_expired(today)
+
+    def _is_expired(self, today):
+        """True si la ruta superó la vigencia (TTL) de su empresa."""
+        self.ensure_one()
+        ttl_days = self.company_id.tms_route_cache_ttl_days
+        return bool(ttl_days and self.last_update and self.last_update + timedelta(days=ttl_days) < today)
+
+    # ============================================================
+    # PERFIL HISTÓRICO DE VELOCIDAD (Motor de ETA)
+    # ============================================================
+    # Se alimenta al cerrar cada viaje del carril (distancia GPS / horas)
+
+    avg_speed_kmh = fields.Float(
+        string='Velocidad Promedio (Km/h)',
+        digits=(10, 2),
+        readonly=True,
+        help='Velocidad promedio real de los viajes cerrados en este carril'
+    )
+    speed_samples = fields.Integer(
+        string='Viajes Medidos',
+        readonly=True,
+    )
+
     _sql_constraints = [
         ('unique_route', 'unique(company_id, origin_zip, dest_zip, vehicle_type_id)',
          'Ya existe una ruta guardada para este origen, destino y tipo de vehículo.')
     ]
+
+    @api.model
+    def _get_lane_speeds(self, lanes):
+        """
+        Velocidad histórica de varios carriles en una sola consulta.
+
+        :param lanes: iterable de (company_id, origin_zip, dest_zip, vehicle_type_id)
+        :return: dict {lane: avg_speed_kmh}
+        """
+        lanes = [lane for lane in lanes if lane[1] and lane[2]]
+        if not lanes:
+            return {}
+        values = SQL(', ').join(
+            SQL('(%s, %s, %s, %s)', company_id, origin_zip, dest_zip, vehicle_type_id or 0)
+            for company_id, origin_zip, dest_zip, vehicle_type_id in lanes
+        )
+        self.env.cr.execute(SQL(
+            """
+            SELECT d.company_id, d.origin_zip, d.dest_zip, COALESCE(d.vehicle_type_id, 0), d.avg_speed_kmh
+              FROM tms_destination d
+              JOIN (VALUES %s) AS l(company_id, origin_zip, dest_zip, vehicle_type_id)
+                ON d.company_id = l.company_id
+               AND d.origin_zip = l.origin_zip
+               AND d.dest_zip = l.dest_zip
+               AND COALESCE(d.vehicle_type_id, 0) = l.vehicle_type_id
+             WHERE d.avg_speed_kmh > 0
+            """,
+            values,
+        ))
+        return {
+            (company_id, origin_zip, dest_zip, vehicle_type_id or False): speed
+            for company_id, origin_zip, dest_zip, vehicle_type_id, speed in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _record_trip_speed(self, company_id, origin_zip, dest_zip, vehicle_type_id, speed_kmh):
+        """
+        Promedio acumulado de velocidad del carril (si la ruta existe en caché).
+
+        UN UPDATE por SQL, como el resto de la ingesta de telemetría: lo
+        dispara la llegada a destino que reporta el chofer, que no tiene
+        acceso a tms.destination. El promedio se calcula en la misma
+        sentencia (sin carreras entre lectura y escritura).
+        """
+        self.env.cr.execute(SQL(
+            """
+            UPDATE tms_destination
+               SET avg_speed_kmh = COALESCE(avg_speed_kmh, 0)
+                       + (%s - COALESCE(avg_speed_kmh, 0)) / (COALESCE(speed_samples, 0) + 1),
+                   speed_samples = COALESCE(speed_samples, 0) + 1
+             WHERE id = (SELECT id FROM tms_destination
+                          WHERE company_id = %s
+                            AND origin_zip = %s
+                            AND dest_zip = %s
+                            AND COALESCE(vehicle_type_id, 0) = %s
+                            AND active
+                          ORDER BY id
+                          LIMIT 1)
+            """,
+            speed_kmh, company_id, origin_zip, dest_zip, vehicle_type_id or 0,
+        ))
+        self.invalidate_model(['avg_speed_kmh', 'speed_samples'])
+
+    # ============================================================
+    # PRECALENTADO DE CACHÉ (cron)
+    # ============================================================
+
+    @api.model
+    def _get_prefetch_lanes(self, limit):
+        """
+        Top-N carriles (empresa, CP origen, CP destino, tipo de vehículo) de
+        los viajes recientes, SIN ruta en caché, cálculo pendiente en la cola
+        ni fallo vigente en la caché negativa.
+        Los CPs salen de las direcciones de los contactos de origen/destino.
+
+        :return: lista de (company_id, origin_zip, dest_zip, vehicle_type_id)
+        """
+        self.env.cr.execute(SQL(
+            """
+            SELECT w.company_id, po.zip, pd.zip, COALESCE(v.tms_vehicle_type_id, 0) AS vehicle_type_id
+              FROM tms_waybill w
+              JOIN res_partner po ON po.id = w.partner_origin_id
+              JOIN res_partner pd ON pd.id = w.partner_dest_id
+              LEFT JOIN fleet_vehicle v ON v.id = w.vehicle_id
+             WHERE w.create_date >= NOW() - make_interval(days => %s)
+               AND COALESCE(po.zip, '') != ''
+               AND COALESCE(pd.zip, '') != ''
+               AND po.zip != pd.zip
+               AND NOT EXISTS (
+                   SELECT 1 FROM tms_destination d
+                    WHERE d.company_id = w.company_id
+                      AND d.origin_zip = po.zip
+                      AND d.dest_zip = pd.zip
+                      AND COALESCE(d.vehicle_type_id, 0) = COALESCE(v.tms_vehicle_type_id, 0))
+               AND NOT EXISTS (
+                   SELECT 1 FROM tms_route_job j
+                    WHERE j.company_id = w.company_id
+                      AND j.origin_zip = po.zip
+                      AND j.dest_zip = pd.zip
+                      AND COALESCE(j.vehicle_type_id, 0) = COALESCE(v.tms_vehicle_type_id, 0)
+                      AND j.state IN ('queued', 'running'))
+               AND NOT EXISTS (
+                   SELECT 1 FROM tms_route_failure f
+                    WHERE f.company_id = w.company_id
+                      AND f.origin_zip = po.zip
+                      AND f.dest_zip = pd.zip
+                      AND COALESCE(f.vehicle_type_id, 0) = COALESCE(v.tms_vehicle_type_id, 0)
+                      AND f.expires_at > NOW() AT TIME ZONE 'UTC')
+             GROUP BY w.company_id, po.zip, pd.zip, COALESCE(v.tms_vehicle_type_id, 0)
+             ORDER BY COUNT(*) DESC
+             LIMIT %s
+            """,
+            ROUTE_PREFETCH_HISTORY_DAYS, limit,
+        ))
+        return [
+            (company_id, origin_zip, dest_zip, vehicle_type_id or False)
+            for company_id, origin_zip, dest_zip, vehicle_type_id in self.env.cr.fetchall()
+        ]
+
+    @api.model
+    def _cron_prefetch_routes(self):
+        """
+        Precalienta la caché con los carriles más frecuentes sin ruta guardada.
+
+        1. UNA consulta: top-N carriles de viajes recientes sin caché
+        2. Llamadas al proveedor en hilos, con concurrencia limitada
+           (los hilos no tocan el cursor: usan la función pura del proveedor)
+        3. UN create masivo con todos los resultados
+
+        Así la cotización del lunes en la mañana encuentra la caché caliente.
+        """
+        Provider = self.env['tms.route.provider']
+        fetch = Provider._get_remote_fetcher(Provider._get_provider())
+        if not fetch:
+            # Proveedor sin red: la estimación ya es instantánea, no hay nada que precalentar
+            return 0
+
+        ICPSudo = self.env['ir.config_parameter'].sudo()
+        limit = int(ICPSudo.get_param('tms.route_prefetch_limit', ROUTE_PREFETCH_LIMIT))
+        concurrency = max(1, int(ICPSudo.get_param('tms.route_prefetch_concurrency', ROUTE_PREFETCH_CONCURRENCY)))
+        lanes = self._get_prefetch_lanes(limit)
+        if not lanes:
+            return 0
+
+        def fetch_lane(lane):
+            try:
+                return lane, fetch(lane[1], lane[2])
+            except RouteProviderError as e:
+                return lane, e
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch_lane, lanes))
+
+        today = fields.Date.today()
+        vals_list = []
+        for (company_id, origin_zip, dest_zip, vehicle_type_id), result in results:
+            if isinstance(result, RouteProviderError):
+                _logger.info("TMS: prefetch de ruta %s → %s sin resultado: %s", origin_zip, dest_zip, result)
+                if result.reason == 'circuit_open':
+                    continue  # No es un fallo del carril: el proveedor está en pausa
+                self.env['tms.route.failure']._record_failure(
+                    self.env['res.company'].browse(company_id), origin_zip, dest_zip,
+                    self.env['tms.vehicle.type'].browse(vehicle_type_id), result.reason, result.detail)
+                continue
+            vals_list.append(dict(
+                result,
+                company_id=company_id,
+                origin_zip=origin_zip,
+                dest_zip=dest_zip,
+                vehicle_type_id=vehicle_type_id,
+                last_update=today,
+            ))
+        created = self._create_prefetched(vals_list)
+        _logger.info("TMS: prefetch de rutas: %s carriles consultados, %s guardados", len(lanes), created)
+        return created
+
+    @api.model
+    def _create_prefetched(self, vals_list):
+        """
+        Inserta las rutas precalculadas en un solo create.
+
+        Si otro proceso (cola o usuario) guardó el mismo carril mientras
+        tanto, el constraint unique_route rechaza el lote: se reintenta uno
+        por uno ignorando los duplicados.
+
+        :return: número de rutas creadas
+        """
+        if not vals_list:
+            return 0
+        try:
+            with self.env.cr.savepoint():
+                self.create(vals_list)
+            return len(vals_list)
+        except IntegrityError:
+            created = 0
+            for vals in vals_list:
+                try:
+                    with self.env.cr.savepoint():
+                        self.create(vals)
+                        created += 1
+                except IntegrityError:
+                    pass  # Carril guardado por otro proceso
+            return created
+
+    # ============================================================
+    # CONSULTA DE CACHÉ (TTL + stale-while-revalidate)
+    # ============================================================
+
+    @api.model
+    def _lookup_route(self, company, origin_zip, dest_zip, vehicle_type):
+        """
+        Busca un carril en la caché y clasifica el resultado.
+
+        Pasa por la caché LRU en memoria del worker (_get_cached_route): un
+        carril caliente se responde desde memoria; la generación de la caché
+        de la empresa (tms.cache.generation) se lee una sola vez por transacción.
+
+        :return: (dict o None, status). El dict trae id, distance_km,
+                 duration_hours y cost_tolls. status:
+                 'hit'   -> ruta vigente
+                 'stale' -> ruta vencida (TTL de la empresa)
+                 'miss'  -> no hay ruta guardada
+        """
+        cached = self._get_cached_route(
+            company.id, origin_zip, dest_zip, vehicle_type.id if vehicle_type else False,
+            self.env['tms.cache.generation']._get(self._name, company.id))
+        if not cached:
+            tms_metrics.inc(self.env.cr.dbname, 'tms_route_cache_lookups_total', {'result': 'miss'})
+            return None, 'miss'
+
+        route_id, distance_km, duration_hours, cost_tolls, expiry_date = cached
+        today = fields.Date.context_today(self)
+        status = 'stale' if expiry_date and expiry_date < today else 'hit'
+        tms_metrics.inc(self.env.cr.dbname, 'tms_route_cache_lookups_total', {'result': status})
+        return {
+            'id': route_id,
+            'distance_km': distance_km,
+            'duration_hours': duration_hours,
+            'cost_tolls': cost_tolls,
+        }, status
+
+    @api.model
+    @tools.ormcache('company_id', 'origin_zip', 'dest_zip', 'vehicle_type_id', 'generation')
+    def _get_cached_route(self, company_id, origin_zip, dest_zip, vehicle_type_id, generation):
+        """
+        Ruta guardada de un carril, en la caché LRU (ormcache) del worker.
+
+        Devuelve una tupla inmutable (segura de compartir entre requests) o
+        None. La generación de la caché de la empresa (tms.cache.generation)
+        forma parte de la llave: se incrementa cuando se crea, modifica o
+        borra una ruta, o cambia la vigencia (TTL) de la empresa, y así solo
+        se descartan las rutas de esa empresa (no toda la caché del registro).
+
+        :return: (id, distance_km, duration_hours, cost_tolls, fecha_de_vencimiento)
+        """
+        tms_metrics.inc(self.env.cr.dbname, 'tms_route_cache_lru_misses_total')
+        self.env.cr.execute(SQL(
+            """
+            SELECT d.id, d.distance_km, d.duration_hours, d.cost_tolls,
+                   CASE WHEN c.tms_route_cache_ttl_days > 0
+                        THEN d.last_update + c.tms_route_cache_ttl_days END
+              FROM tms_destination d
+              JOIN res_company c ON c.id = d.company_id
+             WHERE d.company_id = %s
+               AND d.origin_zip = %s
+               AND d.dest_zip = %s
+               AND COALESCE(d.vehicle_type_id, 0) = %s
+               AND d.active
+             ORDER BY d.id
+             LIMIT 1
+            """,
+            company_id, origin_zip, dest_zip, vehicle_type_id or 0,
+        ))
+        row = self.env.cr.fetchone()
+        return tuple(row) if row else None
+
+    @api.model
+    def _get_cache_stats(self):
+        """
+        Contadores de la caché de rutas de este worker.
+
+        :return: dict con hit, miss, stale, total, hit_rate (0-100) y los
+                 aciertos de la caché en memoria: lru_hits = consultas - lru_miss
+        """
+        dbname = self.env.cr.dbname
+        stats = {
+            status: int(tms_metrics.get_counter(dbname, 'tms_route_cache_lookups_total', {'result': status}))
+            for status in ('hit', 'miss', 'stale')
+        }
+        total = sum(stats.values())
+        lru_misses = int(tms_metrics.get_counter(dbname, 'tms_route_cache_lru_misses_total'))
+        lru_hits = max(total - lru_misses, 0)
+        return dict(
+            stats,
+            total=total,
+            hit_rate=100.0 * (stats['hit'] + stats['stale']) / total if total else 0.0,
+            lru_hits=lru_hits,
+            lru_misses=lru_misses,
+            lru_hit_rate=100.0 * lru_hits / total if total else 0.0,
+        )
+
+    # ============================================================
+    # INVALIDACIÓN DE LA CACHÉ EN MEMORIA (por empresa, todos los workers)
+    # ============================================================
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['tms.cache.generation']._bump(self._name, records.company_id.ids)
+        return records
+
+    def write(self, vals):
+        if not ROUTE_CACHE_FIELDS.intersection(vals):
+            return super().write(vals)
+        company_ids = self.company_id.ids
+        res = super().write(vals)
+        self.env['tms.cache.generation']._bump(self._name, company_ids + self.company_id.ids)
+        return res
+
+    def unlink(self):
+        company_ids = self.company_id.ids
+        res = super().unlink()
+        self.env['tms.cache.generation']._bump(self._name, company_ids)
+        return res
+
+    @api.model
+    def _cron_refresh_stale_routes(self):
+        """
+        Revalida las rutas vencidas más antiguas dentro de un presupuesto.
+
+        UNA consulta elige las N rutas más viejas que superaron la vigencia de
+        su empresa y no tienen cálculo pendiente; se encolan en tms.route.job
+        (el recálculo incrementa la versión de la ruta). El presupuesto
+        ('tms.route_refresh_budget') limita el gasto con el proveedor por hora.
+        """
+        Provider = self.env['tms.route.provider']
+        provider = Provider._get_provider()
+        if Provider._is_offline(provider):
+            # Sin proveedor con red no hay con qué revalidar: la ruta vencida sigue en uso
+            return 0
+
+        budget = int(self.env['ir.config_parameter'].sudo().get_param(
+            'tms.route_refresh_budget', ROUTE_REFRESH_BUDGET))
+        self.env.cr.execute(SQL(
+            """
+            SELECT d.id
+              FROM tms_destination d
+              JOIN res_company c ON c.id = d.company_id
+             WHERE d.active
+               AND c.tms_route_cache_ttl_days > 0
+               AND d.last_update + c.tms_route_cache_ttl_days < CURRENT_DATE
+               AND NOT EXISTS (
+                   SELECT 1 FROM tms_route_job j
+                    WHERE j.company_id = d.company_id
+                      AND j.origin_zip = d.origin_zip
+                      AND j.dest_zip = d.dest_zip
+                      AND COALESCE(j.vehicle_type_id, 0) = COALESCE(d.vehicle_type_id, 0)
+                      AND j.state IN ('queued', 'running'))
+             ORDER BY d.last_update, d.id
+             LIMIT %s
+            """,
+            max(budget, 0),
+        ))
+        routes = self.browse([row[0] for row in self.env.cr.fetchall()])
+        Job = self.env['tms.route.job']
+        for route in routes:
+            Job._enqueue(route.company_id, route.origin_zip, route.dest_zip, route.vehicle_type_id, provider)
+        _logger.info("TMS: %s rutas vencidas enviadas a recálculo. Caché: %s", len(routes), self._get_cache_stats())
+        return len(routes)
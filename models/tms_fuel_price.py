@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+from odoo import models, fields, api, tools
+from odoo.tools import SQL
+
+
+class TmsFuelPrice(models.Model):
+    """
+    Índice de Precios del Diesel por Empresa y Región (con vigencia).
+
+    PROBLEMA: Cada viaje capturaba el precio del diesel a mano (24.00 por
+    defecto); un cambio de precio no llegaba a las cotizaciones abiertas.
+
+    SOLUCIÓN:
+    - Cada fila es un precio vigente DESDE una fecha, por estado (región)
+      o nacional (sin estado)
+    - El precio de un viaje es el último vigente a su fecha de solicitud en
+      el estado de origen; si el estado no tiene precio se usa el nacional
+    - El índice vive en la caché del worker (ormcache) como arreglos
+      ordenados por fecha: cada consulta es una búsqueda binaria (bisect)
+    - Al cambiar el índice solo se recotizan los viajes abiertos cuyo
+      precio vigente cambió
+
+    ARQUITECTURA SAAS: company_id obligatorio.
+    """
+
+    _name = 'tms.fuel.price'
+    _description = 'Precio del Diesel'
+    _order = 'date_from desc, state_id'
+    _rec_name = 'date_from'
+
+    company_id = fields.Many2one(
+        'res.company',
+        string='Compañía',
+        required=True,
+        index=True,
+        default=lambda self: self.env.company,
+    )
+    state_id = fields.Many2one(
+        'res.country.state',
+        string='Estado',
+        help='Región (estado de origen del viaje). Vacío: precio nacional',
+    )
+    date_from = fields.Date(
+        string='Vigente Desde',
+        required=True,
+        default=fields.Date.context_today,
+    )
+    price_liter = fields.Float(string='Precio (L)', required=True, digits=(10, 2))
+
+    _sql_constraints = [
+        ('company_state_date_uniq', 'unique(company_id, state_id, date_from)',
+         'Ya existe un precio para esta región y fecha.'),
+        ('price_positive', 'CHECK(price_liter > 0)', 'El precio del diesel debe ser mayor a cero.'),
+    ]
+
+    # ============================================================
+    # CONSULTA (índice en memoria del worker)
+    # ============================================================
+
+    @api.model
+    @tools.ormcache('company_id', 'generation')
+    def _get_price_index(self, company_id, generation):
+        """
+        Índice de precios de una empresa, en la caché del worker.
+
+        :param generation: generación de la caché de la empresa (tms.cache.generation);
+                           solo forma parte de la llave
+
+        :return: dict {state_id o 0 (nacional): (fechas, precios)} con tuplas
+                 ordenadas por fecha ascendente
+        """
+        self.env.cr.execute(SQL(
+            """
+            SELECT COALESCE(state_id, 0), date_from, price_liter
+              FROM tms_fuel_price
+             WHERE company_id = %s
+             ORDER BY 1, date_from
+            """,
+            company_id,
+        ))
+        index = {}
+        for state_id, date_from, price in self.env.cr.fetchall():
+            dates, prices = index.setdefault(state_id, ([], []))
+            dates.append(date_from)
+            prices.append(float(price))
+        return {state_id: (tuple(dates), tuple(prices)) for state_id, (dates, prices) in index.items()}
+
+    @api.model
+    def _get_price(self, company_id, state_id, date):
+        """
+        Precio del diesel vigente a una fecha (el del estado o, si no hay, el nacional).
+
+        :return: precio por litro o None si la empresa no tiene precio vigente
+        """
+        index = self._get_price_index(
+            company_id, self.env['tms.cache.generation']._get(self._name, company_id))
+        for key in ((state_id or 0), 0):
+            dates, prices = index.get(key, ((), ()))
+            position = bisect.bisect_right(dates, date)
+            if position:
+                return prices[position - 1]
+        return None
+
+    # ============================================================
+    # MANTENIMIENTO DE LA CACHÉ + RECOTIZACIÓN
+    # ============================================================
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._reprice_waybills(records.company_id, min(records.mapped('date_from'), default=None))
+        return records
+
+    def write(self, vals):
+        companies, date_from = self.company_id, min(self.mapped('date_from'), default=None)
+        res = super().write(vals)
+        if {'company_id', 'state_id', 'date_from', 'price_liter'} & set(vals):
+            dates = [date for date in (date_from, min(self.mapped('date_from'), default=None)) if date]
+            self._reprice_waybills(companies | self.company_id, min(dates, default=None))
+        return res
+
+    def unlink(self):
+        companies, date_from = self.company_id, min(self.mapped('date_from'), default=None)
+        res = super().unlink()
+        self._reprice_waybills(companies, date_from)
+        return res
+
+    def _reprice_waybills(self, companies, date_from):
+        """Invalida el índice en memoria de las empresas y recotiza sus viajes abiertos afectados."""
+        self.env.flush_all()
+        if companies:
+            self.env['tms.cache.generation']._bump(self._name, companies.ids)
+            self.env['tms.waybill']._reprice_fuel(companies.ids, date_from)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Métricas del TMS en memoria (contadores e histogramas), por worker y por BD.
+
+- Contadores: consultas a la caché de rutas (hit/miss/stale), llamadas al
+  proveedor por resultado, casetas cotizadas, trabajos de la cola
+- Histogramas: latencia de las llamadas al proveedor (ms)
+
+Sin escrituras a la BD: registrar una métrica es un incremento bajo lock.
+Se exponen como reporte en Ajustes y en formato de texto de Prometheus
+(controllers/metrics.py). Cada worker lleva sus propios números; Prometheus
+los distingue por la etiqueta 'worker' (pid).
+"""
+
+import os
+import threading
+from collections import defaultdict
+
+# Cubetas (ms) del histograma de latencia del proveedor
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 15000)
+
+# Descripción de cada métrica (HELP de Prometheus) y su tipo
+METRICS = {
+    'tms_route_cache_lookups_total': ('counter', 'Consultas a la caché de rutas por resultado (hit, miss, stale)'),
+    'tms_route_cache_lru_misses_total': ('counter', 'Consultas que no estaban en la caché en memoria del worker'),
+    'tms_route_provider_calls_total': ('counter', 'Llamadas al proveedor de rutas por resultado'),
+    'tms_route_provider_latency_ms': ('histogram', 'Latencia de las llamadas al proveedor de rutas (ms)'),
+    'tms_route_provider_tolls_total': ('counter', 'Casetas (MXN) devueltas por el proveedor de rutas'),
+    'tms_route_jobs_total': ('counter', 'Trabajos de la cola de rutas terminados por estado'),
+}
+
+_lock = threading.Lock()
+
+# {dbname: {(nombre, etiquetas): valor}}
+_counters = defaultdict(lambda: defaultdict(float))
+
+# {dbname: {(nombre, etiquetas): [conteo por cubeta..., +Inf, suma]}}
+_histograms = defaultdict(dict)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def inc(dbname, name, labels=None, value=1.0):
+    """Incrementa un contador."""
+    with _lock:
+        _counters[dbname][_key(name, labels)] += value
+
+
+def observe(dbname, name, value, labels=None):
+    """Registra una observación en un histograma."""
+    with _lock:
+        data = _histograms[dbname].setdefault(_key(name, labels), [0] * (len(LATENCY_BUCKETS_MS) + 2))
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if value <= bound:
+                data[index] += 1
+        data[-2] += 1       # +Inf (= conteo total)
+        data[-1] += value   # suma
+
+
+def get_counter(dbname, name, labels=None):
+    with _lock:
+        return _counters[dbname].get(_key(name, labels), 0.0)
+
+
+def snapshot(dbname):
+    """
+    Copia de las métricas de una BD.
+
+    :return: (counters, histograms) con claves (nombre, etiquetas)
+    """
+    with _lock:
+        counters = dict(_counters[dbname])
+        histograms = {key: list(data) for key, data in _histograms[dbname].items()}
+    return counters, histograms
+
+
+def histogram_quantile(data, quantile):
+    """Cuantil aproximado (cota superior de la cubeta) de un histograma."""
+    total = data[-2]
+    if not total:
+        return 0.0
+    rank = quantile * total
+    for index, bound in enumerate(LATENCY_BUCKETS_MS):
+        if data[index] >= rank:
+            return float(bound)
+    return float('inf')
+
+
+def _format_labels(labels):
+    labels = labels + (('worker', str(os.getpid())),)
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels)
+
+
+def render_prometheus(dbname, gauges=None):
+    """
+    Métricas de una BD en formato de texto de Prometheus (exposition 0.0.4).
+
+    :param gauges: dict {(nombre, etiquetas): valor} de métricas instantáneas
+                   (ej. estado del circuit breaker) calculadas al vuelo
+    """
+    counters, histograms = snapshot(dbname)
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), repr(float(value))))
+        else:
+            for (metric, labels), data in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for index, bound in enumerate(LATENCY_BUCKETS_MS):
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', str(bound)),)), data[index]))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', '+Inf'),)), data[-2]))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(float(data[-1]))))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), data[-2]))
+    gauges = gauges or {}
+    for name in sorted({name for name, _labels in gauges}):
+        lines.append('# TYPE %s gauge' % name)
+        for (metric, labels), value in sorted(gauges.items()):
+            if metric == name:
+                lines.append('%s%s %s' % (name, _format_labels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import ValidationError
+from odoo.tools import SQL
+
+
+class TmsRateCard(models.Model):
+    """
+    Tarifario (Rate Card) por Cliente.
+
+    PROBLEMA: price_per_km se capturaba a mano en cada cotización; la tarifa
+    acordada con cada cliente vivía fuera del sistema.
+
+    SOLUCIÓN:
+    - Un tarifario por cliente (o general, sin cliente) con tramos de
+      distancia por tipo de vehículo, recargo por material peligroso y
+      monto mínimo
+    - Los tarifarios de la empresa se compilan en un índice de intervalos en
+      la caché del worker (ormcache): resolver la tarifa de un viaje es una
+      búsqueda binaria en memoria, sin consultas por regla (onchange y
+      recotización masiva); editar un tarifario invalida solo el índice de
+      su empresa (tms.cache.generation)
+    - Prioridad: cliente + tipo de vehículo > cliente > general + tipo de
+      vehículo > general
+
+    ARQUITECTURA SAAS: company_id obligatorio.
+    """
+
+    _name = 'tms.rate.card'
+    _description = 'Tarifario'
+    _order = 'partner_id, name'
+
+    name = fields.Char(string='Tarifario', required=True)
+    company_id = fields.Many2one(
+        'res.company',
+        string='Compañía',
+        required=True,
+        index=True,
+        default=lambda self: self.env.company,
+    )
+    partner_id = fields.Many2one(
+        'res.partner',
+        string='Cliente',
+        domain="[('company_id', 'in', (False, company_id)), ('parent_id', '=', False)]",
+        check_company=True,
+        help='Vacío: tarifario general para clientes sin tarifario propio',
+    )
+    active = fields.Boolean(default=True)
+    currency_id = fields.Many2one(related='company_id.currency_id')
+    hazmat_surcharge_percent = fields.Float(
+        string='Recargo Material Peligroso (%)',
+        help='Se suma al total por KM cuando alguna mercancía es material peligroso',
+    )
+    minimum_amount = fields.Monetary(
+        string='Monto Mínimo',
+        currency_field='currency_id',
+        help='Total por KM mínimo a cobrar por viaje',
+    )
+    line_ids = fields.One2many('tms.rate.card.line', 'card_id', string='Tramos', copy=True)
+
+    @api.constrains('company_id', 'partner_id', 'active')
+    def _check_unique_active_card(self):
+        for card in self.filtered('active'):
+            if self.search_count([
+                ('id', '!=', card.id),
+                ('company_id', '=', card.company_id.id),
+                ('partner_id', '=', card.partner_id.id),
+            ]):
+                raise ValidationError(_(
+                    "Ya existe un tarifario activo para %s.",
+                    card.partner_id.display_name or _("clientes sin tarifario (general)"),
+                ))
+
+    # ============================================================
+    # ÍNDICE COMPILADO (caché en memoria del worker)
+    # ============================================================
+
+    @api.model
+    @tools.ormcache('company_id', 'generation')
+    def _get_rate_index(self, company_id, generation):
+        """
+        Compila los tarifarios activos de una empresa en un índice de intervalos.
+
+        :param generation: generación de la caché de la empresa (tms.cache.generation);
+                           solo forma parte de la llave
+
+        :return: (index, cards) donde
+                 index = {(partner_id o 0, vehicle_type_id o 0):
+                          (inicios, fines, precios, card_ids)} con tuplas
+                          ordenadas por km inicial (fin 0 = sin límite)
+                 cards = {card_id: (recargo_peligroso_%, monto_mínimo)}
+        """
+        self.env.cr.execute(SQL(
+            """
+            SELECT COALESCE(c.partner_id, 0), COALESCE(l.vehicle_type_id, 0),
+                   l.km_from, l.km_to, l.price_per_km, c.id,
+                   c.hazmat_surcharge_percent, c.minimum_amount
+              FROM tms_rate_card_line l
+              JOIN tms_rate_card c ON c.id = l.card_id
+             WHERE c.company_id = %s
+               AND c.active
+             ORDER BY 1, 2, l.km_from
+            """,
+            company_id,
+        ))
+        index, cards = {}, {}
+        for partner_id, vehicle_type_id, km_from, km_to, price, card_id, hazmat, minimum in self.env.cr.fetchall():
+            columns = index.setdefault((partner_id, vehicle_type_id), ([], [], [], []))
+            for column, value in zip(columns, (km_from or 0.0, km_to or 0.0, price or 0.0, card_id)):
+                column.append(value)
+            cards[card_id] = (hazmat or 0.0, float(minimum or 0.0))
+        return {key: tuple(map(tuple, columns)) for key, columns in index.items()}, cards
+
+    @api.model
+    def _match_rate(self, company_id, partner_id, vehicle_type_id, distance_km, hazmat=False):
+        """
+        Tarifa aplicable a un viaje.
+
+        :return: dict {card_id, price_per_km, surcharge_percent, minimum_amount}
+                 o None si ningún tramo cubre la distancia
+        """
+        index, cards = self._get_rate_index(
+            company_id, self.env['tms.cache.generation']._get('tms.rate.card', company_id))
+        for key in ((partner_id or 0, vehicle_type_id or 0), (partner_id or 0, 0),
+                    (0, vehicle_type_id or 0), (0, 0)):
+            if key not in index:
+                continue
+            starts, ends, prices, card_ids = index[key]
+            position = bisect.bisect_right(starts, distance_km) - 1
+            if position < 0 or (ends[position] and distance_km >= ends[position]):
+                continue
+            hazmat_percent, minimum = cards[card_ids[position]]
+            return {
+                'card_id': card_ids[position],
+                'price_per_km': prices[position],
+                'surcharge_percent': hazmat_percent if hazmat else 0.0,
+                'minimum_amount': minimum,
+            }
+        return None
+
+    # ============================================================
+    # MANTENIMIENTO DE LA CACHÉ
+    # ============================================================
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['tms.cache.generation']._bump('tms.rate.card', records.company_id.ids)
+        return records
+
+    def write(self, vals):
+        company_ids = self.company_id.ids
+        res = super().write(vals)
+        self.env['tms.cache.generation']._bump('tms.rate.card', company_ids + self.company_id.ids)
+        return res
+
+    def unlink(self):
+        company_ids = self.company_id.ids
+        res = super().unlink()
+        self.env['tms.cache.generation']._bump('tms.rate.card', company_ids)
+        return res
+
+
+class TmsRateCardLine(models.Model):
+    """Tramo de distancia de un tarifario: [km desde, km hasta) → precio por km."""
+
+    _name = 'tms.rate.card.line'
+    _description = 'Tramo de Tarifario'
+    _order = 'card_id, vehicle_type_id, km_from'
+
+    card_id = fields.Many2one('tms.rate.card', string='Tarifario', required=True, ondelete='cascade', index=True)
+    company_id = fields.Many2one(related='card_id.company_id', store=True)
+    vehicle_type_id = fields.Many2one(
+        'tms.vehicle.type',
+        string='Tipo de Vehículo',
+        help='Vacío: aplica a cualquier tipo de vehículo',
+    )
+    km_from = fields.Float(string='Desde (km)', required=True, default=0.0)
+    km_to = fields.Float(string='Hasta (km)', help='Sin incluir. 0: sin límite')
+    price_per_km = fields.Float(string='Precio por Km', required=True, digits=(10, 2))
+
+    @api.constrains('km_from', 'km_to', 'vehicle_type_id', 'card_id')
+    def _check_tiers(self):
+        for line in self:
+            if line.km_from < 0 or (line.km_to and line.km_to <= line.km_from):
+                raise ValidationError(_("El tramo %s - %s km no es válido.", line.km_from, line.km_to or '∞'))
+            siblings = line.card_id.line_ids.filtered(
+                lambda other: other != line and other.vehicle_type_id == line.vehicle_type_id)
+            for other in siblings:
+                if (not other.km_to or line.km_from < other.km_to) and (not line.km_to or other.km_from < line.km_to):
+                    raise ValidationError(_(
+                        "Los tramos %(a)s y %(b)s del tarifario %(card)s se traslapan.",
+                        a='%s - %s km' % (line.km_from, line.km_to or '∞'),
+                        b='%s - %s km' % (other.km_from, other.km_to or '∞'),
+                        card=line.card_id.name,
+                    ))
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['tms.cache.generation']._bump('tms.rate.card', records.company_id.ids)
+        return records
+
+    def write(self, vals):
+        company_ids = self.company_id.ids
+        res = super().write(vals)
+        self.env['tms.cache.generation']._bump('tms.rate.card', company_ids + self.company_id.ids)
+        return res
+
+    def unlink(self):
+        company_ids = self.company_id.ids
+        res = super().unlink()
+        self.env['tms.cache.generation']._bump('tms.rate.card', company_ids)
+        return res
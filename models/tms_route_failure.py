@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+
+from .tms_route_job import route_lane_key
+
+# ============================================================
+# VIGENCIA DE LA CACHÉ NEGATIVA (minutos, por motivo)
+# ============================================================
+# Sobreescribible con el parámetro 'tms.route_failure_ttl_<motivo>'
+
+ROUTE_FAILURE_TTL_MINUTES = {
+    'invalid_cp': 7 * 24 * 60,    # El CP no cambia: una semana
+    'no_route': 24 * 60,          # Sin ruta entre CPs válidos: un día
+    'provider_error': 5,          # Caída / cuota del proveedor: unos minutos
+}
+
+
+class TmsRouteFailure(models.Model):
+    """
+    Caché Negativa de Rutas (carriles que el proveedor no pudo calcular).
+
+    PROBLEMA: Un carril con CP inválido o sin ruta falla cada vez que se
+    cotiza, y cada intento paga el viaje completo al proveedor (y su cuota).
+
+    SOLUCIÓN:
+    - Cada fallo se guarda con un motivo ('invalid_cp', 'no_route',
+      'provider_error') y una vigencia corta según el motivo
+    - Mientras esté vigente, cotizar el carril falla de inmediato desde la
+      caché en memoria del worker (ormcache), sin proveedor
+    - Registrar o borrar fallos invalida solo esta caché y solo para la
+      empresa del carril (tms.cache.generation), no toda la caché del registro
+    - Al vencer, el siguiente intento vuelve a consultar al proveedor
+
+    ARQUITECTURA SAAS: company_id obligatorio (igual que la caché de rutas).
+    """
+
+    _name = 'tms.route.failure'
+    _description = 'Caché Negativa de Rutas'
+    _order = 'expires_at desc'
+    _rec_name = 'lane_key'
+    _log_access = False
+
+    company_id = fields.Many2one(
+        'res.company',
+        string='Compañía',
+        required=True,
+        index=True,
+        ondelete='cascade',
+    )
+    origin_zip = fields.Char(string='CP Origen', required=True)
+    dest_zip = fields.Char(string='CP Destino', required=True)
+    vehicle_type_id = fields.Many2one('tms.vehicle.type', string='Tipo de Vehículo', ondelete='cascade')
+    lane_key = fields.Char(string='Carril', required=True)
+
+    reason = fields.Selection([
+        ('invalid_cp', 'CP Inválido'),
+        ('no_route', 'Sin Ruta'),
+        ('provider_error', 'Error del Proveedor'),
+    ], string='Motivo', required=True)
+    detail = fields.Char(string='Detalle')
+    expires_at = fields.Datetime(string='Vence', required=True)
+    attempts = fields.Integer(string='Fallos', default=1)
+
+    _sql_constraints = [
+        ('lane_key_uniq', 'unique(lane_key)', 'Solo puede existir un fallo registrado por carril.')
+    ]
+
+    # ============================================================
+    # CONSULTA (caché en memoria del worker)
+    # ============================================================
+
+    @api.model
+    @tools.ormcache('lane_key', 'generation')
+    def _get_failure(self, lane_key, generation):
+        """
+        Fallo registrado de un carril, en la caché LRU (ormcache) del worker.
+
+        :param generation: generación de la caché de la empresa (tms.cache.generation);
+                           solo forma parte de la llave
+
+        :return: tupla inmutable (reason, detail, expires_at) o None
+        """
+        self.env.cr.execute(SQL(
+            "SELECT reason, detail, expires_at FROM tms_route_failure WHERE lane_key = %s",
+            lane_key,
+        ))
+        row = self.env.cr.fetchone()
+        return tuple(row) if row else None
+
+    @api.model
+    def _check_lane(self, company, origin_zip, dest_zip, vehicle_type):
+        """
+        Falla de inmediato si el carril tiene un fallo vigente.
+
+        :raises UserError: con el motivo del fallo y su vencimiento
+        """
+        lane_key = route_lane_key(company.id, origin_zip, dest_zip, vehicle_type.id if vehicle_type else None)
+        failure = self._get_failure(
+            lane_key, self.env['tms.cache.generation']._get(self._name, company.id))
+        if not failure or failure[2] <= fields.Datetime.now():
+            return
+        reason, detail, expires_at = failure
+        raise UserError(_(
+            "La ruta %(origin)s → %(dest)s falló recientemente (%(reason)s: %(detail)s). "
+            "Se reintentará después de %(expires)s."
+        ) % {
+            'origin': origin_zip,
+            'dest': dest_zip,
+            'reason': dict(self._fields['reason']._description_selection(self.env))[reason],
+            'detail': detail or '-',
+            'expires': fields.Datetime.to_string(expires_at),
+        })
+
+    # ============================================================
+    # REGISTRO
+    # ============================================================
+
+    @api.model
+    def _record_failure(self, company, origin_zip, dest_zip, vehicle_type, reason, detail=''):
+        """Registra (upsert) el fallo de un carril con la vigencia de su motivo."""
+        ttl_minutes = int(self.env['ir.config_parameter'].sudo().get_param(
+            'tms.route_failure_ttl_%s' % reason, ROUTE_FAILURE_TTL_MINUTES[reason]))
+        vehicle_type_id = vehicle_type.id if vehicle_type else None
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tms_route_failure AS f
+                   (company_id, origin_zip, dest_zip, vehicle_type_id, lane_key,
+                    reason, detail, expires_at, attempts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 1)
+            ON CONFLICT (lane_key) DO UPDATE
+               SET reason = EXCLUDED.reason,
+                   detail = EXCLUDED.detail,
+                   expires_at = EXCLUDED.expires_at,
+                   attempts = f.attempts + 1
+            """,
+            company.id, origin_zip, dest_zip, vehicle_type_id,
+            route_lane_key(company.id, origin_zip, dest_zip, vehicle_type_id),
+            reason, (detail or '')[:250],
+            fields.Datetime.now() + timedelta(minutes=ttl_minutes),
+        ))
+        self.invalidate_model()
+        self.env['tms.cache.generation']._bump(self._name, [company.id])
+
+    def unlink(self):
+        company_ids = self.company_id.ids
+        res = super().unlink()
+        self.env['tms.cache.generation']._bump(self._name, company_ids)
+        return res
+
+    @api.autovacuum
+    def _gc_expired_failures(self):
+        """
+        Borra los fallos vencidos (ya no bloquean el carril).
+
+        No invalida la caché: una entrada vencida que siga en memoria ya no
+        bloquea (_check_lane compara expires_at).
+        """
+        self.env.cr.execute(SQL(
+            "DELETE FROM tms_route_failure WHERE expires_at < %s",
+            fields.Datetime.now(),
+        ))
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP compartido de los proveedores de rutas (por worker).
+
+- Sesión requests.Session con pool de conexiones y keep-alive: sin un
+  handshake TLS nuevo por cada ruta
+- Reintentos acotados con backoff exponencial y jitter (errores de red,
+  429 y 5xx)
+- Deadline opcional: timeouts y reintentos se recortan al tiempo que le
+  queda a quien llama (presupuesto del cron)
+- Circuit breaker por proveedor: tras varios errores seguidos deja de
+  llamar al proveedor por un tiempo y falla de inmediato
+
+La latencia y los errores por proveedor se registran en tms_metrics.
+
+Todo es de nivel módulo (un estado por proceso worker) y seguro entre hilos:
+lo usan la cola de rutas y el prefetch concurrente. No toca env ni cursor.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ============================================================
+# PARÁMETROS DEL CLIENTE
+# ============================================================
+
+# Conexiones por host en el pool (>= concurrencia del prefetch)
+ROUTE_HTTP_POOL_SIZE = 8
+
+# Timeouts (segundos): conexión, lectura
+ROUTE_HTTP_TIMEOUT = (5, 15)
+
+# Reintentos adicionales tras el primer intento fallido
+ROUTE_HTTP_RETRIES = 2
+
+# Backoff exponencial con jitter completo: espera uniforme en [0, base * 2^intento]
+ROUTE_HTTP_BACKOFF_BASE = 0.5
+ROUTE_HTTP_BACKOFF_MAX = 4.0
+
+# Respuestas que se reintentan (cuota y errores del servidor)
+ROUTE_HTTP_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# Circuit breaker: errores seguidos para abrir y segundos abierto
+ROUTE_BREAKER_THRESHOLD = 5
+ROUTE_BREAKER_COOLDOWN = 60.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RouteHttpError(Exception):
+    """La llamada HTTP falló después de agotar los reintentos."""
+
+
+class RouteDeadlineError(RouteHttpError):
+    """Se agotó el deadline de quien llama antes de obtener respuesta (no es un error del proveedor)."""
+
+
+def get_http_session():
+    """Sesión HTTP compartida del worker (creación perezosa, una por proceso)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=ROUTE_HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def post_json(url, payload, headers, timeout=ROUTE_HTTP_TIMEOUT, retries=ROUTE_HTTP_RETRIES, deadline=None):
+    """
+    POST JSON con la sesión compartida y reintentos con jitter.
+
+    :param deadline: time.monotonic() límite (opcional). Cada intento usa a lo
+                     más el tiempo restante como timeout y no se reintenta si
+                     la espera del backoff ya no cabe
+    :return: (status_code, dict de la respuesta)
+    :raises RouteDeadlineError: no quedó tiempo para intentar, o el intento
+                                falló por el timeout recortado al deadline
+    :raises RouteHttpError: error de red, respuesta no JSON o status
+                            reintentable tras agotar los reintentos
+    """
+    session = get_http_session()
+    for attempt in range(retries + 1):
+        attempt_timeout, capped = timeout, False
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RouteDeadlineError('deadline')
+            capped = remaining < max(timeout)
+            attempt_timeout = tuple(min(limit, remaining) for limit in timeout)
+        try:
+            response = session.post(url, json=payload, headers=headers, timeout=attempt_timeout)
+            if response.status_code not in ROUTE_HTTP_RETRY_STATUS:
+                return response.status_code, response.json()
+            error = RouteHttpError('HTTP %s' % response.status_code)
+        except requests.Timeout as e:
+            if capped:
+                raise RouteDeadlineError(str(e)) from e
+            error = RouteHttpError(str(e))
+        except (requests.RequestException, ValueError) as e:
+            error = RouteHttpError(str(e))
+        if attempt < retries:
+            delay = random.uniform(0, min(ROUTE_HTTP_BACKOFF_MAX, ROUTE_HTTP_BACKOFF_BASE * 2 ** attempt))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                break  # Sin tiempo para otro intento: el error del último cuenta
+            time.sleep(delay)
+    raise error
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un proveedor (estados: closed → open → half_open).
+
+    - closed:    las llamadas pasan; cada error del proveedor suma
+    - open:      tras THRESHOLD errores seguidos; las llamadas fallan de
+                 inmediato durante COOLDOWN segundos
+    - half_open: vencido el COOLDOWN pasa UNA llamada de prueba; si funciona
+                 se cierra, si falla se vuelve a abrir
+    """
+
+    def __init__(self, threshold=ROUTE_BREAKER_THRESHOLD, cooldown=ROUTE_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """True si la llamada puede pasar (reserva la llamada de prueba en half_open)."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def release(self):
+        """Libera la llamada de prueba sin contarla (se canceló antes de tener respuesta)."""
+        with self._lock:
+            self.trial = False
+
+    def record(self, success):
+        with self._lock:
+            self.trial = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    """Circuit breaker del proveedor en este worker."""
+    with _registry_lock:
+        return _breakers.setdefault(provider, CircuitBreaker())
+
+
+def get_breaker_states():
+    """{proveedor: estado del breaker} de los proveedores usados en este worker."""
+    with _registry_lock:
+        breakers = dict(_breakers)
+    return {provider: breaker.state for provider, breaker in breakers.items()}
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from psycopg2 import IntegrityError
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+from odoo.tools.sql import create_index
+
+from . import tms_metrics
+from .tms_route_http import ROUTE_HTTP_TIMEOUT
+from .tms_route_provider import RouteProviderError
+
+_logger = logging.getLogger(__name__)
+
+# Tiempo máximo (segundos) que el cron dedica a la cola en cada ejecución
+ROUTE_JOB_CRON_BUDGET = 50
+
+# Tiempo mínimo restante (segundos) para tomar otro trabajo: un intento completo al proveedor
+ROUTE_JOB_MIN_REMAINING = sum(ROUTE_HTTP_TIMEOUT)
+
+# Minutos sin actividad tras los que un trabajo 'running' se da por abandonado
+# (worker muerto por limit_time_real, OOM o reinicio) y vuelve a la cola
+ROUTE_JOB_STALE_MINUTES = 10
+
+# Espacio de nombres de los advisory locks por carril (evita chocar con otros locks)
+ROUTE_LANE_LOCK_NAMESPACE = 7630195  # 'tms'
+
+
+def route_lane_key(company_id, origin_zip, dest_zip, vehicle_type_id):
+    """Clave de carril: 'empresa|cp_origen|cp_destino|tipo_vehiculo'."""
+    return '%s|%s|%s|%s' % (company_id, origin_zip, dest_zip, vehicle_type_id or 0)
+
+
+class TmsRouteJob(models.Model):
+    """
+    Cola de Cálculo de Rutas (Trabajos en Segundo Plano).
+
+    PROBLEMA: Llamar al proveedor de rutas (Google) dentro del request HTTP
+    bloquea un worker de Odoo hasta 15 segundos por clic.
+
+    SOLUCIÓN:
+    - El botón "Calcular Ruta" solo encola un trabajo y regresa de inmediato
+    - Un cron (ir_cron_tms_route_jobs) toma los trabajos con
+      FOR UPDATE SKIP LOCKED, llama al proveedor (tms.route.provider)
+      y hace commit por trabajo
+    - El viaje muestra el estado del trabajo (route_job_state) para consultarlo
+    - Al terminar, guarda la ruta en caché (tms.destination) y actualiza
+      todos los viajes que esperaban ese resultado
+
+    SINGLE-FLIGHT (un solo cálculo por carril):
+    - Índice único parcial sobre lane_key para trabajos en cola/calculando:
+      dos cotizaciones simultáneas del mismo carril comparten UN trabajo
+      (INSERT ... ON CONFLICT DO NOTHING)
+    - El cron toma un advisory lock de transacción por carril antes de llamar
+      al proveedor; si otro worker ya guardó el carril, reutiliza su resultado
+    - La ruta se guarda en tms.destination dentro de un savepoint
+
+    RECUPERACIÓN: un trabajo que quedó en 'running' por más de
+    ROUTE_JOB_STALE_MINUTES (su worker murió a media llamada) vuelve a la
+    cola al inicio de cada cron; si no, el índice single-flight bloquearía
+    el carril para siempre.
+
+    ARQUITECTURA SAAS: company_id obligatorio (la caché de rutas es por empresa).
+    """
+
+    _name = 'tms.route.job'
+    _description = 'Cola de Cálculo de Rutas'
+    _order = 'id desc'
+
+    # ============================================================
+    # CAMPOS
+    # ============================================================
+
+    company_id = fields.Many2one(
+        'res.company',
+        string='Compañía',
+        required=True,
+        default=lambda self: self.env.company,
+        index=True,
+    )
+
+    origin_zip = fields.Char(string='CP Origen', required=True)
+    dest_zip = fields.Char(string='CP Destino', required=True)
+    vehicle_type_id = fields.Many2one('tms.vehicle.type', string='Tipo de Vehículo')
+    provider = fields.Char(string='Proveedor', required=True, default='google')
+    lane_key = fields.Char(string='Carril', required=True, readonly=True, index=True)
+
+    state = fields.Selection([
+        ('queued', 'En Cola'),
+        ('running', 'Calculando'),
+        ('done', 'Terminado'),
+        ('failed', 'Fallido'),
+    ], string='Estado', default='queued', required=True, index=True)
+
+    # Many2many: viajes que esperan el resultado de este cálculo
+    waybill_ids = fields.Many2many(
+        'tms.waybill',
+        string='Viajes en Espera',
+    )
+
+    attempts = fields.Integer(string='Intentos', default=0)
+    error_message = fields.Text(string='Error')
+    date_done = fields.Datetime(string='Terminado el')
+
+    # Resultado
+    destination_id = fields.Many2one('tms.destination', string='Ruta en Caché', ondelete='set null')
+    distance_km = fields.Float(string='Distancia (km)', digits=(10, 2))
+    duration_hours = fields.Float(string='Duración (hrs)', digits=(10, 2))
+    cost_tolls = fields.Float(string='Costo de Casetas', digits=(10, 2))
+
+    def init(self):
+        """Single-flight: un solo trabajo pendiente (en cola o calculando) por carril."""
+        create_index(
+            self.env.cr,
+            'tms_route_job_lane_pending_uniq',
+            self._table,
+            ['lane_key'],
+            unique=True,
+            where="state IN ('queued', 'running')",
+        )
+
+    # ============================================================
+    # ENCOLAR (desde el request HTTP: sin llamadas de red)
+    # ============================================================
+
+    @api.model
+    def _enqueue(self, company, origin_zip, dest_zip, vehicle_type, provider, waybill=None):
+        """
+        Encola el cálculo de ruta de un carril y despierta al cron.
+
+        UN INSERT ... ON CONFLICT DO NOTHING sobre el índice único parcial:
+        si ya hay un cálculo pendiente del mismo carril, el viaje se suma a
+        ese trabajo en lugar de crear otro (sin carreras entre search y create).
+        Si el trabajo en conflicto aún no era visible para esta transacción,
+        PostgreSQL lanza un error de serialización y Odoo reintenta el request,
+        que entonces se suma al trabajo ya confirmado.
+
+        :param waybill: viaje que espera el resultado (None para un
+                        recálculo de caché en segundo plano)
+        :return: tms.route.job
+        """
+        vehicle_type_id = vehicle_type.id if vehicle_type else None
+        lane_key = route_lane_key(company.id, origin_zip, dest_zip, vehicle_type_id)
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tms_route_job
+                   (company_id, origin_zip, dest_zip, vehicle_type_id, provider, lane_key,
+                    state, attempts, create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, %s, %s, 'queued', 0, %s, NOW() AT TIME ZONE 'UTC',
+                    %s, NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (lane_key) WHERE state IN ('queued', 'running') DO NOTHING
+            RETURNING id
+            """,
+            company.id, origin_zip, dest_zip, vehicle_type_id, provider, lane_key,
+            self.env.uid, self.env.uid,
+        ))
+        row = self.env.cr.fetchone()
+        created = bool(row)
+        if not created:
+            self.env.cr.execute(SQL(
+                """
+                SELECT id FROM tms_route_job
+                 WHERE lane_key = %s AND state IN ('queued', 'running')
+                """,
+                lane_key,
+            ))
+            row = self.env.cr.fetchone()
+        job = self.browse(row[0])
+        if waybill:
+            job.waybill_ids = [(4, waybill.id)]
+        if created:
+            self.env.ref('tms.ir_cron_tms_route_jobs')._trigger()
+        return job
+
+    # ============================================================
+    # PROCESAMIENTO (cron)
+    # ============================================================
+
+    @api.model
+    def _cron_process_jobs(self):
+        """
+        Procesa la cola dentro de un presupuesto de tiempo.
+
+        FOR UPDATE SKIP LOCKED permite varios workers de cron en paralelo
+        sin tomar el mismo trabajo. Commit por trabajo: un fallo no pierde
+        los resultados anteriores.
+
+        El presupuesto también acota cada trabajo: el tiempo restante es el
+        deadline de la llamada al proveedor (timeouts y reintentos incluidos),
+        y un trabajo solo se toma si queda al menos un intento completo.
+        """
+        deadline = time.monotonic() + ROUTE_JOB_CRON_BUDGET
+        self._requeue_stale_jobs()
+        self.env.cr.commit()
+        skipped = [0]
+        while deadline - time.monotonic() >= ROUTE_JOB_MIN_REMAINING:
+            self.env.cr.execute(SQL(
+                """
+                SELECT id FROM tms_route_job
+                 WHERE state = 'queued'
+                   AND id != ALL(%s)
+                 ORDER BY id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+                """,
+                skipped,
+            ))
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            job = self.browse(row[0])
+            # Publicar 'running' antes de la llamada de red (la UI lo consulta)
+            job.write({'state': 'running', 'attempts': job.attempts + 1})
+            self.env.cr.commit()
+            try:
+                if not job._run(deadline):
+                    skipped.append(job.id)
+            except Exception as e:
+                # Error inesperado: revertir el trabajo, marcarlo fallido y seguir con la cola
+                _logger.exception("TMS: error inesperado en trabajo de ruta %s", job.id)
+                self.env.cr.rollback()
+                job.write({'state': 'failed', 'error_message': str(e), 'date_done': fields.Datetime.now()})
+            if job.state in ('done', 'failed'):
+                tms_metrics.inc(self.env.cr.dbname, 'tms_route_jobs_total', {'state': job.state})
+            self.env.cr.commit()
+
+    @api.model
+    def _requeue_stale_jobs(self, job_ids=None):
+        """
+        Regresa a la cola los trabajos 'running' abandonados.
+
+        El cron publica 'running' con commit antes de llamar al proveedor; si
+        el worker muere después, nadie cierra el trabajo. Un trabajo vivo se
+        resuelve en segundos (timeout del proveedor), así que uno sin cambios
+        en ROUTE_JOB_STALE_MINUTES ya no tiene dueño.
+
+        :param job_ids: limitar a estos trabajos (None = toda la cola)
+        :return: ids de los trabajos regresados a la cola
+        """
+        self.env.cr.execute(SQL(
+            """
+            UPDATE tms_route_job
+               SET state = 'queued',
+                   error_message = %s,
+                   write_uid = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+             WHERE state = 'running'
+               AND write_date < NOW() AT TIME ZONE 'UTC' - make_interval(mins => %s)
+               %s
+            RETURNING id
+            """,
+            _("Trabajo abandonado (el worker se detuvo): se regresó a la cola."),
+            self.env.uid, ROUTE_JOB_STALE_MINUTES,
+            SQL("AND id = ANY(%s)", list(job_ids)) if job_ids is not None else SQL(),
+        ))
+        requeued = [row[0] for row in self.env.cr.fetchall()]
+        if requeued:
+            _logger.warning("TMS: %s trabajos de ruta abandonados regresados a la cola: %s", len(requeued), requeued)
+            self.browse(requeued).invalidate_recordset(['state', 'error_message'])
+        return requeued
+
+    def _try_lock_lane(self):
+        """
+        Advisory lock de transacción sobre el carril (se libera en el commit).
+
+        Debe ser la PRIMERA sentencia de la transacción: así la foto
+        (REPEATABLE READ) se toma después del commit de quien tuvo el lock
+        antes, y la búsqueda de la ruta ve lo que ese worker guardó.
+        """
+        self.ensure_one()
+        # La clave se lee en la misma sentencia (sin lecturas previas del ORM)
+        self.env.cr.execute(SQL(
+            """
+            SELECT pg_try_advisory_xact_lock(%s, hashtext(lane_key))
+              FROM tms_route_job
+             WHERE id = %s
+            """,
+            ROUTE_LANE_LOCK_NAMESPACE, self.id,
+        ))
+        return self.env.cr.fetchone()[0]
+
+    def _run(self, deadline=None):
+        """
+        Ejecuta un trabajo: lock del carril → proveedor → caché → viajes en espera.
+
+        :param deadline: time.monotonic() límite para la llamada al proveedor
+        :return: False si el trabajo vuelve a la cola (otro worker tiene el
+                 carril o se agotó el deadline)
+        """
+        self.ensure_one()
+        if not self._try_lock_lane():
+            self.write({'state': 'queued', 'attempts': self.attempts - 1})
+            return False
+
+        destination = self._find_destination()
+
+        # Otro worker (o el prefetch) ya calculó el carril desde que se encoló: compartir su resultado
+        if destination and destination.last_update and destination.last_update >= self.create_date.date():
+            result = {
+                'distance_km': destination.distance_km,
+                'duration_hours': destination.duration_hours,
+                'cost_tolls': destination.cost_tolls,
+            }
+        else:
+            try:
+                result = self.env['tms.route.provider'].with_context(tms_route_deadline=deadline)._compute_route(
+                    self.origin_zip, self.dest_zip, self.vehicle_type_id, self.company_id, self.provider,
+                    fallback=True)
+            except RouteProviderError:
+                # Solo 'deadline': se acabó el presupuesto del cron; no es un fallo del carril
+                _logger.info("TMS: presupuesto agotado en el carril %s; vuelve a la cola", self.lane_key)
+                self.write({'state': 'queued', 'attempts': self.attempts - 1})
+                return False
+            except UserError as e:
+                _logger.warning("TMS: cálculo de ruta %s → %s fallido: %s", self.origin_zip, self.dest_zip, e)
+                self.write({'state': 'failed', 'error_message': str(e), 'date_done': fields.Datetime.now()})
+                return True
+            if result['provider'] != self.provider:
+                # Respaldo (caché vencida o estimación local): se aplica a los viajes
+                # en espera, pero no se guarda como ruta del proveedor
+                self.write({
+                    'state': 'done',
+                    'error_message': _("Proveedor no disponible: resultado de respaldo (%s).") % result['provider'],
+                    'date_done': fields.Datetime.now(),
+                    'distance_km': result['distance_km'],
+                    'duration_hours': result['duration_hours'],
+                    'cost_tolls': result['cost_tolls'],
+                })
+                self.waybill_ids._apply_route_result(result)
+                return True
+            destination = self._save_destination(destination, result)
+            if not destination:
+                # Otra transacción guardó el carril después de nuestra foto (REPEATABLE READ):
+                # de vuelta a la cola; el siguiente intento ve su ruta y la comparte
+                self.write({'state': 'queued', 'attempts': self.attempts - 1})
+                return False
+
+        self.write({
+            'state': 'done',
+            'error_message': False,
+            'date_done': fields.Datetime.now(),
+            'destination_id': destination.id,
+            'distance_km': result['distance_km'],
+            'duration_hours': result['duration_hours'],
+            'cost_tolls': result['cost_tolls'],
+        })
+        self.waybill_ids._apply_route_result(result)
+        return True
+
+    def _find_destination(self):
+        """Ruta guardada del carril, incluidas las archivadas (también cuentan para unique_route)."""
+        self.ensure_one()
+        return self.env['tms.destination'].with_context(active_test=False).search([
+            ('company_id', '=', self.company_id.id),
+            ('origin_zip', '=', self.origin_zip),
+            ('dest_zip', '=', self.dest_zip),
+            ('vehicle_type_id', '=', self.vehicle_type_id.id),
+        ], limit=1)
+
+    def _save_destination(self, destination, result):
+        """
+        Guarda el resultado en tms.destination (upsert) dentro de un savepoint.
+
+        Con el lock del carril no debería haber duplicados; si aun así el
+        constraint unique_route rechaza el create (ej. una captura manual
+        simultánea), se actualiza la fila existente sin abortar el trabajo.
+
+        :return: la ruta guardada, o vacío si la fila en conflicto no es
+                 visible en la foto de esta transacción (se guardó después)
+        """
+        Destination = self.env['tms.destination']
+        route_vals = {
+            'distance_km': result['distance_km'],
+            'duration_hours': result['duration_hours'],
+            'cost_tolls': result['cost_tolls'],
+            'last_update': fields.Date.today(),
+        }
+        if not destination:
+            try:
+                with self.env.cr.savepoint():
+                    return Destination.create(dict(
+                        route_vals,
+                        company_id=self.company_id.id,
+                        origin_zip=self.origin_zip,
+                        dest_zip=self.dest_zip,
+                        vehicle_type_id=self.vehicle_type_id.id,
+                    ))
+            except IntegrityError:
+                destination = self._find_destination()
+                if not destination:
+                    _logger.info("TMS: carril %s guardado por otra transacción; se reintenta", self.lane_key)
+                    return destination
+        # Recálculo: nueva versión de la ruta
+        destination.write(dict(route_vals, version=destination.version + 1))
+        return destination
+
+    def action_retry(self):
+        """Regresa a la cola los trabajos fallidos y los 'running' abandonados."""
+        running = self.filtered(lambda job: job.state == 'running')
+        if running:
+            stuck = self._requeue_stale_jobs(running.ids)
+            if len(stuck) < len(running):
+                raise UserError(_(
+                    "El cálculo aún está en curso. Un trabajo se puede reintentar si lleva más de "
+                    "%s minutos sin avance.", ROUTE_JOB_STALE_MINUTES))
+        for job in self.filtered(lambda job: job.state == 'failed'):
+            try:
+                with self.env.cr.savepoint():
+                    job.write({'state': 'queued', 'error_message': False})
+            except IntegrityError:
+                pass  # Ya hay un cálculo pendiente del mismo carril
+        self.env.ref('tms.ir_cron_tms_route_jobs')._trigger()
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import re
+import statistics
+import time
+
+from odoo import models, api, _
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+
+from .tms_waybill_eta import ETA_DEFAULT_CIRCUITY
+from .tms_waybill_position import haversine_km
+from . import tms_metrics
+from .tms_route_http import RouteDeadlineError, RouteHttpError, get_breaker, get_breaker_states, post_json
+
+_logger = logging.getLogger(__name__)
+
+# Endpoint por defecto de Google Routes API (sobreescribible con 'tms.google_routes_url')
+GOOGLE_ROUTES_URL = "https://routes.googleapis.com/directions/v2:computeRoutes"
+
+# Código Postal mexicano (c_CodigoPostal): 5 dígitos
+CP_PATTERN = re.compile(r'^\d{5}$')
+
+# ============================================================
+# PARÁMETROS DEL PROVEEDOR LOCAL (sin red)
+# ============================================================
+
+# Rutas en caché usadas para aprender el factor carretera / línea recta
+LOCAL_CIRCUITY_SAMPLE = 200
+
+# Límites del factor aprendido (descarta CPs mal geolocalizados)
+LOCAL_MIN_CIRCUITY = 1.0
+LOCAL_MAX_CIRCUITY = 3.0
+
+# Velocidad de carretera por defecto (km/h) si la empresa aún no tiene rutas
+LOCAL_DEFAULT_SPEED_KMH = 60.0
+
+
+class RouteProviderError(Exception):
+    """
+    Error de un proveedor de rutas con red.
+
+    :param reason: 'invalid_cp' (CP mal formado o no reconocido),
+                   'no_route' (el proveedor no encontró ruta),
+                   'provider_error' (conexión, cuota, respuesta inválida),
+                   'circuit_open' (proveedor en pausa por errores recientes) o
+                   'deadline' (se agotó el tiempo de quien llama; no es fallo del carril)
+    """
+
+    def __init__(self, reason, detail=''):
+        super().__init__(detail or reason)
+        self.reason = reason
+        self.detail = detail
+
+
+def call_provider(dbname, provider, fetch, origin_zip, dest_zip):
+    """
+    Llama a un proveedor con red a través de su circuit breaker y registra
+    llamadas, latencia y casetas en tms_metrics. Función pura: segura para
+    llamarse desde hilos.
+
+    Solo los 'provider_error' abren el breaker: 'no_route' e 'invalid_cp'
+    son respuestas válidas del proveedor; 'deadline' no cuenta ni a favor
+    ni en contra.
+
+    :raises RouteProviderError: 'circuit_open' sin llamar si el breaker está abierto
+    """
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        tms_metrics.inc(dbname, 'tms_route_provider_calls_total', {'provider': provider, 'result': 'circuit_open'})
+        raise RouteProviderError('circuit_open', provider)
+    start = time.monotonic()
+    try:
+        result = fetch(origin_zip, dest_zip)
+    except RouteProviderError as e:
+        if e.reason == 'deadline':
+            breaker.release()
+        else:
+            breaker.record(e.reason != 'provider_error')
+        tms_metrics.observe(dbname, 'tms_route_provider_latency_ms', (time.monotonic() - start) * 1000.0,
+                            {'provider': provider})
+        tms_metrics.inc(dbname, 'tms_route_provider_calls_total', {'provider': provider, 'result': e.reason})
+        raise
+    breaker.record(True)
+    tms_metrics.observe(dbname, 'tms_route_provider_latency_ms', (time.monotonic() - start) * 1000.0,
+                        {'provider': provider})
+    tms_metrics.inc(dbname, 'tms_route_provider_calls_total', {'provider': provider, 'result': 'ok'})
+    tms_metrics.inc(dbname, 'tms_route_provider_tolls_total', {'provider': provider}, result['cost_tolls'])
+    return result
+
+
+def fetch_google_route(url, api_key, origin_zip, dest_zip, deadline=None):
+    """
+    Consulta Google Routes API (v1:computeRoutes): Distancia, Tiempo y PEAJES.
+
+    Función pura (sin env ni cursor): segura para llamarse desde hilos.
+    Usa la sesión HTTP compartida del worker (keep-alive + reintentos).
+
+    :param deadline: time.monotonic() límite para la llamada y sus reintentos
+    :return: dict con distance_km, duration_hours, cost_tolls
+    :raises RouteProviderError: si no hay ruta o falla el proveedor
+    """
+    # CP mexicano: 5 dígitos. Uno mal formado no se envía al proveedor
+    for zip_code in (origin_zip, dest_zip):
+        if not CP_PATTERN.match(zip_code or ''):
+            raise RouteProviderError('invalid_cp', zip_code or '')
+
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Goog-Api-Key': api_key,
+        'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.travelAdvisory.tollInfo'
+    }
+
+    # Body del request
+    # Usamos CP, País para origen/destino
+    payload = {
+        "origin": {"address": f"postal code {origin_zip}, Mexico"},
+        "destination": {"address": f"postal code {dest_zip}, Mexico"},
+        "travelMode": "DRIVE",
+        "routingPreference": "TRAFFIC_AWARE",
+        "extraComputations": ["TOLLS"],
+        # TODO: Agregar routeModifiers para vehicle info si Google lo soporta en Mexico (emissionType, etc)
+        # Por ahora básico.
+    }
+
+    try:
+        _status, data = post_json(url, payload, headers, deadline=deadline)
+    except RouteDeadlineError as e:
+        raise RouteProviderError('deadline', str(e)) from e
+    except RouteHttpError as e:
+        raise RouteProviderError('provider_error', str(e)) from e
+
+    if 'error' in data:
+        # INVALID_ARGUMENT: Google no pudo interpretar el origen/destino
+        reason = 'invalid_cp' if data['error'].get('status') == 'INVALID_ARGUMENT' else 'provider_error'
+        raise RouteProviderError(reason, data['error'].get('message') or '')
+
+    if not data.get('routes'):
+        raise RouteProviderError('no_route')
+
+    route = data['routes'][0]
+
+    # Extraer datos
+    distance_km = route.get('distanceMeters', 0) / 1000.0
+    duration_hours = int(route.get('duration', '0s').replace('s', '')) / 3600.0
+
+    # Peajes (Tolls)
+    toll_cost = 0.0
+    if route.get('travelAdvisory') and route.get('travelAdvisory').get('tollInfo'):
+        toll_info = route['travelAdvisory']['tollInfo']
+        # Google puede devolver múltiples monedas; normalmente la moneda local del trayecto.
+        # Estimación de precio es 'estimatedPrice'.
+        for price in toll_info.get('estimatedPrice', []):
+            # Sumar si es MXN. Simplificamos asumiendo MXN para Mexico.
+            if price.get('currencyCode') == 'MXN':
+                toll_cost += float(price.get('units', 0)) + (price.get('nanos', 0) / 1e9)
+
+    return {
+        'distance_km': distance_km,
+        'duration_hours': duration_hours,
+        'cost_tolls': toll_cost,
+    }
+
+
+class TmsRouteProvider(models.AbstractModel):
+    """
+    Proveedores de Cálculo de Rutas (Interfaz Intercambiable).
+
+    CONCEPTO: Un punto único para calcular Distancia, Duración y Casetas entre
+    dos CPs. Cada proveedor es un método _route_<codigo> con la misma firma:
+
+        _route_<codigo>(origin_zip, dest_zip, vehicle_type, company)
+            -> dict(distance_km, duration_hours, cost_tolls)
+
+    PROVEEDORES:
+    - google: Google Routes API (red, con casetas). Se ejecuta en la cola
+      (tms.route.job), nunca en el request HTTP.
+    - local:  Sin red. Línea recta entre centroides de CP (c_CodigoPostal)
+      por un factor carretera aprendido de las rutas en caché de la empresa.
+      Cotización instantánea aunque Google esté lento o caído.
+
+    El proveedor activo se configura en Ajustes ('tms.route_provider').
+    """
+
+    _name = 'tms.route.provider'
+    _description = 'Proveedor de Cálculo de Rutas'
+
+    @api.model
+    def _get_provider(self):
+        """
+        Proveedor activo. 'std' (valor por defecto histórico) conserva el
+        comportamiento original: Google Routes API.
+        """
+        provider = self.env['ir.config_parameter'].sudo().get_param('tms.route_provider') or 'std'
+        return 'google' if provider == 'std' else provider
+
+    @api.model
+    def _is_offline(self, provider):
+        """Proveedores sin red: se ejecutan en línea, sin pasar por la cola."""
+        return provider == 'local'
+
+    @api.model
+    def _is_available(self, provider):
+        """False si el circuit breaker del proveedor está abierto en este worker."""
+        return self._is_offline(provider) or get_breaker(provider).state != 'open'
+
+    @api.model
+    def _get_provider_stats(self):
+        """
+        Llamadas, errores, latencia y estado del breaker por proveedor (este worker).
+
+        :return: dict {proveedor: {calls, errors, rejected, avg_ms, p95_ms, tolls, breaker}}
+        """
+        dbname = self.env.cr.dbname
+        counters, histograms = tms_metrics.snapshot(dbname)
+        breakers = get_breaker_states()
+        stats = {}
+        for (name, labels), value in counters.items():
+            labels = dict(labels)
+            if name != 'tms_route_provider_calls_total':
+                continue
+            entry = stats.setdefault(labels['provider'], {'calls': 0, 'errors': 0, 'rejected': 0})
+            if labels['result'] == 'circuit_open':
+                entry['rejected'] += int(value)
+                continue
+            entry['calls'] += int(value)
+            if labels['result'] == 'provider_error':
+                entry['errors'] += int(value)
+        for provider, entry in stats.items():
+            latency = histograms.get(('tms_route_provider_latency_ms', (('provider', provider),)))
+            entry.update({
+                'avg_ms': latency[-1] / latency[-2] if latency and latency[-2] else 0.0,
+                'p95_ms': tms_metrics.histogram_quantile(latency, 0.95) if latency else 0.0,
+                'tolls': tms_metrics.get_counter(dbname, 'tms_route_provider_tolls_total', {'provider': provider}),
+                'breaker': breakers.get(provider, 'closed'),
+            })
+        return stats
+
+    @api.model
+    def _get_metric_gauges(self):
+        """Métricas instantáneas para Prometheus: breaker abierto (1) o no (0) por proveedor."""
+        return {
+            ('tms_route_provider_breaker_open', (('provider', provider),)): int(state == 'open')
+            for provider, state in get_breaker_states().items()
+        }
+
+    @api.model
+    def _compute_route(self, origin_zip, dest_zip, vehicle_type, company, provider=None, fallback=False):
+        """
+        Calcula una ruta con el proveedor indicado (o el configurado).
+
+        :param fallback: si el proveedor con red falla o su breaker está
+                         abierto, responder con la caché (aunque esté vencida)
+                         o con la estimación local
+
+        Contexto 'tms_route_deadline': time.monotonic() límite para la llamada
+        al proveedor (timeouts y reintentos se recortan a él).
+        :return: dict con distance_km, duration_hours, cost_tolls y provider
+                 (quién respondió: el proveedor, 'cache' o 'local')
+        :raises UserError: si el proveedor no existe o no encuentra ruta
+                           (el fallo queda en la caché negativa, tms.route.failure)
+        :raises RouteProviderError: 'deadline' si se agotó el tiempo (sin
+                                    registrar fallo ni usar el respaldo)
+        """
+        provider = provider or self._get_provider()
+        method = getattr(self, '_route_%s' % provider, None)
+        if not method:
+            raise UserError(_("Proveedor de rutas desconocido: %s") % provider)
+
+        # Caché negativa: un carril que falló recientemente no vuelve al proveedor
+        Failure = self.env['tms.route.failure']
+        Failure._check_lane(company, origin_zip, dest_zip, vehicle_type)
+        try:
+            return dict(method(origin_zip, dest_zip, vehicle_type, company), provider=provider)
+        except RouteProviderError as e:
+            if e.reason == 'deadline':
+                raise
+            if e.reason != 'circuit_open':
+                Failure._record_failure(company, origin_zip, dest_zip, vehicle_type, e.reason, e.detail)
+            if fallback and e.reason in ('provider_error', 'circuit_open'):
+                result = self._fallback_route(origin_zip, dest_zip, vehicle_type, company)
+                if result:
+                    return result
+            raise UserError(self._get_error_message(e, origin_zip, dest_zip)) from e
+
+    @api.model
+    def _fallback_route(self, origin_zip, dest_zip, vehicle_type, company):
+        """
+        Respuesta de respaldo cuando el proveedor con red no está disponible:
+        1. La ruta en caché, aunque esté vencida
+        2. La estimación local (sin red)
+
+        :return: dict de ruta (provider = 'cache' o 'local') o None
+        """
+        route, status = self.env['tms.destination']._lookup_route(company, origin_zip, dest_zip, vehicle_type)
+        if route:
+            return {
+                'distance_km': route['distance_km'],
+                'duration_hours': route['duration_hours'],
+                'cost_tolls': route['cost_tolls'],
+                'provider': 'cache',
+            }
+        try:
+            return dict(self._route_local(origin_zip, dest_zip, vehicle_type, company), provider='local')
+        except UserError:
+            return None
+
+    # ============================================================
+    # PROVEEDOR: GOOGLE ROUTES API
+    # ============================================================
+
+    @api.model
+    def _get_remote_fetcher(self, provider):
+        """
+        Función de consulta SIN env para un proveedor con red.
+
+        Lee la configuración una vez y la encapsula: la función resultante se
+        puede llamar desde hilos (prefetch concurrente) porque no toca el
+        cursor ni el ORM. Pasa por el circuit breaker del proveedor.
+
+        :return: callable(origin_zip, dest_zip) -> dict, o None si el proveedor
+                 no usa red
+        """
+        if provider != 'google':
+            return None
+        ICPSudo = self.env['ir.config_parameter'].sudo()
+        api_key = ICPSudo.get_param('tms.google_maps_api_key')
+        if not api_key:
+            raise UserError(_("Falta API Key de Google Maps en Ajustes."))
+        url = ICPSudo.get_param('tms.google_routes_url') or GOOGLE_ROUTES_URL
+        return functools.partial(
+            call_provider, self.env.cr.dbname, provider, functools.partial(
+                fetch_google_route, url, api_key, deadline=self.env.context.get('tms_route_deadline')))
+
+    @api.model
+    def _route_google(self, origin_zip, dest_zip, vehicle_type, company):
+        """
+        Google Routes API (v1:computeRoutes) para Distancia, Tiempo y PEAJES.
+
+        Se llama SOLO desde procesos en segundo plano (cola, prefetch), nunca desde la UI.
+        """
+        return self._get_remote_fetcher('google')(origin_zip, dest_zip)
+
+    @api.model
+    def _get_error_message(self, error, origin_zip, dest_zip):
+        """Mensaje traducido de un RouteProviderError."""
+        if error.reason == 'no_route':
+            return _("El proveedor no encontró ruta entre %s y %s") % (origin_zip, dest_zip)
+        if error.reason == 'invalid_cp':
+            return _("Código Postal inválido o no reconocido por el proveedor: %s") % error.detail
+        if error.reason == 'circuit_open':
+            return _("El proveedor de rutas %s no está disponible temporalmente por errores recientes.") % error.detail
+        return _("Error del proveedor de rutas: %s") % error.detail
+
+    # ============================================================
+    # PROVEEDOR: LOCAL (sin red)
+    # ============================================================
+
+    @api.model
+    def _route_local(self, origin_zip, dest_zip, vehicle_type, company):
+        """
+        Estimación instantánea sin red:
+
+            distancia = haversine(centroide CP origen, centroide CP destino) × factor carretera
+            duración  = distancia / velocidad promedio de las rutas en caché
+
+        Las casetas no se pueden estimar sin proveedor: se devuelven en 0.
+        """
+        centroids = self.env['tms.sat.codigo.postal']._get_centroids({origin_zip, dest_zip})
+        origin, dest = centroids.get(origin_zip), centroids.get(dest_zip)
+        if not origin or not dest:
+            raise UserError(_(
+                "Sin coordenadas para el CP %s en el catálogo c_CodigoPostal. "
+                "Cargue latitud/longitud del CP o use otro proveedor."
+            ) % (dest_zip if origin else origin_zip))
+
+        circuity, speed_kmh = self._get_local_profile(company.id)
+        distance_km = haversine_km(origin[0], origin[1], dest[0], dest[1]) * circuity
+        return {
+            'distance_km': distance_km,
+            'duration_hours': distance_km / speed_kmh,
+            'cost_tolls': 0.0,
+        }
+
+    @api.model
+    def _get_local_profile(self, company_id):
+        """
+        Aprende de las rutas en caché de la empresa (tms.destination):
+        - Factor carretera: mediana de distancia real / línea recta
+        - Velocidad: mediana de distancia / duración
+
+        Dos consultas (rutas recientes + centroides de sus CPs).
+
+        :return: (circuity, speed_kmh)
+        """
+        self.env.cr.execute(SQL(
+            """
+            SELECT origin_zip, dest_zip, distance_km, duration_hours
+              FROM tms_destination
+             WHERE company_id = %s
+               AND active
+               AND distance_km > 0
+             ORDER BY last_update DESC NULLS LAST, id DESC
+             LIMIT %s
+            """,
+            company_id, LOCAL_CIRCUITY_SAMPLE,
+        ))
+        routes = self.env.cr.fetchall()
+        centroids = self.env['tms.sat.codigo.postal']._get_centroids(
+            {zip_code for route in routes for zip_code in route[:2]})
+
+        ratios, speeds = [], []
+        for origin_zip, dest_zip, distance_km, duration_hours in routes:
+            if duration_hours and duration_hours > 0:
+                speeds.append(distance_km / duration_hours)
+            origin, dest = centroids.get(origin_zip), centroids.get(dest_zip)
+            if not origin or not dest:
+                continue
+            straight_km = haversine_km(origin[0], origin[1], dest[0], dest[1])
+            if straight_km > 1.0:
+                ratio = distance_km / straight_km
+                if LOCAL_MIN_CIRCUITY <= ratio <= LOCAL_MAX_CIRCUITY:
+                    ratios.append(ratio)
+
+        circuity = statistics.median(ratios) if ratios else ETA_DEFAULT_CIRCUITY
+        speed_kmh = statistics.median(speeds) if speeds else LOCAL_DEFAULT_SPEED_KMH
+        return circuity, speed_kmh
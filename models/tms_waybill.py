@@ -1,12 +1,62 @@
 # -*- coding: utf-8 -*-
+import base64
 import logging
-import requests
 import json
+from datetime import datetime, timezone
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError, AccessError, MissingError
+from odoo.tools import SQL
+from markupsafe import Markup
+
+from .tms_waybill_eta import ETA_DEFAULT_CIRCUITY, update_eta
+from .tms_waybill_quote import QUOTE_INPUT_COLUMNS, QUOTE_OUTPUT_COLUMNS, compute_quotes
+from .tms_waybill_position import (
+    decode_track, encode_track, haversine_km, simplify_track, track_distance_km,
+)
 
 _logger = logging.getLogger(__name__)
 
+# ============================================================
+# API APP MÓVIL: STATUS REPORTADOS
+# ============================================================
+# Status válidos que puede reportar la app
+DRIVER_REPORT_STATUSES = ('arrived_origin', 'started_route', 'arrived_dest', 'tracking')
+
+# Status de la app → estado del viaje (tracking no cambia estado)
+DRIVER_REPORT_STATES = {
+    'started_route': 'in_transit',
+    'arrived_dest': 'arrived',
+}
+
+# ============================================================
+# RECOTIZACIÓN MASIVA
+# ============================================================
+# Estados en los que una cotización todavía se puede recotizar
+REQUOTE_STATES = ('draft', 'en_pedido')
+
+# Valores por defecto sin índice de precios / sin rendimiento del vehículo
+FUEL_PRICE_DEFAULT = 24.00
+FUEL_PERFORMANCE_DEFAULT = 2.5
+
+# Orden del workflow: los reportes de la app solo pueden avanzar el estado
+STATE_RANK = {
+    'draft': 0,
+    'en_pedido': 1,
+    'assigned': 2,
+    'waybill': 3,
+    'in_transit': 4,
+    'arrived': 5,
+    'closed': 6,
+    'cancel': 7,
+    'rejected': 7,
+}
+
+# Estados de cierre de viaje: al entrar a ellos se compacta la trayectoria
+TRACK_COMPACT_STATES = ('arrived', 'closed')
+
+# Histéresis de salida de geocerca: salir exige alejarse radio * factor
+GEOFENCE_EXIT_FACTOR = 1.5
+
 
 class TmsWaybill(models.Model):
     """
@@ -287,6 +337,24 @@ class TmsWaybill(models.Model):
         help='Selecciona una ruta frecuente para auto-completar origen, destino, distancia y duración'
     )
 
+    # Many2one: último cálculo de ruta encolado (tms.route.job)
+    # La UI consulta su estado en lugar de esperar a Google
+    route_job_id = fields.Many2one(
+        'tms.route.job',
+        string='Cálculo de Ruta',
+        copy=False,
+        readonly=True,
+        ondelete='set null',
+    )
+    route_job_state = fields.Selection(
+        related='route_job_id.state',
+        string='Estado del Cálculo',
+    )
+    route_job_error = fields.Text(
+        related='route_job_id.error_message',
+        string='Error del Cálculo',
+    )
+
     # ============================================================
     # SELECTOR INTELIGENTE DE RUTAS
     # ============================================================
@@ -433,11 +501,15 @@ class TmsWaybill(models.Model):
     )
 
     # ===== TRACKING EN TIEMPO REAL (Solo App) =====
+    # IMPORTANTE: Ya NO se guardan en tms_waybill. Se derivan de la bitácora
+    # tms.waybill.position (solo inserción), así cada ping es un INSERT angosto
+    # y no un UPDATE sobre esta tabla (ancha, indexada y con tracking).
 
     # Float: última latitud reportada por la app
     last_app_lat = fields.Float(
         string='Última Latitud (App)',
         digits=(12, 8),
+        compute='_compute_last_app_position',
         help='Última posición GPS reportada por la app móvil'
     )
 
@@ -445,27 +517,239 @@ class TmsWaybill(models.Model):
     last_app_long = fields.Float(
         string='Última Longitud (App)',
         digits=(12, 8),
+        compute='_compute_last_app_position',
         help='Última posición GPS reportada por la app móvil'
     )
 
     # Datetime: última actualización de posición
     last_report_date = fields.Datetime(
         string='Última Actualización GPS',
+        compute='_compute_last_app_position',
         help='Última vez que la app reportó posición'
     )
 
+    def _compute_last_app_position(self):
+        """
+        Última posición de la bitácora GPS.
+        Una sola consulta (DISTINCT ON) para todo el recordset.
+        """
+        latest = self.env['tms.waybill.position']._get_latest_positions(
+            [record._origin.id for record in self if record._origin.id])
+        for record in self:
+            position = latest.get(record._origin.id)
+            if record.track_packed:
+                # Viaje compactado: la última posición es el último punto empaquetado,
+                # salvo que llegue un punto crudo posterior (un reporte tardío más viejo no la mueve)
+                packed_date, packed_lat, packed_long = record._get_packed_track()[-1]
+                if not position or position[2] <= packed_date:
+                    position = (packed_lat, packed_long, packed_date)
+            if position:
+                lat, long, report_date = position
+            else:
+                lat, long, report_date = 0.0, 0.0, False
+            record.last_app_lat = lat
+            record.last_app_long = long
+            record.last_report_date = report_date
+
+    # ===== ETA EN VIVO (Solo App) =====
+    # Se leen de tms.waybill.eta (fila angosta por viaje, ver _update_etas)
+
+    # Datetime: hora estimada de llegada
+    eta_date = fields.Datetime(
+        string='ETA',
+        compute='_compute_eta',
+        help='Hora estimada de llegada a destino según los últimos pings de la app'
+    )
+
+    # Float: km restantes estimados
+    eta_remaining_km = fields.Float(
+        string='Km Restantes',
+        digits=(10, 2),
+        compute='_compute_eta',
+    )
+
+    # Float: velocidad promedio reciente
+    eta_speed_kmh = fields.Float(
+        string='Velocidad Promedio (Km/h)',
+        digits=(10, 2),
+        compute='_compute_eta',
+    )
+
+    # ===== TRAYECTORIA COMPACTADA (Viajes cerrados) =====
+    # Al llegar a destino / cerrar, la bitácora cruda se simplifica
+    # (Douglas-Peucker) y se empaqueta (deltas + varint) en un solo campo.
+
+    # Binary: trayectoria empaquetada (ver encode_track)
+    track_packed = fields.Binary(
+        string='Trayectoria Compactada',
+        attachment=False,
+        copy=False,
+        readonly=True,
+        help='Trayectoria simplificada y empaquetada al cerrar el viaje'
+    )
+
+    # Integer: puntos crudos antes de compactar
+    track_raw_points = fields.Integer(
+        string='Puntos GPS Reportados',
+        copy=False,
+        readonly=True,
+    )
+
+    # Integer: puntos conservados tras la simplificación
+    track_packed_points = fields.Integer(
+        string='Puntos GPS Conservados',
+        copy=False,
+        readonly=True,
+    )
+
+    # Float: distancia recorrida (calculada con TODOS los puntos crudos)
+    track_distance_km = fields.Float(
+        string='Distancia Recorrida (Km)',
+        digits=(10, 2),
+        copy=False,
+        readonly=True,
+        help='Distancia real recorrida según GPS (antes de simplificar)'
+    )
+
+    def _get_packed_track(self):
+        """Decodifica track_packed → lista de (report_date, lat, long)."""
+        self.ensure_one()
+        if not self.track_packed:
+            return []
+        return decode_track(base64.b64decode(self.track_packed))
+
+    def _compact_trajectory(self):
+        """
+        Compacta la bitácora GPS de los viajes cerrados.
+
+        1. Lee los puntos crudos y los mezcla, por hora, con la trayectoria
+           ya compactada (si existe)
+        2. Calcula la distancia recorrida con todos los puntos
+        3. Simplifica (Douglas-Peucker) con la tolerancia configurada
+        4. Empaqueta en track_packed y libera las filas crudas (se conservan
+           solo los event_id, ver _purge_waybill_positions)
+        """
+        Position = self.env['tms.waybill.position']
+        tolerance_m = float(self.env['ir.config_parameter'].sudo().get_param(
+            'tms.track_simplify_tolerance_m', 25.0))
+        compacted = self.browse()
+        for record in self:
+            raw = Position._get_track(record.id)
+            if not raw:
+                continue
+            # Los puntos tardíos (reportes offline) pueden ser anteriores al último empaquetado
+            points = sorted(record._get_packed_track() + raw, key=lambda point: point[0])
+            simplified = simplify_track(points, tolerance_m)
+            distance_km = track_distance_km(points)
+            record.write({
+                'track_packed': base64.b64encode(encode_track(simplified)),
+                'track_raw_points': record.track_raw_points + len(raw),
+                'track_packed_points': len(simplified),
+                'track_distance_km': distance_km,
+            })
+            record._record_lane_speed(distance_km)
+            compacted |= record
+        Position._purge_waybill_positions(compacted.ids)
+        self.invalidate_recordset(['last_app_lat', 'last_app_long', 'last_report_date'])
+        return compacted
+
+    def _record_lane_speed(self, distance_km):
+        """Alimenta el perfil histórico de velocidad del carril (para la ETA)."""
+        self.ensure_one()
+        if not (self.date_started_route and self.date_arrived_dest) or self.state != 'arrived':
+            return
+        hours = (self.date_arrived_dest - self.date_started_route).total_seconds() / 3600.0
+        if hours <= 0 or distance_km <= 0:
+            return
+        # Aprender la velocidad nunca debe abortar la ingesta del reporte del chofer
+        try:
+            with self.env.cr.savepoint():
+                # sudo: el chofer no lee necesariamente vehículos ni contactos
+                waybill = self.sudo()
+                self.env['tms.destination']._record_trip_speed(
+                    waybill.company_id.id,
+                    waybill.origin_zip or waybill.partner_origin_id.zip,
+                    waybill.dest_zip or waybill.partner_dest_id.zip,
+                    waybill.vehicle_id.tms_vehicle_type_id.id,
+                    distance_km / hours,
+                )
+        except Exception:
+            _logger.exception("TMS: no se pudo registrar la velocidad del carril del viaje %s", self.id)
+
+    def get_trajectory(self):
+        """
+        API de lectura de trayectoria (portal / back office / app).
+
+        Combina la trayectoria compactada con los puntos crudos aún no
+        compactados. Retorna una lista de dicts en orden cronológico:
+        [{'timestamp': 'YYYY-MM-DD HH:MM:SS', 'lat': float, 'long': float}, ...]
+        """
+        self.ensure_one()
+        points = sorted(
+            self._get_packed_track() + self.env['tms.waybill.position']._get_track(self.id),
+            key=lambda point: point[0])
+        return [{
+            'timestamp': fields.Datetime.to_string(report_date),
+            'lat': lat,
+            'long': long,
+        } for report_date, lat, long in points]
+
+    def action_view_positions(self):
+        """Abre la bitácora GPS (breadcrumbs) del viaje."""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Bitácora GPS - %s') % self.name,
+            'res_model': 'tms.waybill.position',
+            'view_mode': 'list',
+            'domain': [('waybill_id', '=', self.id), ('compacted', '=', False)],
+            'context': {'create': False, 'edit': False},
+        }
+
     # ============================================================
     # MONTOS Y COSTOS
     # ============================================================
 
     # Monetary: valor del viaje (monto a cobrar)
+    # Se calcula de la propuesta seleccionada (editable); almacenado e indexado para reportes
     amount_total = fields.Monetary(
         string='Valor del Viaje',
         currency_field='currency_id',
+        compute='_compute_amount_total',
+        store=True,
+        readonly=False,
+        index=True,
         tracking=True,
         help='Monto total a cobrar por el servicio'
     )
 
+    # Costos totales y margen (almacenados e indexados: dashboards y análisis de margen en SQL)
+    cost_total = fields.Monetary(
+        string='Costo Total',
+        currency_field='currency_id',
+        compute='_compute_margin',
+        store=True,
+        index=True,
+        help='Diesel + Casetas + Chofer + Maniobras + Otros'
+    )
+    margin_amount = fields.Monetary(
+        string='Margen',
+        currency_field='currency_id',
+        compute='_compute_margin',
+        store=True,
+        index=True,
+        help='Valor del Viaje - Costo Total'
+    )
+    margin_percent = fields.Float(
+        string='Margen (%)',
+        digits=(10, 2),
+        compute='_compute_margin',
+        store=True,
+        index=True,
+        aggregator='avg',
+        help='Margen / Valor del Viaje'
+    )
+
     # ==========================================
     # API EXTERNA: CÁLCULO DE RUTA (GOOGLE ROUTES API + CACHÉ)
     # ==========================================
@@ -473,9 +757,16 @@ class TmsWaybill(models.Model):
         """
         Método inteligente:
         1. Busca en caché (tms.destination) por CP Origen + CP Destino + Tipo Vehículo.
-        2. Si encuentra y es reciente (< 6 meses), usa eso.
-        3. Si no, llama a Google Maps Routes API (con Peajes).
-        4. Guarda/Actualiza el resultado en tms.destination.
+        2. Si encuentra y está vigente (TTL de la empresa), usa eso de inmediato.
+           Si está vencida y la empresa lo permite, la usa y la recalcula en
+           segundo plano (stale-while-revalidate).
+        3. Si no, usa el proveedor configurado (tms.route.provider):
+           - Sin red (local): estima en línea y actualiza el viaje al instante.
+           - Con red (google): ENCOLA el cálculo (tms.route.job) y regresa sin esperar.
+             El cron llama al proveedor, guarda en tms.destination y actualiza el viaje.
+
+        El request HTTP nunca espera al proveedor: un worker de Odoo no debe
+        quedar bloqueado hasta 15 segundos por clic.
         """
         self.ensure_one()
 
@@ -485,115 +776,87 @@ class TmsWaybill(models.Model):
 
         origin_zip = self.partner_origin_id.zip
         dest_zip = self.partner_dest_id.zip
-        vehicle_type = self.vehicle_id.vehicle_type_id # Asumiendo que fleet.vehicle tiene vehicle_type_id relacionado a tms.vehicle.type
-
-        # 1. BUSCAR EN CACHÉ
-        cached_route = self.env['tms.destination'].search([
-            ('company_id', '=', self.company_id.id),
-            ('origin_zip', '=', origin_zip),
-            ('dest_zip', '=', dest_zip),
-            ('vehicle_type_id', '=', vehicle_type.id if vehicle_type else False)
-        ], limit=1)
-
-        # Si existe y es válida (ej. < 6 meses), usarla
-        # TODO: Agregar chequeo de fecha si se desea forzar expiración aquí,
-        # pero el usuario pidió un cron separado para re-calcular las viejas.
-        # Por ahora, si existe, la usamos.
-        if cached_route:
-             self.write({
-                'distance_km': cached_route.distance_km,
-                'duration_hours': cached_route.duration_hours,
-                'cost_tolls': cached_route.toll_cost, # Costo de casetas guardado
+        vehicle_type = self.vehicle_id.tms_vehicle_type_id
+
+        Provider = self.env['tms.route.provider']
+        provider = Provider._get_provider()
+
+        # 1. BUSCAR EN CACHÉ (con vigencia por empresa)
+        cached_route, status = self.env['tms.destination']._lookup_route(
+            self.company_id, origin_zip, dest_zip, vehicle_type)
+
+        # Vigente, o vencida con "usar mientras se recalcula": respuesta inmediata
+        serve_stale = self.company_id.tms_route_cache_serve_stale or Provider._is_offline(provider)
+        if status == 'hit' or (status == 'stale' and serve_stale):
+            self.write({
+                'distance_km': cached_route['distance_km'],
+                'duration_hours': cached_route['duration_hours'],
+                'cost_tolls': cached_route['cost_tolls'],
                 'extra_distance_km': 0.0,
             })
-             return self._notify_success("Datos obtenidos de Caché interno.", cached_route.distance_km, cached_route.duration_hours, cached_route.toll_cost)
-
-        # 2. SI NO EXISTE -> API
-        return self._fetch_google_routes_api(origin_zip, dest_zip, vehicle_type)
-
-    def _fetch_google_routes_api(self, origin_zip, dest_zip, vehicle_type):
-        """Consumo directo de Routes API (v1:computeRoutes) para Distancia, Tiempo y PEAJES"""
-        ICPSudo = self.env['ir.config_parameter'].sudo()
-        api_key = ICPSudo.get_param('tms.google_maps_api_key')
-
-        if not api_key:
-            raise UserError(_("Falta API Key de Google Maps en Ajustes."))
-
-        # Endpoint Routes API (POST)
-        url = "https://routes.googleapis.com/directions/v2:computeRoutes"
-
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Goog-Api-Key': api_key,
-            'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.travelAdvisory.tollInfo'
-        }
+            source = _("Caché interno")
+            if status == 'stale' and not Provider._is_offline(provider):
+                # Stale-while-revalidate: recálculo en segundo plano, sin esperar
+                self.env['tms.route.job']._enqueue(self.company_id, origin_zip, dest_zip, vehicle_type, provider)
+                source = _("Caché vencida, recalculando")
+            return self._notify_success(source, cached_route['distance_km'], cached_route['duration_hours'], cached_route['cost_tolls'])
+
+        # 2. SI NO EXISTE (o está vencida) -> PROVEEDOR
+        # Caché negativa: un carril que falló recientemente falla aquí, sin encolar
+        self.env['tms.route.failure']._check_lane(self.company_id, origin_zip, dest_zip, vehicle_type)
+        if Provider._is_offline(provider) or not Provider._is_available(provider):
+            # Sin red, o proveedor en pausa (circuit breaker): respuesta inmediata
+            if Provider._is_offline(provider):
+                result = Provider._compute_route(origin_zip, dest_zip, vehicle_type, self.company_id, provider)
+            else:
+                result = Provider._fallback_route(origin_zip, dest_zip, vehicle_type, self.company_id)
+                if not result:
+                    raise UserError(_("El proveedor de rutas no está disponible temporalmente. Intente más tarde o capture la distancia manualmente."))
+            self.write({
+                'distance_km': result['distance_km'],
+                'duration_hours': result['duration_hours'],
+                'cost_tolls': result['cost_tolls'],
+                'extra_distance_km': 0.0,
+            })
+            source = _("Caché interno") if result['provider'] == 'cache' else _("Estimación local")
+            return self._notify_success(source, result['distance_km'], result['duration_hours'], result['cost_tolls'])
 
-        # Body del request
-        # Usamos CP, País para origen/destino
-        payload = {
-            "origin": {"address": f"postal code {origin_zip}, Mexico"},
-            "destination": {"address": f"postal code {dest_zip}, Mexico"},
-            "travelMode": "DRIVE",
-            "routingPreference": "TRAFFIC_AWARE",
-            "extraComputations": ["TOLLS"],
-            # TODO: Agregar routeModifiers para vehicle info si Google lo soporta en Mexico (emissionType, etc)
-            # Por ahora básico.
+        # 3. PROVEEDOR CON RED -> COLA (sin llamada de red en este request)
+        job = self.env['tms.route.job']._enqueue(self.company_id, origin_zip, dest_zip, vehicle_type, provider, self)
+        self.route_job_id = job
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Cálculo de Ruta en Cola'),
+                'message': _('La ruta %s → %s se calcula en segundo plano. El viaje se actualizará al terminar.') % (origin_zip, dest_zip),
+                'sticky': False,
+                'type': 'info',
+            }
         }
 
-        try:
-            response = requests.post(url, json=payload, headers=headers, timeout=15)
-            data = response.json()
-        except Exception as e:
-            raise UserError(_("Error de conexión: %s") % str(e))
-
-        if 'error' in data:
-            raise UserError(_("Google API Error: %s") % data['error'].get('message'))
-
-        if not data.get('routes'):
-            raise UserError(_("Google no encontró ruta entre %s y %s") % (origin_zip, dest_zip))
-
-        route = data['routes'][0]
-
-        # Extraer datos
-        distance_meters = route.get('distanceMeters', 0)
-        distance_km = distance_meters / 1000.0
-
-        duration_seconds = int(route.get('duration', '0s').replace('s', ''))
-        duration_hours = duration_seconds / 3600.0
-
-        # Peajes (Tolls)
-        toll_cost = 0.0
-        if route.get('travelAdvisory') and route.get('travelAdvisory').get('tollInfo'):
-            toll_info = route['travelAdvisory']['tollInfo']
-            # Google puede devolver múltiples monedas, asumimos MXN o convertimos si es necesario?
-            # Normalmente devuelve la moneda local del trayecto.
-            # Estimación de precio es 'estimatedPrice'.
-            for price in toll_info.get('estimatedPrice', []):
-                # Sumar si es MXN, o convertir. Simplificamos asumiendo MXN para Mexico.
-                if price.get('currencyCode') == 'MXN':
-                     toll_cost += float(price.get('units', 0)) + (price.get('nanos', 0) / 1e9)
-
-        # 3. GUARDAR EN CACHÉ (tms.destination)
-        self.env['tms.destination'].create({
-            'company_id': self.company_id.id,
-            'origin_zip': origin_zip,
-            'dest_zip': dest_zip,
-            'vehicle_type_id': vehicle_type.id if vehicle_type else False,
-            'distance_km': distance_km,
-            'duration_hours': duration_hours,
-            'toll_cost': toll_cost,
-            'last_update': fields.Date.today()
-        })
+    def _apply_route_result(self, result):
+        """
+        Aplica el resultado de un trabajo de ruta (tms.route.job) a los viajes en espera.
 
-        # 4. ACTUALIZAR WAYBILL
-        self.write({
-            'distance_km': distance_km,
-            'duration_hours': duration_hours,
-            'cost_tolls': toll_cost,
+        Solo toca viajes que aún no avanzan más allá de la cotización: si el
+        usuario ya confirmó el viaje mientras esperaba, no se le cambian los datos.
+        """
+        waybills = self.filtered(lambda w: w.state in ('draft', 'en_pedido', 'assigned'))
+        if not waybills:
+            return
+        waybills.write({
+            'distance_km': result['distance_km'],
+            'duration_hours': result['duration_hours'],
+            'cost_tolls': result['cost_tolls'],
             'extra_distance_km': 0.0,
         })
-
-        return self._notify_success("Calculado vía Google API (y guardado)", distance_km, duration_hours, toll_cost)
+        for waybill in waybills:
+            waybill.message_post(
+                body=_('Ruta calculada: %.2f km, %.2f hrs, Casetas: $%.2f') % (
+                    result['distance_km'], result['duration_hours'], result['cost_tolls']),
+                subtype_xmlid='mail.mt_note',
+            )
 
     def _notify_success(self, source, dist, dur, tolls):
         return {
@@ -666,8 +929,15 @@ class TmsWaybill(models.Model):
     # ============================================================
 
     # --- INPUTS DE COSTOS ---
-    fuel_price_liter = fields.Float(string='Precio Diesel (L)', default=24.00, digits=(10,2))
-    fuel_performance = fields.Float(string='Rendimiento (Km/L)', default=2.5, digits=(10,2), help="Kms por Litro")
+    # Precio y rendimiento se resuelven solos (índice de precios / vehículo) y se pueden editar
+    fuel_price_liter = fields.Float(
+        string='Precio Diesel (L)', digits=(10,2),
+        compute='_compute_fuel_price_liter', store=True, readonly=False, precompute=True,
+        help="Precio vigente a la fecha de solicitud en el estado de origen (Configuración > Precios del Diesel)")
+    fuel_performance = fields.Float(
+        string='Rendimiento (Km/L)', digits=(10,2),
+        compute='_compute_fuel_performance', store=True, readonly=False, precompute=True,
+        help="Kms por Litro. Por defecto el rendimiento del tractor asignado")
     cost_tolls = fields.Float(string='Costo Casetas', digits=(10,2))
     cost_driver = fields.Float(string='Sueldo Chofer', digits=(10,2))
     cost_maneuver = fields.Float(string='Maniobras', digits=(10,2))
@@ -683,23 +953,38 @@ class TmsWaybill(models.Model):
     )
 
     # --- PROPUESTA 1: POR KILÓMETRO ---
-    price_per_km = fields.Float(string='Precio por Km', digits=(10,2))
-    # IMPORTANTE: Este campo NO tiene store=True, usa método separado
+    # Se resuelve del tarifario del cliente (tms.rate.card); sin tarifario se captura a mano
+    price_per_km = fields.Float(
+        string='Precio por Km', digits=(10,2),
+        compute='_compute_price_per_km', store=True, readonly=False, precompute=True)
+    rate_card_id = fields.Many2one(
+        'tms.rate.card', string='Tarifario',
+        compute='_compute_rate_card', store=True, precompute=True)
+    rate_surcharge_percent = fields.Float(
+        string='Recargo Tarifario (%)',
+        compute='_compute_rate_card', store=True, precompute=True,
+        help="Recargo por material peligroso del tarifario")
+    rate_minimum_amount = fields.Monetary(
+        string='Mínimo Tarifario', currency_field='currency_id',
+        compute='_compute_rate_card', store=True, precompute=True)
+    # Almacenado e indexado: se puede filtrar, agrupar y sumar en SQL
     proposal_km_total = fields.Monetary(
         string='Total (Por KM)',
         compute='_compute_proposal_values',
         currency_field='currency_id',
-        store=False
+        store=True,
+        index=True,
     )
 
     # --- PROPUESTA 2: POR VIAJE (Costos + Utilidad) ---
     profit_margin_percent = fields.Float(string='Margen Utilidad (%)', default=30.0)
-    # IMPORTANTE: Este campo NO tiene store=True, usa método separado
+    # Almacenado e indexado: se puede filtrar, agrupar y sumar en SQL
     proposal_trip_total = fields.Monetary(
         string='Total (Por Viaje)',
         compute='_compute_proposal_values',
         currency_field='currency_id',
-        store=False
+        store=True,
+        index=True,
     )
 
     # --- PROPUESTA 3: VENTA DIRECTA ---
@@ -729,6 +1014,65 @@ class TmsWaybill(models.Model):
     # MÉTODOS COMPUTADOS
     # ============================================================
 
+    @api.depends('company_id', 'partner_origin_id.state_id', 'date_created')
+    def _compute_fuel_price_liter(self):
+        """
+        Precio del diesel vigente (tms.fuel.price) a la fecha de solicitud en
+        el estado de origen. Solo cotizaciones abiertas: un viaje confirmado
+        conserva el precio con el que se cotizó.
+        """
+        FuelPrice = self.env['tms.fuel.price']
+        for record in self:
+            if record.state and record.state not in REQUOTE_STATES:
+                continue
+            price = FuelPrice._get_price(
+                record.company_id.id, record.partner_origin_id.state_id.id,
+                record.date_created or fields.Date.context_today(record))
+            record.fuel_price_liter = price or record.fuel_price_liter or FUEL_PRICE_DEFAULT
+
+    @api.depends('vehicle_id.performance_km_l')
+    def _compute_fuel_performance(self):
+        """Rendimiento del tractor asignado (si lo tiene capturado)."""
+        for record in self:
+            if record.state and record.state not in REQUOTE_STATES:
+                continue
+            record.fuel_performance = (
+                record.vehicle_id.performance_km_l or record.fuel_performance or FUEL_PERFORMANCE_DEFAULT)
+
+    def _get_rate_match(self):
+        """Tarifa del tarifario aplicable al viaje (índice en memoria, sin consultas)."""
+        self.ensure_one()
+        return self.env['tms.rate.card']._match_rate(
+            self.company_id.id,
+            self.partner_invoice_id.commercial_partner_id.id,
+            self.vehicle_id.tms_vehicle_type_id.id,
+            self.distance_km + self.extra_distance_km,
+            hazmat=any(self.line_ids.mapped('is_dangerous')),
+        )
+
+    @api.depends('company_id', 'partner_invoice_id', 'vehicle_id.tms_vehicle_type_id',
+                 'distance_km', 'extra_distance_km')
+    def _compute_price_per_km(self):
+        """Precio por km del tramo del tarifario; sin tarifario conserva el capturado."""
+        for record in self:
+            if record.state and record.state not in REQUOTE_STATES:
+                continue
+            match = record._get_rate_match()
+            if match:
+                record.price_per_km = match['price_per_km']
+
+    @api.depends('company_id', 'partner_invoice_id', 'vehicle_id.tms_vehicle_type_id',
+                 'distance_km', 'extra_distance_km', 'line_ids.is_dangerous')
+    def _compute_rate_card(self):
+        """Tarifario aplicado, recargo por material peligroso y monto mínimo."""
+        for record in self:
+            if record.state and record.state not in REQUOTE_STATES:
+                continue
+            match = record._get_rate_match() or {}
+            record.rate_card_id = match.get('card_id', False)
+            record.rate_surcharge_percent = match.get('surcharge_percent', 0.0)
+            record.rate_minimum_amount = match.get('minimum_amount', 0.0)
+
     @api.depends('distance_km', 'extra_distance_km', 'fuel_price_liter', 'fuel_performance')
     def _compute_cost_diesel_total(self):
         """
@@ -753,43 +1097,48 @@ class TmsWaybill(models.Model):
             else:
                 record.cost_diesel_total = 0.0
 
-    @api.depends('distance_km', 'extra_distance_km', 'price_per_km', 'cost_diesel_total',
+    @api.depends('distance_km', 'extra_distance_km', 'price_per_km', 'rate_surcharge_percent',
+                 'rate_minimum_amount', 'cost_diesel_total',
                  'cost_tolls', 'cost_driver', 'cost_maneuver', 'cost_other',
-                 'profit_margin_percent', 'proposal_direct_amount', 'selected_proposal')
+                 'profit_margin_percent')
     def _compute_proposal_values(self):
         """
-        Calcula las 3 propuestas de cotización automáticamente.
+        Calcula las propuestas de cotización automáticamente.
 
-        PROPUESTA 1 (Por KM): (Distancia Base + Km Extras) * Precio/KM
+        PROPUESTA 1 (Por KM): (Distancia Base + Km Extras) * Precio/KM * (1 + Recargo%),
+                              nunca menor al mínimo del tarifario
         PROPUESTA 2 (Por Viaje): (Costos Totales) / (1 - Margen%)
-        PROPUESTA 3 (Directa): Monto fijo capturado manualmente
-
-        El campo amount_total se actualiza según la propuesta seleccionada.
+        PROPUESTA 3 (Directa): Monto fijo capturado manualmente (sin cálculo)
 
         IMPORTANTE:
-        - Este método es para campos NO almacenados (store=False)
-        - Depende de cost_diesel_total que SÍ está almacenado
-        - Esto evita warnings de inconsistencia en compute_sudo y store
+        - Ambas propuestas están almacenadas e indexadas (store=True): las
+          listas, pivotes y exportaciones las leen de la BD sin recalcular
         - Los Km Extras se suman a la distancia base para el cobro por KM
+        - amount_total se calcula aparte (_compute_amount_total)
+        - Mantener en sincronía con compute_quotes() (recotización masiva)
         """
         for record in self:
             # 1. Calcular Propuesta KM
             # Distancia Total = Distancia Base + Km Extras
-            # Total = Distancia Total * Precio por KM
+            # Total = Distancia Total * Precio por KM * (1 + Recargo%), mínimo el del tarifario
             total_distance = record.distance_km + record.extra_distance_km
-            record.proposal_km_total = total_distance * record.price_per_km
+            record.proposal_km_total = max(
+                total_distance * record.price_per_km * (1 + record.rate_surcharge_percent / 100),
+                record.rate_minimum_amount)
 
             # 2. Calcular Propuesta Viaje
-            # Costo Total = Diesel + Casetas + Chofer + Maniobras + Otros
-            total_costs = record.cost_diesel_total + record.cost_tolls + record.cost_driver + record.cost_maneuver + record.cost_other
             # Precio Venta = Costo Total / (1 - Margen%)
+            total_costs = record._get_total_costs()
             margin_factor = 1 - (record.profit_margin_percent / 100)
             if margin_factor > 0:
                 record.proposal_trip_total = total_costs / margin_factor
             else:
                 record.proposal_trip_total = total_costs
 
-            # 3. Actualizar Monto Final (Amount Total) basado en selección
+    @api.depends('selected_proposal', 'proposal_km_total', 'proposal_trip_total', 'proposal_direct_amount')
+    def _compute_amount_total(self):
+        """Monto final según la propuesta seleccionada (editable a mano)."""
+        for record in self:
             if record.selected_proposal == 'km':
                 record.amount_total = record.proposal_km_total
             elif record.selected_proposal == 'trip':
@@ -797,6 +1146,186 @@ class TmsWaybill(models.Model):
             else:
                 record.amount_total = record.proposal_direct_amount
 
+    @api.depends('cost_diesel_total', 'cost_tolls', 'cost_driver', 'cost_maneuver', 'cost_other', 'amount_total')
+    def _compute_margin(self):
+        """Costo total, margen y margen % sobre el Valor del Viaje."""
+        for record in self:
+            record.cost_total = record._get_total_costs()
+            record.margin_amount = record.amount_total - record.cost_total
+            record.margin_percent = 100.0 * record.margin_amount / record.amount_total if record.amount_total else 0.0
+
+    def _get_total_costs(self):
+        """Costo Total = Diesel + Casetas + Chofer + Maniobras + Otros."""
+        self.ensure_one()
+        return self.cost_diesel_total + self.cost_tolls + self.cost_driver + self.cost_maneuver + self.cost_other
+
+    # ============================================================
+    # RECOTIZACIÓN MASIVA (motor vectorizado)
+    # ============================================================
+
+    def _bulk_requote(self, fuel_price_liter=None, apply_rates=False):
+        """
+        Recotiza en bloque las cotizaciones abiertas del recordset.
+
+        PROBLEMA: Cuando sube el diesel hay que recotizar cientos de
+        cotizaciones; write() por registro dispara los computes, el tracking
+        y un UPDATE por viaje (minutos para 10k cotizaciones).
+
+        SOLUCIÓN:
+        1. Una consulta SQL lee los insumos de todo el recordset
+        2. Opcionalmente la tarifa de cada viaje se resuelve en el índice
+           en memoria de los tarifarios (sin consultas por regla)
+        3. compute_quotes() calcula diesel, propuestas y monto final sobre
+           columnas completas (NumPy si está instalado)
+        4. Un solo UPDATE ... FROM unnest() escribe los resultados
+
+        Solo toca cotizaciones en REQUOTE_STATES. No genera mensajes de
+        seguimiento por viaje: el reporte de retorno es la bitácora.
+
+        :param fuel_price_liter: nuevo precio del diesel, dict {waybill_id: precio}
+                                 por viaje o None (conservar el de cada viaje)
+        :param apply_rates: volver a resolver precio por km, recargo y mínimo
+                            con los tarifarios vigentes
+        :return: dict {count, changed, old_total, new_total, lines}; lines son
+                 las cotizaciones con cambio (id, name, old, new), mayor cambio primero
+        """
+        self.env.flush_all()
+        self.env.cr.execute(SQL(
+            """
+            SELECT w.id, w.name, w.selected_proposal, COALESCE(w.amount_total, 0),
+                   COALESCE(c.decimal_places, 2), w.company_id, p.commercial_partner_id,
+                   v.tms_vehicle_type_id, w.rate_card_id,
+                   EXISTS(SELECT 1 FROM tms_waybill_line l WHERE l.waybill_id = w.id AND l.is_dangerous),
+                   %s
+              FROM tms_waybill w
+              LEFT JOIN res_currency c ON c.id = w.currency_id
+              LEFT JOIN res_partner p ON p.id = w.partner_invoice_id
+              LEFT JOIN fleet_vehicle v ON v.id = w.vehicle_id
+             WHERE w.id = ANY(%s)
+               AND w.state IN %s
+             ORDER BY w.id
+            """,
+            SQL(', ').join(SQL('COALESCE(w.%s, 0)', SQL.identifier(column)) for column in QUOTE_INPUT_COLUMNS),
+            self.ids, REQUOTE_STATES,
+        ))
+        rows = self.env.cr.fetchall()
+        report = {'count': len(rows), 'changed': 0, 'old_total': 0.0, 'new_total': 0.0, 'lines': []}
+        if not rows:
+            return report
+
+        # Una pasada vectorizada por cantidad de decimales de la moneda
+        RateCard = self.env['tms.rate.card']
+        by_digits = {}
+        for row in rows:
+            by_digits.setdefault(row[4], []).append(row)
+        written = {name: [] for name in (
+            'id', 'cost_diesel_total', 'fuel_price_liter', 'amount_total',
+            'price_per_km', 'rate_card_id', 'rate_surcharge_percent', 'rate_minimum_amount',
+            'proposal_km_total', 'proposal_trip_total', 'cost_total', 'margin_amount', 'margin_percent')}
+        for digits, group in by_digits.items():
+            columns = {
+                column: [float(row[10 + index]) for row in group]
+                for index, column in enumerate(QUOTE_INPUT_COLUMNS)
+            }
+            if isinstance(fuel_price_liter, dict):
+                columns['fuel_price_liter'] = [
+                    fuel_price_liter.get(row[0], price) for row, price in zip(group, columns['fuel_price_liter'])]
+            elif fuel_price_liter is not None:
+                columns['fuel_price_liter'] = [fuel_price_liter] * len(group)
+            card_ids = [row[8] or 0 for row in group]
+            if apply_rates:
+                for position, row in enumerate(group):
+                    distance = columns['distance_km'][position] + columns['extra_distance_km'][position]
+                    match = RateCard._match_rate(row[5], row[6], row[7], distance, hazmat=row[9])
+                    if match:
+                        columns['price_per_km'][position] = match['price_per_km']
+                    card_ids[position] = match['card_id'] if match else 0
+                    columns['rate_surcharge_percent'][position] = match['surcharge_percent'] if match else 0.0
+                    columns['rate_minimum_amount'][position] = match['minimum_amount'] if match else 0.0
+            result = compute_quotes(columns, [row[2] for row in group], digits)
+            for row, new_amount in zip(group, result['amount_total']):
+                old_amount = float(row[3])
+                report['old_total'] += old_amount
+                report['new_total'] += new_amount
+                if round(new_amount - old_amount, digits):
+                    report['lines'].append((row[0], row[1], old_amount, new_amount))
+            written['id'] += [row[0] for row in group]
+            written['rate_card_id'] += card_ids
+            for column in QUOTE_OUTPUT_COLUMNS:
+                written[column] += result[column]
+            for column in ('fuel_price_liter', 'price_per_km', 'rate_surcharge_percent', 'rate_minimum_amount'):
+                written[column] += columns[column]
+
+        self.env.cr.execute(SQL(
+            """
+            UPDATE tms_waybill w
+               SET cost_diesel_total = v.cost_diesel_total,
+                   fuel_price_liter = v.fuel_price_liter,
+                   amount_total = v.amount_total,
+                   price_per_km = v.price_per_km,
+                   rate_card_id = NULLIF(v.rate_card_id, 0),
+                   rate_surcharge_percent = v.rate_surcharge_percent,
+                   rate_minimum_amount = v.rate_minimum_amount,
+                   proposal_km_total = v.proposal_km_total,
+                   proposal_trip_total = v.proposal_trip_total,
+                   cost_total = v.cost_total,
+                   margin_amount = v.margin_amount,
+                   margin_percent = v.margin_percent,
+                   write_uid = %s,
+                   write_date = (now() at time zone 'UTC')
+              FROM unnest(%s::int[], %s::float8[], %s::float8[], %s::float8[],
+                          %s::float8[], %s::int[], %s::float8[], %s::float8[],
+                          %s::float8[], %s::float8[], %s::float8[], %s::float8[], %s::float8[])
+                   AS v(id, cost_diesel_total, fuel_price_liter, amount_total,
+                        price_per_km, rate_card_id, rate_surcharge_percent, rate_minimum_amount,
+                        proposal_km_total, proposal_trip_total, cost_total, margin_amount, margin_percent)
+             WHERE w.id = v.id
+            """,
+            self.env.uid, *written.values(),
+        ))
+        self.browse(written['id']).invalidate_recordset(list(written)[1:] + ['write_uid', 'write_date'])
+        report['changed'] = len(report['lines'])
+        report['lines'].sort(key=lambda line: abs(line[3] - line[2]), reverse=True)
+        _logger.info(
+            "TMS: recotización masiva de %s viajes (%s con cambio): %.2f → %.2f",
+            report['count'], report['changed'], report['old_total'], report['new_total'],
+        )
+        return report
+
+    @api.model
+    def _reprice_fuel(self, company_ids, date_from=None):
+        """
+        Recotiza las cotizaciones abiertas cuyo precio vigente del diesel cambió
+        (tras modificar el índice tms.fuel.price).
+
+        Una consulta lee precio actual, estado de origen y fecha de cada viaje;
+        el precio vigente se resuelve en memoria (bisect) y solo los viajes con
+        diferencia pasan a _bulk_requote().
+
+        :param date_from: solo viajes solicitados desde esta fecha (None: todos)
+        :return: reporte de _bulk_requote() o None si ningún precio cambió
+        """
+        self.env.cr.execute(SQL(
+            """
+            SELECT w.id, w.company_id, p.state_id, w.date_created, COALESCE(w.fuel_price_liter, 0)
+              FROM tms_waybill w
+              LEFT JOIN res_partner p ON p.id = w.partner_origin_id
+             WHERE w.company_id = ANY(%s)
+               AND w.state IN %s
+               AND (%s::date IS NULL OR w.date_created >= %s::date)
+            """,
+            list(company_ids), REQUOTE_STATES, date_from, date_from,
+        ))
+        FuelPrice = self.env['tms.fuel.price']
+        prices = {}
+        for waybill_id, company_id, state_id, date_created, current in self.env.cr.fetchall():
+            price = FuelPrice._get_price(company_id, state_id, date_created)
+            if price is not None and round(price - float(current), 2):
+                prices[waybill_id] = price
+        if not prices:
+            return None
+        return self.browse(list(prices))._bulk_requote(prices)
+
     def _compute_access_url(self):
         """
         Sobrescribe el método de portal.mixin para generar la URL del portal.
@@ -883,67 +1412,36 @@ class TmsWaybill(models.Model):
                 if municipio:
                     self.dest_city_id = municipio
 
-    @api.onchange('route_id')
-    def _onchange_route_id(self):
-        """
-        AUTOCOMPLETADO DE RUTA AL SELECCIONAR UNA RUTA FRECUENTE.
-
-        Cuando el usuario selecciona una ruta desde el campo route_id:
-        - Auto-llena origin_city_id con el municipio de origen de la ruta
-        - Auto-llena dest_city_id con el municipio de destino de la ruta
-        - Auto-llena distance_km con la distancia de la ruta
-        - Auto-llena duration_hours con la duración de la ruta
-        - Auto-llena cost_tolls con el costo de casetas de la ruta
+    @api.onchange('origin_zip', 'dest_zip', 'vehicle_id')
+    def _onchange_route_autocomplete(self):
         """
-        if self.route_id:
-            # Auto-llenar estados de origen y destino (Sincronización requerida)
-            self.origin_state_id = self.route_id.state_origin_id
-            self.dest_state_id = self.route_id.state_dest_id
-
-            # Auto-llenar distancia y duración
-            self.distance_km = self.route_id.distance_km or 0.0
-            self.duration_hours = self.route_id.duration_hours or 0.0
+        AUTOCOMPLETADO INTELIGENTE DE RUTA (Búsqueda en caché).
 
-            # Auto-llenar costo de casetas
-            self.cost_tolls = self.route_id.toll_cost or 0.0
-            self.toll_cost = self.route_id.toll_cost or 0.0
-
-    @api.onchange('origin_state_id', 'dest_state_id')
-    def _onchange_route_autocomplete(self):
+        Busca en tms.destination la ruta del carril (CP Origen + CP Destino +
+        Tipo de Vehículo) y pre-llena distancia, duración y casetas.
+        Usa la caché en memoria del worker: sin consultas a la BD en carriles
+        calientes, aunque el onchange se dispare en cada cambio del formulario.
         """
-        AUTOCOMPLETADO INTELIGENTE DE RUTA (Búsqueda inversa).
-
-        Busca en tms.destination si existe la ruta basándose en Estados
-        y pre-llena datos. También actualiza route_id si encuentra una coincidencia.
-        """
-        if self.origin_state_id and self.dest_state_id:
-            route = self.env['tms.destination'].search([
-                ('state_origin_id', '=', self.origin_state_id.id),
-                ('state_dest_id', '=', self.dest_state_id.id),
-                ('company_id', '=', self.company_id.id),
-                ('active', '=', True),
-            ], limit=1)
-
-            if route:
-                # Actualizar route_id si se encuentra una ruta
-                self.route_id = route
-                self.distance_km = route.distance_km or 0.0
-                self.duration_hours = route.duration_hours or 0.0
-                self.cost_tolls = route.toll_cost or 0.0
-                self.toll_cost = route.toll_cost or 0.0
-
-                return {
-                    'warning': {
-                        'title': _('✅ Ruta Encontrada'),
-                        'message': _('Distancia: %s km | Duración: %s hrs') % (
-                            route.distance_km,
-                            route.duration_hours
-                        )
-                    }
-                }
-            else:
-                # Si no se encuentra ruta, limpiar route_id
-                self.route_id = False
+        if not self.origin_zip or not self.dest_zip:
+            return
+        route, status = self.env['tms.destination']._lookup_route(
+            self.company_id or self.env.company, self.origin_zip, self.dest_zip,
+            self.vehicle_id.tms_vehicle_type_id)
+        if not route:
+            return
+
+        self.distance_km = route['distance_km'] or 0.0
+        self.duration_hours = route['duration_hours'] or 0.0
+        self.cost_tolls = route['cost_tolls'] or 0.0
+        return {
+            'warning': {
+                'title': _('✅ Ruta Encontrada'),
+                'message': _('Distancia: %s km | Duración: %s hrs') % (
+                    route['distance_km'],
+                    route['duration_hours']
+                )
+            }
+        }
 
     # ============================================================
     # MÉTODO: Group Expand (CRÍTICO para Kanban)
@@ -1010,7 +1508,7 @@ class TmsWaybill(models.Model):
         if not self.driver_id:
             raise UserError(_('Debe asignar un chofer antes de aprobar la CP.'))
 
-        self.write({'state': 'carta_porte'})
+        self._write_telemetry({'state': 'waybill'}, 'manual')
 
     def action_start_route_manual(self):
         """
@@ -1019,7 +1517,7 @@ class TmsWaybill(models.Model):
         PLAN B (Respaldo Manual):
         - Registra la fecha/hora actual
         - NO registra GPS (lat/long quedan en 0.0)
-        - Cambia estado a 'transit'
+        - Cambia estado a 'in_transit'
 
         VENTAJA: El sistema sigue funcionando aunque la App falle.
         """
@@ -1028,14 +1526,14 @@ class TmsWaybill(models.Model):
         # Registrar fecha/hora actual
         now = fields.Datetime.now()
 
-        # Escribir valores
+        # Escribir valores (sin tracking campo por campo, un solo mensaje en chatter)
         # GPS en 0.0 indica operación MANUAL (sin app)
-        self.write({
+        self._write_telemetry({
             'date_started_route': now,
             'lat_started_route': 0.0,  # 0.0 = Manual
             'long_started_route': 0.0,  # 0.0 = Manual
-            'state': 'transit',
-        })
+            'state': 'in_transit',
+        }, 'manual')
 
     def action_arrived_dest_manual(self):
         """
@@ -1044,20 +1542,20 @@ class TmsWaybill(models.Model):
         PLAN B (Respaldo Manual):
         - Registra la fecha/hora actual
         - NO registra GPS (lat/long quedan en 0.0)
-        - Cambia estado a 'destination'
+        - Cambia estado a 'arrived'
         """
         self.ensure_one()
 
         # Registrar fecha/hora actual
         now = fields.Datetime.now()
 
-        # Escribir valores
-        self.write({
+        # Escribir valores (sin tracking campo por campo, un solo mensaje en chatter)
+        self._write_telemetry({
             'date_arrived_dest': now,
             'lat_arrived_dest': 0.0,  # 0.0 = Manual
             'long_arrived_dest': 0.0,  # 0.0 = Manual
-            'state': 'destination',
-        })
+            'state': 'arrived',
+        }, 'manual')
 
     def action_create_invoice(self):
         """
@@ -1073,7 +1571,7 @@ class TmsWaybill(models.Model):
         # TODO: Aquí se puede integrar la creación real de factura
         # account_invoice = self.env['account.move'].create({...})
 
-        self.write({'state': 'invoiced'})
+        self._write_telemetry({'state': 'closed'}, 'manual')
 
     def _action_sign(self, signature, signed_by):
         """
@@ -1148,7 +1646,7 @@ class TmsWaybill(models.Model):
         - Cambia el estado del viaje según el status
 
         :param waybill_id: ID del viaje (int)
-        :param status: Estado reportado ('started_route', 'arrived_dest', 'tracking')
+        :param status: Estado reportado ('arrived_origin', 'started_route', 'arrived_dest', 'tracking')
         :param lat: Latitud GPS (float)
         :param long: Longitud GPS (float)
         :return: dict con resultado
@@ -1160,67 +1658,538 @@ class TmsWaybill(models.Model):
                 "args": [123, "started_route", 25.6866, -100.3161]
             }
         }
+
+        NOTA: Es un lote de un solo reporte (ver action_driver_report_batch).
+        """
+        result = self.action_driver_report_batch([{
+            'waybill_id': waybill_id,
+            'status': status,
+            'lat': lat,
+            'long': long,
+        }])['results'][0]
+        result.pop('index', None)
+        return result
+
+    @api.model
+    def action_driver_report_batch(self, reports):
         """
-        # Buscar el viaje
-        waybill = self.browse(waybill_id)
+        API de ingesta MASIVA de reportes GPS de la App Móvil.
+
+        Recibe muchos reportes a la vez (de muchos viajes, posiblemente
+        acumulados offline en el teléfono) y los aplica con pocas escrituras:
+        - Cambios de estado: status explícitos de la app o detectados por
+          geocerca; un write ORM por viaje que cambió (son eventos raros,
+          conservan la lógica de negocio)
+        - Posiciones: UN SOLO INSERT en la bitácora tms.waybill.position
+          para todo el lote (last_app_* se deriva de ella)
+
+        :param reports: lista de dicts con llaves:
+            - waybill_id (int)
+            - status ('arrived_origin', 'started_route', 'arrived_dest', 'tracking')
+            - lat, long (float)
+            - device_ts / timestamp (opcional): hora del dispositivo en UTC
+              ('YYYY-MM-DD HH:MM:SS', ISO 8601 o epoch en segundos/milisegundos).
+              Es la hora del evento (fechas de llegada/inicio), no la del servidor
+            - event_id (opcional, recomendado): ID único del evento generado por
+              la app. Un reenvío con el mismo event_id es un no-op y responde
+              {'success': True, 'duplicate': True}
+        :return: dict {'success': True, 'results': [...]} con un resultado
+                 por reporte, en el mismo orden de entrada
 
-        if not waybill.exists():
-            return {
-                'success': False,
-                'message': _('Viaje no encontrado')
+        EJEMPLO DE USO (desde la App):
+        POST /web/dataset/call_kw/tms.waybill/action_driver_report_batch
+        {
+            "params": {
+                "args": [[
+                    {"waybill_id": 123, "status": "tracking", "lat": 25.68, "long": -100.31,
+                     "timestamp": "2024-05-01 14:30:00"},
+                    {"waybill_id": 124, "status": "arrived_dest", "lat": 19.43, "long": -99.13}
+                ]]
             }
-
-        # Registrar fecha/hora actual
+        }
+        """
         now = fields.Datetime.now()
+        results = [None] * len(reports)
+        parsed = []
+
+        # 1. VALIDAR Y NORMALIZAR (sin tocar la BD)
+        for index, report in enumerate(reports):
+            try:
+                item = self._parse_driver_report(report, now)
+            except (TypeError, ValueError, AttributeError, KeyError) as e:
+                results[index] = self._driver_report_result(
+                    index, report, False, _('Reporte inválido: %s') % e)
+                continue
+            item['index'] = index
+            parsed.append(item)
+
+        # 2. UNA SOLA CONSULTA: viajes existentes y con permiso de escritura
+        waybill_ids = {item['waybill_id'] for item in parsed}
+        waybills = self.browse(waybill_ids).exists()
+        writable_ids = set(waybills._filtered_access('write').ids)
+        existing_ids = set(waybills.ids)
+
+        valid = []
+        seen_events = set()
+        for item in parsed:
+            event_key = (item['waybill_id'], item['event_id'])
+            if item['event_id'] and event_key in seen_events:
+                # Duplicado dentro del mismo lote (la app reenvió el buffer)
+                results[item['index']] = self._driver_report_result(
+                    item['index'], item, True, _('Reporte duplicado (ya procesado)'))
+                results[item['index']]['duplicate'] = True
+                continue
+            seen_events.add(event_key)
+            if item['waybill_id'] not in existing_ids:
+                results[item['index']] = self._driver_report_result(
+                    item['index'], item, False, _('Viaje no encontrado'))
+            elif item['waybill_id'] not in writable_ids:
+                results[item['index']] = self._driver_report_result(
+                    item['index'], item, False, _('Sin permiso sobre el viaje'))
+            else:
+                valid.append(item)
+
+        # Orden cronológico (hora del dispositivo): los reportes offline llegan desordenados
+        valid.sort(key=lambda item: item['timestamp'])
+
+        # 3. BITÁCORA GPS: todos los reportes en un solo INSERT
+        # (last_app_* se deriva de aquí; se inserta ANTES de los cambios de
+        # estado para que la compactación al llegar a destino incluya el lote)
+        # IDEMPOTENCIA: el índice único (waybill_id, event_id) de la bitácora es
+        # el índice de deduplicación; los reintentos de la app son no-ops.
+        inserted = self.env['tms.waybill.position']._log_positions(valid)
+        self.invalidate_model(['last_app_lat', 'last_app_long', 'last_report_date'])
+        fresh = []
+        for item in valid:
+            if item['event_id'] and (item['waybill_id'], item['event_id']) not in inserted:
+                results[item['index']] = self._driver_report_result(
+                    item['index'], item, True, _('Reporte duplicado (ya procesado)'))
+                results[item['index']]['duplicate'] = True
+            else:
+                fresh.append(item)
+        valid = fresh
+
+        # 4. CAMBIOS DE ESTADO: reportes explícitos + geocercas, evaluados en
+        # memoria y aplicados con UN write ORM por viaje que cambió
+        context = self._get_tracking_context({item['waybill_id'] for item in valid})
+        transitions = self._evaluate_driver_reports(valid, context)
+        for waybill_id, (vals, events) in transitions.items():
+            self.browse(waybill_id)._write_telemetry(vals, 'app', events)
+
+        # 5. ETA EN VIVO: O(1) por ping en memoria, UN upsert por lote
+        self._update_etas(valid, context)
+
+        # 6. RESULTADOS POR REPORTE
+        messages = {
+            'arrived_origin': _('Llegada a origen registrada'),
+            'started_route': _('Ruta iniciada correctamente'),
+            'arrived_dest': _('Llegada a destino registrada'),
+            'tracking': _('Posición actualizada'),
+        }
+        states = {rec['id']: rec['state'] for rec in self.browse(
+            {item['waybill_id'] for item in valid}).read(['state'])}
+        for item in valid:
+            results[item['index']] = self._driver_report_result(
+                item['index'], item, True, messages[item['status']],
+                states.get(item['waybill_id']))
+
+        return {
+            'success': True,
+            'results': results,
+        }
+
+    @api.model
+    def _parse_driver_report(self, report, now):
+        """
+        Normaliza un reporte de la app.
+
+        :raise ValueError: si el status, las coordenadas o el timestamp no son válidos
+        """
+        status = report.get('status')
+        if status not in DRIVER_REPORT_STATUSES:
+            raise ValueError(_('Status no válido: %s') % status)
+
+        lat = float(report['lat'])
+        long = float(report['long'])
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= long <= 180.0):
+            raise ValueError(_('Coordenadas fuera de rango: %s, %s') % (lat, long))
+
+        timestamp = self._parse_report_timestamp(
+            report.get('device_ts') or report.get('timestamp'), now)
+
+        event_id = report.get('event_id')
+        event_id = str(event_id).strip()[:64] if event_id not in (None, '') else False
 
-        # Actualizar según el status reportado
-        if status == 'started_route':
+        return {
+            'event_id': event_id,
+            'waybill_id': int(report['waybill_id']),
+            'status': status,
+            'lat': lat,
+            'long': long,
+            'timestamp': timestamp,
+        }
+
+    @api.model
+    def _parse_report_timestamp(self, value, now):
+        """
+        Convierte la hora del dispositivo a datetime UTC naive (formato de Odoo).
+        Sin valor → hora del servidor. Fechas en el futuro se recortan a "ahora".
+        """
+        if not value:
+            return now
+        if isinstance(value, (int, float)):
+            # Epoch en milisegundos (JS Date.now()) o segundos
+            seconds = value / 1000.0 if value > 1e11 else value
+            timestamp = datetime.fromtimestamp(seconds, tz=timezone.utc).replace(tzinfo=None)
+        else:
+            value = str(value).strip()
+            try:
+                timestamp = fields.Datetime.to_datetime(value)
+            except ValueError:
+                timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                if timestamp.tzinfo:
+                    timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return min(timestamp, now)
+
+    @api.model
+    def _evaluate_driver_reports(self, items, context):
+        """
+        Máquina de estados en memoria para un lote de reportes.
+
+        Recorre los reportes en orden cronológico. Los status explícitos de la
+        app se aplican tal cual; los pings de 'tracking' se evalúan contra las
+        geocercas de origen y destino del viaje para avanzar el estado
+        automáticamente (Plan A sin depender de que la app mande el status).
+
+        :param context: resultado de _get_tracking_context (se actualiza el
+                        estado simulado de cada viaje)
+        :return: dict {waybill_id: (vals, events)} con los valores fusionados
+                 por viaje y la lista de eventos (status, timestamp, origen)
+                 para el mensaje consolidado del chatter
+        """
+        transitions = {}
+        for item in items:
+            fence = context[item['waybill_id']]
+            status, source = item['status'], 'app'
+            if status == 'tracking':
+                status, source = self._geofence_status(fence, item), 'geofence'
+            if not status or not self._is_forward_report(fence, status):
+                continue
+            vals = self._prepare_driver_transition_vals(item, status)
+            waybill_vals, events = transitions.setdefault(item['waybill_id'], ({}, []))
+            waybill_vals.update(vals)
+            events.append((status, item['timestamp'], source))
+            # Actualizar el estado simulado para los siguientes pings del lote
+            fence['state'] = vals.get('state', fence['state'])
+            if status == 'arrived_origin':
+                fence['arrived_origin'] = True
+        return transitions
+
+    @api.model
+    def _is_forward_report(self, fence, status):
+        """
+        Regla monotónica: un reporte solo puede AVANZAR el viaje.
+
+        Un started_route reenviado cuando el viaje ya va En Trayecto (o ya
+        llegó) se ignora: no re-estampa fechas ni regresa el estado.
+        """
+        current = fence['state']
+        if current in ('cancel', 'rejected'):
+            return False
+        if status == 'arrived_origin':
+            return not fence['arrived_origin'] and STATE_RANK[current] < STATE_RANK['in_transit']
+        return STATE_RANK[current] < STATE_RANK[DRIVER_REPORT_STATES[status]]
+
+    def _prepare_driver_transition_vals(self, item, status):
+        """Valores a escribir para un reporte con cambio de estado."""
+        vals = {}
+        if status in DRIVER_REPORT_STATES:
+            vals['state'] = DRIVER_REPORT_STATES[status]
+        if status == 'arrived_origin':
+            # Chofer llegó al punto de carga
+            vals.update({
+                'date_arrived_origin': item['timestamp'],
+                'lat_arrived_origin': item['lat'],
+                'long_arrived_origin': item['long'],
+            })
+        elif status == 'started_route':
             # Chofer inició el viaje
-            waybill.write({
-                'date_started_route': now,
-                'lat_started_route': lat,
-                'long_started_route': long,
-                'last_app_lat': lat,
-                'last_app_long': long,
-                'last_report_date': now,
-                'state': 'transit',
+            vals.update({
+                'date_started_route': item['timestamp'],
+                'lat_started_route': item['lat'],
+                'long_started_route': item['long'],
             })
-            message = _('Ruta iniciada correctamente')
-
         elif status == 'arrived_dest':
             # Chofer llegó a destino
-            waybill.write({
-                'date_arrived_dest': now,
-                'lat_arrived_dest': lat,
-                'long_arrived_dest': long,
-                'last_app_lat': lat,
-                'last_app_long': long,
-                'last_report_date': now,
-                'state': 'destination',
-            })
-            message = _('Llegada a destino registrada')
-
-        elif status == 'tracking':
-            # Actualización de posición (sin cambio de estado)
-            waybill.write({
-                'last_app_lat': lat,
-                'last_app_long': long,
-                'last_report_date': now,
+            vals.update({
+                'date_arrived_dest': item['timestamp'],
+                'lat_arrived_dest': item['lat'],
+                'long_arrived_dest': item['long'],
             })
-            message = _('Posición actualizada')
+        return vals
 
-        else:
-            return {
-                'success': False,
-                'message': _('Status no válido: %s') % status
-            }
+    # ============================================================
+    # ESCRITURA DE TELEMETRÍA (sin tracking de mail.thread)
+    # ============================================================
+
+    def _write_telemetry(self, vals, source, events=None):
+        """
+        Escritura de alta frecuencia para App / Geocercas / Botones manuales.
+
+        - write() con mail_notrack: evita el diff de tracking y las filas
+          mail.tracking.value por cada campo (state, fechas, coordenadas)
+        - Si cambia el estado, publica UN mensaje consolidado en el chatter
+          con la transición, el origen del evento y la hora/posición
+
+        :param vals: valores a escribir
+        :param source: 'app', 'geofence' o 'manual'
+        :param events: lista opcional de (status, timestamp, origen) para el detalle
+        """
+        old_states = {record.id: record.state for record in self}
+        res = self.with_context(mail_notrack=True).write(vals)
+        new_state = vals.get('state')
+        if not new_state:
+            return res
+
+        labels = dict(self._fields['state']._description_selection(self.env))
+        sources = {
+            'app': _('App Móvil'),
+            'geofence': _('Geocerca'),
+            'manual': _('Manual'),
+        }
+        event_labels = {
+            'arrived_origin': _('Llegada a origen'),
+            'started_route': _('Inicio de ruta'),
+            'arrived_dest': _('Llegada a destino'),
+        }
+        details = Markup('').join(
+            Markup('<li>%s: %s (%s)</li>') % (
+                event_labels.get(status, status),
+                fields.Datetime.to_string(timestamp),
+                sources.get(event_source, event_source),
+            )
+            for status, timestamp, event_source in (events or [])
+        )
+        for record in self:
+            old_state = old_states[record.id]
+            if old_state == new_state:
+                continue
+            body = Markup('<p>%s: <strong>%s</strong> → <strong>%s</strong> (%s)</p>') % (
+                _('Estado'), labels.get(old_state, old_state),
+                labels.get(new_state, new_state), sources.get(source, source),
+            )
+            if details:
+                body += Markup('<ul>%s</ul>') % details
+            record.message_post(body=body, subtype_xmlid='mail.mt_note')
+        return res
+
+    # ============================================================
+    # GEOCERCAS (Avance automático de estados por GPS)
+    # ============================================================
+
+    @api.model
+    def _get_tracking_context(self, waybill_ids):
+        """
+        Contexto de rastreo de varios viajes (geocercas + carril) con
+        4 consultas en total (viajes, contactos, vehículos, centroides de CP),
+        sin búsquedas por punto.
+
+        PRIORIDAD DE COORDENADAS DE GEOCERCA:
+        1. Geolocalización del contacto (partner_latitude/partner_longitude)
+        2. Centroide del Código Postal SAT (radio mayor, el CP es un área)
+
+        :return: dict {waybill_id: {'state', 'arrived_origin', 'origin', 'dest',
+                 'lane', 'distance_km'}} donde origin/dest son (lat, long, radio_m)
+                 o None y lane es (company_id, origin_zip, dest_zip, vehicle_type_id)
+        """
+        ICPSudo = self.env['ir.config_parameter'].sudo()
+        radius_m = float(ICPSudo.get_param('tms.geofence_radius_m', 500))
+        cp_radius_m = float(ICPSudo.get_param('tms.geofence_cp_radius_m', 2000))
+
+        waybills = self.browse(waybill_ids).read([
+            'state', 'date_arrived_origin', 'partner_origin_id', 'partner_dest_id',
+            'origin_zip', 'dest_zip', 'company_id', 'vehicle_id', 'distance_km',
+        ])
+        partner_ids = {
+            wb[fname][0] for wb in waybills
+            for fname in ('partner_origin_id', 'partner_dest_id') if wb[fname]
+        }
+        partners = {
+            p['id']: p for p in self.env['res.partner'].browse(partner_ids).read(
+                ['partner_latitude', 'partner_longitude', 'zip'])
+        }
+        vehicle_types = {
+            v['id']: v['tms_vehicle_type_id'] and v['tms_vehicle_type_id'][0]
+            for v in self.env['fleet.vehicle'].browse(
+                {wb['vehicle_id'][0] for wb in waybills if wb['vehicle_id']}
+            ).read(['tms_vehicle_type_id'])
+        }
+
+        def partner_of(wb, partner_field):
+            return partners.get(wb[partner_field] and wb[partner_field][0]) or {}
+
+        def endpoint(wb, partner_field, zip_code):
+            partner = partner_of(wb, partner_field)
+            if partner.get('partner_latitude') or partner.get('partner_longitude'):
+                return ('partner', partner['partner_latitude'], partner['partner_longitude'])
+            return ('zip', zip_code)
+
+        zips = {
+            wb['id']: (wb['origin_zip'] or partner_of(wb, 'partner_origin_id').get('zip'),
+                       wb['dest_zip'] or partner_of(wb, 'partner_dest_id').get('zip'))
+            for wb in waybills
+        }
+        endpoints = {
+            wb['id']: (endpoint(wb, 'partner_origin_id', zips[wb['id']][0]),
+                       endpoint(wb, 'partner_dest_id', zips[wb['id']][1]))
+            for wb in waybills
+        }
+        centroids = self.env['tms.sat.codigo.postal']._get_centroids(
+            {ep[1] for pair in endpoints.values() for ep in pair if ep[0] == 'zip' and ep[1]})
+
+        def to_fence(ep):
+            if ep[0] == 'partner':
+                return (ep[1], ep[2], radius_m)
+            centroid = centroids.get(ep[1])
+            return (centroid[0], centroid[1], cp_radius_m) if centroid else None
 
         return {
-            'success': True,
+            wb['id']: {
+                'state': wb['state'],
+                'arrived_origin': bool(wb['date_arrived_origin']),
+                'origin': to_fence(endpoints[wb['id']][0]),
+                'dest': to_fence(endpoints[wb['id']][1]),
+                'lane': (wb['company_id'][0], zips[wb['id']][0], zips[wb['id']][1],
+                         vehicle_types.get(wb['vehicle_id'] and wb['vehicle_id'][0]) or False),
+                'distance_km': wb['distance_km'],
+            }
+            for wb in waybills
+        }
+
+    @api.model
+    def _geofence_status(self, fence, item):
+        """
+        Evalúa un ping contra las geocercas de su viaje (O(1) por punto).
+
+        REGLAS:
+        - Carta Porte Lista + dentro de origen → 'arrived_origin'
+        - Carta Porte Lista + ya llegó a origen + fuera de origen → 'started_route'
+          (con histéresis para no rebotar por el ruido del GPS)
+        - En Trayecto + dentro de destino → 'arrived_dest'
+        """
+        origin, dest = fence['origin'], fence['dest']
+        if fence['state'] == 'waybill' and origin:
+            distance_m = haversine_km(item['lat'], item['long'], origin[0], origin[1]) * 1000
+            if not fence['arrived_origin']:
+                if distance_m <= origin[2]:
+                    return 'arrived_origin'
+            elif distance_m > origin[2] * GEOFENCE_EXIT_FACTOR:
+                return 'started_route'
+        elif fence['state'] == 'in_transit' and dest:
+            distance_m = haversine_km(item['lat'], item['long'], dest[0], dest[1]) * 1000
+            if distance_m <= dest[2]:
+                return 'arrived_dest'
+        return None
+
+    @api.model
+    def _driver_report_result(self, index, item, success, message, state=None):
+        """Resultado individual de un reporte (mismo formato que action_driver_report)."""
+        result = {
+            'index': index,
+            'success': success,
             'message': message,
-            'waybill_id': waybill_id,
-            'current_state': waybill.state,
+            'waybill_id': item.get('waybill_id') if isinstance(item, dict) else None,
         }
+        if success:
+            result['current_state'] = state
+        return result
+
+    # ============================================================
+    # ETA EN VIVO (Viajes en Trayecto)
+    # ============================================================
+
+    @api.model
+    def _update_etas(self, items, context):
+        """
+        Motor incremental de ETA para los viajes que quedan En Trayecto.
+
+        - 1 consulta: estado de ETA previo (tms.waybill.eta)
+        - 1 consulta: velocidad histórica por carril (tms.destination)
+        - O(1) en memoria por ping (update_eta)
+        - 1 upsert para todo el lote
+        """
+        in_transit = {
+            waybill_id for waybill_id, ctx in context.items() if ctx['state'] == 'in_transit'
+        }
+        if not in_transit:
+            return
+        Eta = self.env['tms.waybill.eta']
+        states = Eta._get_states(in_transit)
+        profiles = self.env['tms.destination']._get_lane_speeds(
+            {context[waybill_id]['lane'] for waybill_id in in_transit})
+        default_speed = float(self.env['ir.config_parameter'].sudo().get_param(
+            'tms.eta_default_speed_kmh', 55.0))
+
+        updated = {}
+        for item in items:
+            waybill_id = item['waybill_id']
+            if waybill_id not in in_transit:
+                continue
+            ctx = context[waybill_id]
+            state = updated.setdefault(waybill_id, dict(states.get(waybill_id) or {}))
+            if state.get('last_report_date') and item['timestamp'] < state['last_report_date']:
+                continue  # Ping atrasado: no retrocede la ETA
+            update_eta(state, item, ctx['dest'],
+                       profiles.get(ctx['lane']) or default_speed,
+                       self._get_route_circuity(ctx))
+        Eta._upsert_states(updated)
+        self.invalidate_model(['eta_date', 'eta_remaining_km', 'eta_speed_kmh'])
+
+    @api.model
+    def _get_route_circuity(self, ctx):
+        """Factor carretera / línea recta: de la ruta calculada o por defecto."""
+        origin, dest = ctx['origin'], ctx['dest']
+        if ctx['distance_km'] and origin and dest:
+            straight_km = haversine_km(origin[0], origin[1], dest[0], dest[1])
+            if straight_km > 1.0:
+                return min(max(ctx['distance_km'] / straight_km, 1.0), 3.0)
+        return ETA_DEFAULT_CIRCUITY
+
+    def _compute_eta(self):
+        """ETA vigente desde tms.waybill.eta (una consulta por recordset)."""
+        states = self.env['tms.waybill.eta']._get_states(
+            [record._origin.id for record in self if record._origin.id])
+        for record in self:
+            state = states.get(record._origin.id) or {}
+            record.eta_date = state.get('eta_date') if record.state == 'in_transit' else False
+            record.eta_remaining_km = state.get('remaining_km') or 0.0
+            record.eta_speed_kmh = state.get('speed_kmh') or 0.0
+
+    @api.model
+    def get_eta_in_transit(self):
+        """
+        API masiva para el Dashboard: ETA de TODOS los viajes En Trayecto.
+
+        Dos consultas en total (búsqueda con record rules + lectura de la
+        tabla de ETA); no recalcula nada, lee el estado que mantiene la ingesta.
+
+        :return: lista de dicts {'waybill_id', 'name', 'eta', 'remaining_km',
+                 'speed_kmh', 'last_report_date'}
+        """
+        waybills = self.search([('state', '=', 'in_transit')])
+        states = self.env['tms.waybill.eta']._get_states(waybills.ids)
+        result = []
+        for waybill_id, name in zip(waybills.ids, waybills.mapped('name')):
+            state = states.get(waybill_id) or {}
+            result.append({
+                'waybill_id': waybill_id,
+                'name': name,
+                'eta': fields.Datetime.to_string(state.get('eta_date')),
+                'remaining_km': state.get('remaining_km') or 0.0,
+                'speed_kmh': state.get('speed_kmh') or 0.0,
+                'last_report_date': fields.Datetime.to_string(state.get('last_report_date')),
+            })
+        return result
 
     # ============================================================
     # MÉTODO CREATE (Generar folio automático)
@@ -1237,6 +2206,13 @@ class TmsWaybill(models.Model):
                 vals['name'] = self.env['ir.sequence'].next_by_code('tms.waybill') or 'Nuevo'
         return super(TmsWaybill, self).create(vals_list)
 
+    def write(self, vals):
+        """Al pasar a En Destino / Cerrado, compacta la trayectoria GPS."""
+        res = super().write(vals)
+        if vals.get('state') in TRACK_COMPACT_STATES:
+            self._compact_trajectory()
+        return res
+
 
     def action_send_email(self):
         """ Abre el wizard de correo con la plantilla pre-cargada """
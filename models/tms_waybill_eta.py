@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import models, fields, api
+from odoo.tools import SQL
+
+from .tms_waybill_position import haversine_km
+
+# ============================================================
+# PARÁMETROS DEL MOTOR DE ETA
+# ============================================================
+
+# Peso del ping más reciente en la velocidad exponencial (EWMA)
+ETA_SPEED_ALPHA = 0.2
+
+# Velocidades fuera de este rango (km/h) se descartan como ruido del GPS
+ETA_MIN_SPEED_KMH = 1.0
+ETA_MAX_SPEED_KMH = 150.0
+
+# Piso de velocidad para estimar (evita ETA infinita con el camión detenido)
+ETA_FLOOR_SPEED_KMH = 20.0
+
+# Factor carretera / línea recta cuando no hay ruta calculada
+ETA_DEFAULT_CIRCUITY = 1.25
+
+
+def update_eta(state, item, dest, profile_speed_kmh, circuity):
+    """
+    Actualiza incrementalmente (O(1)) el estado de ETA de un viaje con un ping.
+
+    :param state: dict con last_lat, last_long, last_report_date, speed_kmh
+                  (se modifica en sitio; vacío para el primer ping)
+    :param item: ping normalizado (lat, long, timestamp)
+    :param dest: (lat, long, radio_m) del destino o None
+    :param profile_speed_kmh: velocidad histórica del carril o 0.0
+    :param circuity: factor carretera / línea recta
+    :return: state actualizado con remaining_km y eta_date
+    """
+    if state.get('last_report_date'):
+        hours = (item['timestamp'] - state['last_report_date']).total_seconds() / 3600.0
+        if hours > 0:
+            speed = haversine_km(state['last_lat'], state['last_long'], item['lat'], item['long']) / hours
+            if ETA_MIN_SPEED_KMH <= speed <= ETA_MAX_SPEED_KMH:
+                previous = state.get('speed_kmh') or speed
+                state['speed_kmh'] = ETA_SPEED_ALPHA * speed + (1 - ETA_SPEED_ALPHA) * previous
+
+    state.update({
+        'last_lat': item['lat'],
+        'last_long': item['long'],
+        'last_report_date': item['timestamp'],
+    })
+    if not dest:
+        state.update({'remaining_km': 0.0, 'eta_date': None})
+        return state
+
+    # Mezcla: velocidad reciente del camión + perfil histórico del carril
+    live_speed = state.get('speed_kmh') or 0.0
+    speeds = [speed for speed in (live_speed, profile_speed_kmh) if speed]
+    speed = max(sum(speeds) / len(speeds) if speeds else 0.0, ETA_FLOOR_SPEED_KMH)
+
+    remaining_km = haversine_km(item['lat'], item['long'], dest[0], dest[1]) * circuity
+    state.update({
+        'remaining_km': remaining_km,
+        'eta_date': item['timestamp'] + timedelta(hours=remaining_km / speed),
+    })
+    return state
+
+
+class TmsWaybillEta(models.Model):
+    """
+    Estado del motor de ETA por viaje en tránsito.
+
+    CONCEPTO: Una fila angosta por viaje con la última posición, la velocidad
+    exponencial (EWMA) y la ETA vigente. Se actualiza con UN upsert por lote
+    de pings (no un UPDATE por ping sobre tms_waybill).
+
+    ARQUITECTURA SAAS: sin company_id propio; hereda el aislamiento del viaje.
+    """
+
+    _name = 'tms.waybill.eta'
+    _description = 'ETA en Vivo del Viaje'
+    _rec_name = 'waybill_id'
+    _log_access = False
+
+    waybill_id = fields.Many2one(
+        'tms.waybill',
+        string='Viaje',
+        required=True,
+        ondelete='cascade',
+    )
+    eta_date = fields.Datetime(string='ETA')
+    remaining_km = fields.Float(string='Km Restantes')
+    speed_kmh = fields.Float(string='Velocidad Promedio (Km/h)')
+    last_lat = fields.Float(string='Última Latitud')
+    last_long = fields.Float(string='Última Longitud')
+    last_report_date = fields.Datetime(string='Último Reporte')
+
+    _sql_constraints = [
+        ('waybill_uniq', 'unique(waybill_id)', 'Solo puede existir un estado de ETA por viaje.')
+    ]
+
+    @api.model
+    def _get_states(self, waybill_ids):
+        """
+        Estado de ETA de varios viajes en una sola consulta.
+
+        :return: dict {waybill_id: dict de estado}
+        """
+        if not waybill_ids:
+            return {}
+        self.env.cr.execute(SQL(
+            """
+            SELECT waybill_id, eta_date, remaining_km, speed_kmh,
+                   last_lat, last_long, last_report_date
+              FROM tms_waybill_eta
+             WHERE waybill_id = ANY(%s)
+            """,
+            list(waybill_ids),
+        ))
+        columns = [desc[0] for desc in self.env.cr.description]
+        return {row[0]: dict(zip(columns, row)) for row in self.env.cr.fetchall()}
+
+    @api.model
+    def _upsert_states(self, states):
+        """
+        Guarda el estado de ETA de varios viajes en UN SOLO upsert.
+
+        :param states: dict {waybill_id: dict de estado}
+        """
+        if not states:
+            return
+        values = SQL(', ').join(
+            SQL('(%s, %s::timestamp, %s, %s, %s, %s, %s::timestamp)',
+                waybill_id, state.get('eta_date'), state.get('remaining_km') or 0.0,
+                state.get('speed_kmh') or 0.0, state['last_lat'], state['last_long'],
+                state['last_report_date'])
+            for waybill_id, state in states.items()
+        )
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tms_waybill_eta AS e
+                   (waybill_id, eta_date, remaining_km, speed_kmh,
+                    last_lat, last_long, last_report_date)
+            VALUES %s
+            ON CONFLICT (waybill_id) DO UPDATE
+               SET eta_date = EXCLUDED.eta_date,
+                   remaining_km = EXCLUDED.remaining_km,
+                   speed_kmh = EXCLUDED.speed_kmh,
+                   last_lat = EXCLUDED.last_lat,
+                   last_long = EXCLUDED.last_long,
+                   last_report_date = EXCLUDED.last_report_date
+             WHERE e.last_report_date IS NULL
+                OR e.last_report_date <= EXCLUDED.last_report_date
+            """,
+            values,
+        ))
+        self.invalidate_model()
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timezone
+from math import asin, cos, radians, sin, sqrt
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.tools import SQL, create_index
+
+# ============================================================
+# GEOMETRÍA Y COMPRESIÓN DE TRAYECTORIAS
+# ============================================================
+# Funciones puras (sin ORM) para poder reutilizarlas en lotes grandes.
+# Un punto de trayectoria es una tupla (report_date, lat, long).
+
+EARTH_RADIUS_KM = 6371.0
+
+# Versión del formato binario empaquetado (primer byte del blob)
+TRACK_FORMAT_VERSION = 1
+
+# Precisión de coordenadas empaquetadas: 1e-5 grados ≈ 1.1 m
+TRACK_COORD_SCALE = 100000
+
+# Días que se conservan los event_id de los puntos compactados (deduplicación
+# de reenvíos tardíos de la app); parámetro 'tms.track_event_retention_days'
+TRACK_EVENT_RETENTION_DAYS = 30
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """Distancia en línea recta (km) entre dos coordenadas."""
+    dlat = radians(lat2 - lat1)
+    dlong = radians(long2 - long1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlong / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(min(1.0, a)))
+
+
+def track_distance_km(points):
+    """Suma de haversine entre puntos consecutivos."""
+    return sum(
+        haversine_km(a[1], a[2], b[1], b[2])
+        for a, b in zip(points, points[1:])
+    )
+
+
+def simplify_track(points, tolerance_m):
+    """
+    Simplificación Douglas-Peucker (iterativa, sin recursión).
+
+    Proyecta los puntos a metros con una proyección equirectangular local
+    y conserva solo los que se alejan más de tolerance_m de la recta
+    entre sus vecinos conservados. El primer y último punto siempre se conservan.
+    """
+    count = len(points)
+    if count < 3 or tolerance_m <= 0:
+        return list(points)
+
+    lat0 = radians(sum(point[1] for point in points) / count)
+    kx = 111320.0 * cos(lat0)
+    ky = 110540.0
+    xy = [(point[2] * kx, point[1] * ky) for point in points]
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        dx, dy = bx - ax, by - ay
+        seg_len = sqrt(dx * dx + dy * dy)
+        max_dist, max_index = 0.0, None
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            if seg_len:
+                dist = abs(dy * px - dx * py + bx * ay - by * ax) / seg_len
+            else:
+                dist = sqrt((px - ax) ** 2 + (py - ay) ** 2)
+            if dist > max_dist:
+                max_dist, max_index = dist, i
+        if max_index is not None and max_dist > tolerance_m:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _write_varint(out, value):
+    """Entero con signo → zigzag → varint (7 bits por byte)."""
+    value = (value << 1) if value >= 0 else ((-value) << 1) - 1
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    """Lee un varint zigzag desde data[pos]. Retorna (valor, nueva_posición)."""
+    shift = result = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    value = (result >> 1) if not result & 1 else -((result + 1) >> 1)
+    return value, pos
+
+
+def encode_track(points):
+    """
+    Empaqueta una trayectoria en bytes.
+
+    FORMATO: [versión][n puntos] y por cada punto los DELTAS respecto al
+    anterior de (segundos epoch, lat * 1e5, long * 1e5) en varint zigzag.
+    Un punto típico ocupa 4-8 bytes.
+    """
+    out = bytearray([TRACK_FORMAT_VERSION])
+    _write_varint(out, len(points))
+    prev_ts = prev_lat = prev_long = 0
+    for report_date, lat, long in points:
+        ts = int(report_date.replace(tzinfo=timezone.utc).timestamp())
+        ilat = round(lat * TRACK_COORD_SCALE)
+        ilong = round(long * TRACK_COORD_SCALE)
+        _write_varint(out, ts - prev_ts)
+        _write_varint(out, ilat - prev_lat)
+        _write_varint(out, ilong - prev_long)
+        prev_ts, prev_lat, prev_long = ts, ilat, ilong
+    return bytes(out)
+
+
+def decode_track(data):
+    """Inverso de encode_track: bytes → lista de (report_date, lat, long)."""
+    if not data:
+        return []
+    if data[0] != TRACK_FORMAT_VERSION:
+        raise ValueError('Formato de trayectoria no soportado: %s' % data[0])
+    count, pos = _read_varint(data, 1)
+    points = []
+    ts = ilat = ilong = 0
+    for _i in range(count):
+        delta, pos = _read_varint(data, pos)
+        ts += delta
+        delta, pos = _read_varint(data, pos)
+        ilat += delta
+        delta, pos = _read_varint(data, pos)
+        ilong += delta
+        points.append((
+            datetime.fromtimestamp(ts, tz=timezone.utc).replace(tzinfo=None),
+            ilat / TRACK_COORD_SCALE,
+            ilong / TRACK_COORD_SCALE,
+        ))
+    return points
+
+
+class TmsWaybillPosition(models.Model):
+    """
+    Bitácora GPS del Viaje (Breadcrumbs).
+
+    CONCEPTO: Cada reporte de la App Móvil se GUARDA como una fila nueva
+    en lugar de sobrescribir last_app_lat/last_app_long en tms.waybill.
+
+    DISEÑO (Alta Frecuencia):
+    - Filas angostas: solo viaje, fecha, lat, long y status
+    - Sin columnas de auditoría (_log_access = False)
+    - SOLO INSERCIÓN: no se permite write (la historia no se edita)
+    - Inserción masiva por SQL desde action_driver_report_batch
+    - Índice compuesto (waybill_id, report_date DESC) para "última posición"
+      y para reproducir un viaje sin tocar la tabla tms_waybill
+    - Índice BRIN en report_date para consultas/purgas por rango de fechas
+    - Al compactar el viaje se borran las filas sin event_id; las que traen
+      event_id quedan sin coordenadas (compacted) para que el índice de
+      deduplicación siga rechazando los reenvíos de la app, y se borran al
+      vencer 'tms.track_event_retention_days'
+
+    ARQUITECTURA SAAS: sin company_id propio; el aislamiento se hereda del
+    viaje (ver record rule en security/tms_security.xml).
+    """
+
+    _name = 'tms.waybill.position'
+    _description = 'Bitácora GPS (Posición del Viaje)'
+    _order = 'waybill_id, report_date desc, id desc'
+    _rec_name = 'report_date'
+    _log_access = False
+
+    # ============================================================
+    # CAMPOS
+    # ============================================================
+
+    # Many2one: viaje reportado (indexado por el índice compuesto de init())
+    waybill_id = fields.Many2one(
+        'tms.waybill',
+        string='Viaje',
+        required=True,
+        ondelete='cascade',
+    )
+
+    # Datetime: hora del reporte (del dispositivo si la app la envía)
+    report_date = fields.Datetime(
+        string='Fecha Reporte',
+        required=True,
+    )
+
+    # Float sin digits → columna double precision (más angosta que numeric)
+    # NULL en las filas ya compactadas (el punto vive en track_packed del viaje)
+    latitude = fields.Float(string='Latitud')
+    longitude = fields.Float(string='Longitud')
+
+    # Selection: status reportado por la app
+    status = fields.Selection([
+        ('tracking', 'Posición'),
+        ('arrived_origin', 'Llegada a Origen'),
+        ('started_route', 'Inicio de Ruta'),
+        ('arrived_dest', 'Llegada a Destino'),
+    ], string='Status', required=True, default='tracking')
+
+    # Char: ID único del evento generado por la app (idempotencia de reintentos)
+    event_id = fields.Char(string='ID Evento (App)')
+
+    # Boolean: punto ya empaquetado en la trayectoria del viaje (solo conserva event_id)
+    compacted = fields.Boolean(string='Compactado', readonly=True)
+
+    def init(self):
+        """Índices para lecturas por viaje, por rango de fechas y deduplicación."""
+        create_index(
+            self.env.cr,
+            'tms_waybill_position_waybill_date_idx',
+            self._table,
+            ['waybill_id', 'report_date DESC'],
+        )
+        create_index(
+            self.env.cr,
+            'tms_waybill_position_date_brin_idx',
+            self._table,
+            ['report_date'],
+            method='brin',
+        )
+        # Índice de deduplicación: un event_id solo se acepta una vez por viaje
+        self.env.cr.execute(SQL(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS tms_waybill_position_event_uniq
+                ON tms_waybill_position (waybill_id, event_id)
+             WHERE event_id IS NOT NULL
+            """
+        ))
+
+    # ============================================================
+    # SOLO INSERCIÓN
+    # ============================================================
+
+    def write(self, vals):
+        raise UserError(_('La bitácora GPS no se puede modificar (solo inserción).'))
+
+    @api.model
+    def _log_positions(self, items):
+        """
+        Inserta muchos reportes en UN SOLO INSERT (sin pasar por el ORM).
+
+        Los reportes con event_id ya registrado para el viaje se descartan
+        en la misma sentencia (ON CONFLICT DO NOTHING sobre el índice único).
+
+        :param items: lista de dicts con waybill_id, timestamp, lat, long, status
+                      y event_id (opcional)
+        :return: set de (waybill_id, event_id) efectivamente insertados
+        """
+        if not items:
+            return set()
+        values = SQL(', ').join(
+            SQL('(%s, %s::timestamp, %s, %s, %s, %s)',
+                item['waybill_id'], item['timestamp'], item['lat'], item['long'],
+                item['status'], item.get('event_id') or None)
+            for item in items
+        )
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tms_waybill_position
+                   (waybill_id, report_date, latitude, longitude, status, event_id)
+            VALUES %s
+            ON CONFLICT (waybill_id, event_id) WHERE event_id IS NOT NULL DO NOTHING
+            RETURNING waybill_id, event_id
+            """,
+            values,
+        ))
+        return {row for row in self.env.cr.fetchall() if row[1]}
+
+    # ============================================================
+    # LECTURAS (nunca tocan la tabla tms_waybill)
+    # ============================================================
+
+    @api.model
+    def _get_latest_positions(self, waybill_ids):
+        """
+        Última posición de cada viaje (DISTINCT ON sobre el índice compuesto).
+
+        :return: dict {waybill_id: (lat, long, report_date)}
+        """
+        if not waybill_ids:
+            return {}
+        self.flush_model()
+        self.env.cr.execute(SQL(
+            """
+            SELECT DISTINCT ON (waybill_id) waybill_id, latitude, longitude, report_date
+              FROM tms_waybill_position
+             WHERE waybill_id = ANY(%s)
+               AND compacted IS NOT TRUE
+             ORDER BY waybill_id, report_date DESC, id DESC
+            """,
+            list(waybill_ids),
+        ))
+        return {row[0]: row[1:] for row in self.env.cr.fetchall()}
+
+    @api.model
+    def _get_track(self, waybill_id):
+        """
+        Recorrido aún no compactado de un viaje, en orden cronológico.
+
+        :return: lista de tuplas (report_date, lat, long)
+        """
+        self.flush_model()
+        self.env.cr.execute(SQL(
+            """
+            SELECT report_date, latitude, longitude
+              FROM tms_waybill_position
+             WHERE waybill_id = %s
+               AND compacted IS NOT TRUE
+             ORDER BY report_date, id
+            """,
+            waybill_id,
+        ))
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _purge_waybill_positions(self, waybill_ids):
+        """
+        Libera las filas crudas de viajes ya compactados.
+
+        - Sin event_id: se borran (un solo DELETE)
+        - Con event_id: se quitan las coordenadas y se marcan compacted; el
+          índice único (waybill_id, event_id) sigue rechazando los reenvíos
+          de la app que lleguen después de compactar
+
+        :return: filas liberadas
+        """
+        if not waybill_ids:
+            return 0
+        self.env.cr.execute(SQL(
+            "DELETE FROM tms_waybill_position WHERE waybill_id = ANY(%s) AND event_id IS NULL",
+            list(waybill_ids),
+        ))
+        purged = self.env.cr.rowcount
+        self.env.cr.execute(SQL(
+            """
+            UPDATE tms_waybill_position
+               SET latitude = NULL, longitude = NULL, compacted = TRUE
+             WHERE waybill_id = ANY(%s)
+               AND event_id IS NOT NULL
+               AND compacted IS NOT TRUE
+            """,
+            list(waybill_ids),
+        ))
+        self.invalidate_model()
+        return purged + self.env.cr.rowcount
+
+    @api.autovacuum
+    def _gc_compacted_events(self):
+        """
+        Borra los event_id compactados más viejos que la ventana de reenvíos
+        de la app ('tms.track_event_retention_days').
+        """
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'tms.track_event_retention_days', TRACK_EVENT_RETENTION_DAYS))
+        self.env.cr.execute(SQL(
+            """
+            DELETE FROM tms_waybill_position
+             WHERE compacted
+               AND report_date < NOW() AT TIME ZONE 'UTC' - make_interval(days => %s)
+            """,
+            days,
+        ))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de cotización vectorizado (recotización masiva).
+
+Mismas fórmulas que _compute_cost_diesel_total, _compute_proposal_values,
+_compute_amount_total y _compute_margin de tms.waybill, pero sobre columnas
+completas: una sola pasada para miles de cotizaciones en lugar de un
+compute por registro.
+
+NumPy es opcional: si está instalado se usan arreglos; si no, listas de
+Python con el mismo resultado. No toca env ni cursor.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Columnas de entrada (en este orden) que lee la recotización
+QUOTE_INPUT_COLUMNS = (
+    'distance_km', 'extra_distance_km', 'fuel_price_liter', 'fuel_performance',
+    'cost_tolls', 'cost_driver', 'cost_maneuver', 'cost_other',
+    'price_per_km', 'rate_surcharge_percent', 'rate_minimum_amount',
+    'profit_margin_percent', 'proposal_direct_amount',
+)
+
+# Columnas de salida de compute_quotes
+QUOTE_OUTPUT_COLUMNS = (
+    'cost_diesel_total', 'proposal_km_total', 'proposal_trip_total', 'amount_total',
+    'cost_total', 'margin_amount', 'margin_percent',
+)
+
+
+def compute_quotes(columns, selected, digits=2):
+    """
+    Calcula diesel, propuestas y monto final de muchas cotizaciones a la vez.
+
+    :param columns: dict {columna de QUOTE_INPUT_COLUMNS: lista de floats}
+    :param selected: lista con la propuesta seleccionada ('km', 'trip', 'direct')
+    :param digits: decimales de la moneda para redondear los montos
+    :return: dict {columna de QUOTE_OUTPUT_COLUMNS: lista de floats}
+    """
+    if numpy is not None:
+        return _compute_quotes_numpy(columns, selected, digits)
+    return _compute_quotes_python(columns, selected, digits)
+
+
+def _compute_quotes_numpy(columns, selected, digits):
+    col = {name: numpy.asarray(columns[name], dtype=float) for name in QUOTE_INPUT_COLUMNS}
+    selected = numpy.asarray(selected, dtype=object)
+    total_distance = col['distance_km'] + col['extra_distance_km']
+
+    # Diesel: (km / rendimiento) * precio; 0 si no hay rendimiento
+    performance = col['fuel_performance']
+    diesel = numpy.divide(
+        total_distance * col['fuel_price_liter'], performance,
+        out=numpy.zeros_like(total_distance), where=performance > 0)
+
+    # Propuesta por KM (con recargo y mínimo del tarifario) y por viaje (costos / (1 - margen))
+    km_total = numpy.maximum(
+        total_distance * col['price_per_km'] * (1 + col['rate_surcharge_percent'] / 100),
+        col['rate_minimum_amount'])
+    costs = diesel + col['cost_tolls'] + col['cost_driver'] + col['cost_maneuver'] + col['cost_other']
+    margin_factor = 1 - col['profit_margin_percent'] / 100
+    trip_total = numpy.divide(costs, margin_factor, out=costs.copy(), where=margin_factor > 0)
+
+    amount = numpy.select(
+        [selected == 'km', selected == 'trip'],
+        [km_total, trip_total],
+        default=col['proposal_direct_amount'])
+    amount = numpy.round(amount, digits)
+    costs = numpy.round(costs, digits)
+    margin = amount - costs
+    margin_percent = numpy.divide(100.0 * margin, amount, out=numpy.zeros_like(margin), where=amount != 0)
+    return {
+        'cost_diesel_total': diesel.tolist(),
+        'proposal_km_total': numpy.round(km_total, digits).tolist(),
+        'proposal_trip_total': numpy.round(trip_total, digits).tolist(),
+        'amount_total': amount.tolist(),
+        'cost_total': costs.tolist(),
+        'margin_amount': margin.tolist(),
+        'margin_percent': margin_percent.tolist(),
+    }
+
+
+def _compute_quotes_python(columns, selected, digits):
+    result = {name: [] for name in QUOTE_OUTPUT_COLUMNS}
+    rows = zip(*(columns[name] for name in QUOTE_INPUT_COLUMNS))
+    for (distance, extra, fuel_price, performance, tolls, driver, maneuver, other,
+         price_per_km, surcharge, minimum, margin, direct), proposal in zip(rows, selected):
+        total_distance = distance + extra
+        diesel = total_distance * fuel_price / performance if performance > 0 else 0.0
+        km_total = max(total_distance * price_per_km * (1 + surcharge / 100), minimum)
+        costs = diesel + tolls + driver + maneuver + other
+        margin_factor = 1 - margin / 100
+        trip_total = costs / margin_factor if margin_factor > 0 else costs
+        amount = km_total if proposal == 'km' else trip_total if proposal == 'trip' else direct
+        amount, costs = round(amount, digits), round(costs, digits)
+        margin = amount - costs
+        result['cost_diesel_total'].append(diesel)
+        result['proposal_km_total'].append(round(km_total, digits))
+        result['proposal_trip_total'].append(round(trip_total, digits))
+        result['amount_total'].append(amount)
+        result['cost_total'].append(costs)
+        result['margin_amount'].append(margin)
+        result['margin_percent'].append(100.0 * margin / amount if amount else 0.0)
+    return result
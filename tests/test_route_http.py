@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del cliente HTTP de rutas: reintentos y circuit breaker.
+
+Sin red ni BD: la sesión HTTP compartida se reemplaza por un mock y los
+breakers de cada prueba empiezan vacíos.
+"""
+
+from unittest.mock import MagicMock, patch
+
+from odoo.tests.common import BaseCase, tagged
+
+from odoo.addons.tms.models import tms_route_http
+from odoo.addons.tms.models.tms_route_provider import RouteProviderError, call_provider, fetch_google_route
+
+GOOGLE_URL = 'https://routes.example.test/v1:computeRoutes'
+
+ROUTE_OK = {
+    'routes': [{
+        'distanceMeters': 120000,
+        'duration': '5400s',
+        'travelAdvisory': {'tollInfo': {'estimatedPrice': [{'currencyCode': 'MXN', 'units': '250'}]}},
+    }],
+}
+
+
+def _response(status_code, data=None):
+    response = MagicMock(status_code=status_code)
+    response.json.return_value = data if data is not None else {}
+    return response
+
+
+@tagged('tms', 'post_install', '-at_install')
+class TestRouteHttp(BaseCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = MagicMock()
+        for patcher in (
+            patch.object(tms_route_http, 'get_http_session', return_value=self.session),
+            patch.object(tms_route_http.time, 'sleep'),
+            patch.dict(tms_route_http._breakers, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _call(self):
+        fetch = lambda origin_zip, dest_zip: fetch_google_route(GOOGLE_URL, 'key', origin_zip, dest_zip)
+        return call_provider('test_db', 'google', fetch, '06600', '64000')
+
+    def test_retry_then_success(self):
+        """Un 503 se reintenta y la segunda respuesta se usa."""
+        self.session.post.side_effect = [_response(503), _response(200, ROUTE_OK)]
+
+        result = self._call()
+
+        self.assertEqual(self.session.post.call_count, 2)
+        self.assertAlmostEqual(result['distance_km'], 120.0)
+        self.assertAlmostEqual(result['duration_hours'], 1.5)
+        self.assertAlmostEqual(result['cost_tolls'], 250.0)
+        self.assertEqual(tms_route_http.get_breaker('google').state, 'closed')
+
+    def test_breaker_opens_after_threshold(self):
+        """THRESHOLD llamadas fallidas abren el breaker; la siguiente no sale a la red."""
+        self.session.post.return_value = _response(503)
+        attempts = tms_route_http.ROUTE_HTTP_RETRIES + 1
+
+        for _i in range(tms_route_http.ROUTE_BREAKER_THRESHOLD):
+            with self.assertRaises(RouteProviderError) as error:
+                self._call()
+            self.assertEqual(error.exception.reason, 'provider_error')
+        self.assertEqual(tms_route_http.get_breaker('google').state, 'open')
+        self.assertEqual(self.session.post.call_count, tms_route_http.ROUTE_BREAKER_THRESHOLD * attempts)
+
+        with self.assertRaises(RouteProviderError) as error:
+            self._call()
+        self.assertEqual(error.exception.reason, 'circuit_open')
+        self.assertEqual(self.session.post.call_count, tms_route_http.ROUTE_BREAKER_THRESHOLD * attempts)
+
+    def test_half_open_recovery(self):
+        """Vencido el cooldown pasa una sola llamada de prueba; si funciona, el breaker se cierra."""
+        breaker = tms_route_http.get_breaker('google')
+        for _i in range(breaker.threshold):
+            breaker.record(False)
+        self.assertEqual(breaker.state, 'open')
+
+        breaker.opened_at -= breaker.cooldown
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow(), "Solo una llamada de prueba en half_open")
+        breaker.release()
+
+        self.session.post.return_value = _response(200, ROUTE_OK)
+        self._call()
+
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+
+    def test_half_open_failure_reopens(self):
+        """Si la llamada de prueba falla, el breaker vuelve a abrirse."""
+        breaker = tms_route_http.get_breaker('google')
+        for _i in range(breaker.threshold):
+            breaker.record(False)
+        breaker.opened_at -= breaker.cooldown
+        self.session.post.return_value = _response(503)
+
+        with self.assertRaises(RouteProviderError):
+            self._call()
+
+        self.assertEqual(breaker.state, 'open')
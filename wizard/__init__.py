@@ -3,3 +3,4 @@
 # Importamos el wizard de importación de catálogos SAT
 from . import sat_import_wizard
 from . import partner_assign_company_wizard
+from . import waybill_requote_wizard
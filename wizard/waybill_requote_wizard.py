@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from markupsafe import Markup, escape
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+from ..models.tms_waybill import REQUOTE_STATES
+
+# Cotizaciones con cambio que se listan en el reporte (las de mayor diferencia)
+REQUOTE_REPORT_LINES = 50
+
+
+class WaybillRequoteWizard(models.TransientModel):
+    """
+    Wizard de recotización masiva (ej. cuando se mueve el precio del diesel).
+
+    USO:
+    - Desde la lista de viajes (Acción > Recotizar) con los viajes seleccionados,
+      o sin selección para todas las cotizaciones abiertas de la empresa
+    - Opcionalmente capturar el nuevo precio del diesel
+    - Recotizar: muestra el total anterior vs. el nuevo y las mayores diferencias
+    """
+    _name = 'tms.waybill.requote.wizard'
+    _description = 'Wizard: Recotización Masiva'
+
+    company_id = fields.Many2one(
+        'res.company',
+        string='Empresa',
+        required=True,
+        default=lambda self: self.env.company,
+    )
+    waybill_ids = fields.Many2many(
+        'tms.waybill',
+        string='Cotizaciones',
+        help='Vacío: todas las cotizaciones en Solicitud / En Pedido de la empresa',
+    )
+    update_fuel_price = fields.Boolean(string='Actualizar Precio Diesel')
+    fuel_price_liter = fields.Float(string='Nuevo Precio Diesel (L)', digits=(10, 2))
+    apply_rates = fields.Boolean(
+        string='Aplicar Tarifarios',
+        default=True,
+        help='Volver a resolver precio por km, recargo y mínimo con los tarifarios vigentes',
+    )
+
+    state = fields.Selection([('draft', 'Captura'), ('done', 'Resultado')], default='draft')
+    count = fields.Integer(string='Cotizaciones Revisadas', readonly=True)
+    changed = fields.Integer(string='Cotizaciones con Cambio', readonly=True)
+    currency_id = fields.Many2one(related='company_id.currency_id')
+    old_total = fields.Monetary(string='Total Anterior', readonly=True)
+    new_total = fields.Monetary(string='Total Nuevo', readonly=True)
+    report_html = fields.Html(string='Detalle', readonly=True, sanitize=False)
+
+    @api.model
+    def default_get(self, fields_list):
+        res = super().default_get(fields_list)
+        if self.env.context.get('active_model') == 'tms.waybill' and self.env.context.get('active_ids'):
+            res['waybill_ids'] = [(6, 0, self.env.context['active_ids'])]
+        return res
+
+    def action_requote(self):
+        """Recotiza las cotizaciones y muestra el reporte anterior vs. nuevo."""
+        self.ensure_one()
+        if self.update_fuel_price and self.fuel_price_liter <= 0:
+            raise UserError(_('El nuevo precio del diesel debe ser mayor a cero.'))
+        waybills = self.waybill_ids or self.env['tms.waybill'].search([
+            ('company_id', '=', self.company_id.id),
+            ('state', 'in', REQUOTE_STATES),
+        ])
+        result = waybills._bulk_requote(
+            self.fuel_price_liter if self.update_fuel_price else None, apply_rates=self.apply_rates)
+        if not result['count']:
+            raise UserError(_('No hay cotizaciones en Solicitud / En Pedido para recotizar.'))
+
+        currency = self.currency_id
+        rows = Markup('').join(
+            Markup('<tr><td>%s</td><td class="text-end">%s</td><td class="text-end">%s</td></tr>') % (
+                escape(name),
+                escape(currency.format(old) if currency else old),
+                escape(currency.format(new) if currency else new),
+            )
+            for _id, name, old, new in result['lines'][:REQUOTE_REPORT_LINES]
+        )
+        self.write({
+            'state': 'done',
+            'count': result['count'],
+            'changed': result['changed'],
+            'old_total': result['old_total'],
+            'new_total': result['new_total'],
+            'report_html': Markup(
+                '<table class="table table-sm"><thead><tr><th>%s</th>'
+                '<th class="text-end">%s</th><th class="text-end">%s</th></tr></thead>'
+                '<tbody>%s</tbody></table>'
+            ) % (_('Viaje'), _('Anterior'), _('Nuevo'), rows) if rows else False,
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }